@@ -1,27 +1,245 @@
 # bot.py
-import os, re, threading, json, math, datetime
+import os, re, sys, threading, json, math, datetime, asyncio, queue, time, contextlib, gzip, hashlib, signal
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from bisect import bisect_left, bisect_right
 from pathlib import Path
 from dotenv import load_dotenv
-from http.server import HTTPServer, BaseHTTPRequestHandler
 import requests
 
 # ========== 加载环境 ==========
 load_dotenv()
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OWNER_ID  = os.getenv("OWNER_ID")  # 可选：你的 Telegram ID（字符串），拥有永久管理员权限
+OWNER_USER_ID = int(OWNER_ID) if OWNER_ID and OWNER_ID.isdigit() else None  # 启动时解析一次
 
 # ========== 记账核心状态（多群组支持）==========
 DATA_DIR = Path("./data")
 GROUPS_DIR = DATA_DIR / "groups"
 LOG_DIR  = DATA_DIR / "logs"
+ARCHIVE_DIR = DATA_DIR / "archive"
 ADMINS_FILE = DATA_DIR / "admins.json"
+RECIPIENTS_FILE = DATA_DIR / "recipients.json"
+RECIPIENTS_JOURNAL = DATA_DIR / "recipients.journal"
 
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 GROUPS_DIR.mkdir(parents=True, exist_ok=True)
 LOG_DIR.mkdir(parents=True, exist_ok=True)
+ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+
+# ========== 运行指标 ==========
+# 手写的 Prometheus 计数器/直方图（不引入额外依赖），由 HTTP 服务器的 /metrics 按文本格式输出。
+# 存储读写在 I/O 线程中计时，所以每个指标带一把锁；已有统计（缓存命中、群组数等）在输出时通过回调读取。
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+metrics_registry = []
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_metric_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class CounterMetric:
+    """只增不减的计数器（可带标签）"""
+    kind = "counter"
+    
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}  # {标签值元组: 数值}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+    
+    def render(self) -> list:
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{format_metric_labels(self.labels, key)} {value}" for key, value in items]
+
+class HistogramMetric:
+    """直方图：按桶累计观测次数，另记总和与次数（可带标签）"""
+    kind = "histogram"
+    
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = METRIC_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {}  # {标签值元组: [各桶计数..., 总和, 次数]}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+    
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+    
+    def render(self) -> list:
+        with self.lock:
+            items = sorted((key, list(entry)) for key, entry in self.values.items())
+        lines = []
+        for key, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_metric_labels(self.labels, key, le)} {cumulative}")
+            inf = 'le="+Inf"'
+            labels = format_metric_labels(self.labels, key)
+            lines.append(f"{self.name}_bucket{format_metric_labels(self.labels, key, inf)} {entry[-1]}")
+            lines.append(f"{self.name}_sum{labels} {entry[-2]}")
+            lines.append(f"{self.name}_count{labels} {entry[-1]}")
+        return lines
+
+class CallbackMetric:
+    """输出时才读取的指标：read() 返回一个数值，或 {标签值元组: 数值}"""
+    
+    def __init__(self, name: str, help: str, kind: str, read, labels: tuple = ()):
+        self.name, self.help, self.kind, self.read, self.labels = name, help, kind, read, labels
+        metrics_registry.append(self)
+    
+    def render(self) -> list:
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{format_metric_labels(self.labels, key)} {value}" for key, value in sorted(values.items())]
+
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+HANDLER_SECONDS = HistogramMetric("bot_handler_seconds", "群组命令处理耗时（含等待群组锁）", ("command",))
+HANDLER_ERRORS = CounterMetric("bot_handler_errors_total", "群组命令处理时抛出的异常", ("command",))
+CHAT_LOCK_WAIT_SECONDS = HistogramMetric("bot_chat_lock_wait_seconds", "等待群组串行锁的时间")
+STATE_LOAD_SECONDS = HistogramMetric("bot_state_load_seconds", "从存储读取一个群组状态的耗时")
+STATE_SAVE_SECONDS = HistogramMetric("bot_state_save_seconds", "写入一个群组（快照或操作日志）的耗时")
+STATE_BYTES_WRITTEN = CounterMetric("bot_state_bytes_written_total", "写入存储的群组数据字节数", ("kind",))
+TELEGRAM_API_SECONDS = HistogramMetric("bot_telegram_api_seconds", "Telegram Bot API 请求耗时", ("method",))
+TELEGRAM_API_ERRORS = CounterMetric("bot_telegram_api_errors_total", "Telegram Bot API 请求失败次数", ("method", "reason"))
+render_cache_stats = {"hit": 0, "miss": 0}
+
+# 群组状态缓存上限：条目数 / 估算内存字节数（0 表示不限制）
+GROUP_CACHE_MAX_ENTRIES = int(os.getenv("GROUP_CACHE_MAX_ENTRIES", "500"))
+GROUP_CACHE_MAX_BYTES = int(os.getenv("GROUP_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+class GroupStateCache:
+    """有界 LRU 群组状态缓存：超出条目数或字节预算时淘汰最久未使用的群组，淘汰前写回未保存的修改"""
+    
+    BASE_BYTES = 4096     # 每个群组状态的基础开销（估算）
+    RECORD_BYTES = 200    # 每条账单记录（LedgerRecord）的内存开销（估算）
+    
+    def __init__(self, max_entries: int = 0, max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # {chat_id: state_dict}，最近使用的在末尾
+        self.sizes = {}
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.on_evict = None  # 淘汰前的回调（写回修改）
+        self.pinned = set()   # 正在使用、不能淘汰的群组
+    
+    def __contains__(self, chat_id) -> bool:
+        return chat_id in self.entries
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def estimate_bytes(self, state: dict) -> int:
+        recent = state["recent"]
+        return self.BASE_BYTES + self.RECORD_BYTES * (len(recent["in"]) + len(recent["out"]))
+    
+    def get(self, chat_id: int) -> dict | None:
+        """读取缓存（计入命中/未命中统计）：每条消息只在 aload_group_state 里查一次，其余内部访问用 peek"""
+        state = self.entries.get(chat_id)
+        if state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(chat_id)
+        return state
+    
+    def peek(self, chat_id: int) -> dict | None:
+        """读取缓存但不影响 LRU 顺序和统计"""
+        return self.entries.get(chat_id)
+    
+    def put(self, chat_id: int, state: dict):
+        self.entries[chat_id] = state
+        self.entries.move_to_end(chat_id)
+        self.resize(chat_id)
+    
+    def resize(self, chat_id: int):
+        """群组记录数变化后更新占用估算，并在超出预算时淘汰"""
+        state = self.entries.get(chat_id)
+        if state is None:
+            return
+        size = self.estimate_bytes(state)
+        self.total_bytes += size - self.sizes.get(chat_id, 0)
+        self.sizes[chat_id] = size
+        self.evict_if_needed()
+    
+    def over_budget(self, entries: int | None = None, total_bytes: int | None = None) -> bool:
+        entries = len(self.entries) if entries is None else entries
+        total_bytes = self.total_bytes if total_bytes is None else total_bytes
+        if self.max_entries and entries > self.max_entries:
+            return True
+        return bool(self.max_bytes) and total_bytes > self.max_bytes
+    
+    def evict_if_needed(self):
+        if not self.over_budget():
+            return  # 绝大多数调用在这里返回，不遍历缓存
+        # 从最久未使用的一端逐个取，跳过被钉住的群组，够了就停；至少保留最近使用的一个群组
+        victims = []
+        entries, total_bytes = len(self.entries), self.total_bytes
+        for chat_id in islice(self.entries, len(self.entries) - 1):
+            if not self.over_budget(entries, total_bytes):
+                break
+            if chat_id in self.pinned:
+                continue
+            victims.append(chat_id)
+            entries -= 1
+            total_bytes -= self.sizes.get(chat_id, 0)
+        for chat_id in victims:
+            if self.on_evict is not None:
+                self.on_evict(chat_id)
+            del self.entries[chat_id]
+            self.total_bytes -= self.sizes.pop(chat_id, 0)
+            self.evictions += 1
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
 
 # 群组状态缓存 {chat_id: state_dict}
-groups_state = {}
+groups_state = GroupStateCache(GROUP_CACHE_MAX_ENTRIES, GROUP_CACHE_MAX_BYTES)
 
 def get_default_state():
     """返回默认群组状态（初始费率/汇率为0，需要管理员设置）"""
@@ -43,94 +261,1350 @@ def group_file_path(chat_id: int) -> Path:
     """获取群组状态文件路径"""
     return GROUPS_DIR / f"group_{chat_id}.json"
 
-def load_group_state(chat_id: int) -> dict:
-    """从JSON文件加载群组状态"""
-    # 先检查缓存
-    if chat_id in groups_state:
-        return groups_state[chat_id]
-    
-    # 从文件读取
-    file_path = group_file_path(chat_id)
-    if file_path.exists():
+def group_journal_path(chat_id: int) -> Path:
+    """获取群组操作日志（journal）文件路径"""
+    return GROUPS_DIR / f"group_{chat_id}.journal"
+
+# 每个群组累计多少条操作日志后压缩成一次快照
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "200"))
+
+# 自上次快照以来的操作日志条数 {chat_id: count}
+journal_counts = {}
+
+# ========== 账单记录与聚合 ==========
+class LedgerRecord:
+    """一条账单记录（内存中的紧凑表示，序列化后仍是原来的 JSON 格式）"""
+    __slots__ = ("ts", "raw", "usdt", "country", "fx", "rate", "type", "line", "id", "msg")
+    
+    def __init__(self, ts=None, raw=None, usdt=0.0, country=None, fx=None, rate=None, type=None, line=None,
+                 id=None, msg=None):
+        self.ts = sys.intern(ts) if ts else ts
+        self.raw = raw
+        self.usdt = usdt
+        self.country = sys.intern(country) if country else country  # 国家名大量重复，驻留后共用同一个字符串
+        self.fx = fx
+        self.rate = rate
+        self.type = type
+        self.line = line
+        self.id = id    # 群组内唯一的记录编号
+        self.msg = msg  # 记账后机器人回复的消息 ID（用于撤销）
+    
+    @classmethod
+    def from_dict(cls, d: dict) -> "LedgerRecord":
+        return cls(d.get("ts"), d.get("raw"), d.get("usdt", 0.0), d.get("country"),
+                   d.get("fx"), d.get("rate"), d.get("type"), d.get("line"), d.get("id"), d.get("msg"))
+    
+    def to_dict(self) -> dict:
+        if self.type == "下发":
+            d = {"ts": self.ts, "usdt": self.usdt, "type": self.type}
+        else:
+            d = {"ts": self.ts, "raw": self.raw, "usdt": self.usdt, "country": self.country}
+            if self.fx is not None:
+                d["fx"] = self.fx
+            if self.rate is not None:
+                d["rate"] = self.rate
+            if self.type is not None:
+                d["type"] = self.type
+        if self.line is not None:
+            d["line"] = self.line
+        if self.id is not None:
+            d["id"] = self.id
+        if self.msg is not None:
+            d["msg"] = self.msg
+        return d
+
+def compact_records(state: dict) -> dict:
+    """把状态中的记录字典转换成 LedgerRecord（已转换的保持不变）"""
+    for direction in ("in", "out"):
+        state["recent"][direction] = [
+            r if isinstance(r, LedgerRecord) else LedgerRecord.from_dict(r)
+            for r in state["recent"][direction]
+        ]
+    return state
+
+# 每个群组在内存里维护当天的笔数/合计（state["_agg"]），随每条操作增量更新，
+# 汇总显示时直接读取，不再重新扫描记录列表。以 "_" 开头的键只存在于内存中，不会写盘。
+
+def record_kind(direction: str, item: LedgerRecord) -> str:
+    """记录的分类：in（入金）/ out（出金）/ send（下发）"""
+    if direction == "out" and item.type == "下发":
+        return "send"
+    return direction
+
+def new_aggregates() -> dict:
+    return {
+        "count": {"in": 0, "out": 0, "send": 0},
+        "raw": {"in": 0.0, "out": 0.0},
+        "usdt": {"in": 0.0, "out": 0.0, "send": 0.0},
+        "countries": {},  # {国家: {"in"/"out": {"count", "raw", "usdt"}}}
+    }
+
+def agg_add(agg: dict, kind: str, item: LedgerRecord, sign: int = 1):
+    """把一条记录计入（sign=1）或移出（sign=-1）聚合"""
+    usdt = item.usdt or 0
+    agg["count"][kind] += sign
+    agg["usdt"][kind] = round(agg["usdt"][kind] + sign * usdt, 6)
+    if kind == "send":
+        return
+    raw = item.raw or 0
+    agg["raw"][kind] = round(agg["raw"][kind] + sign * raw, 6)
+    country = item.country or "通用"
+    per_country = agg["countries"].setdefault(country, {})
+    c = per_country.setdefault(kind, {"count": 0, "raw": 0.0, "usdt": 0.0})
+    c["count"] += sign
+    c["raw"] = round(c["raw"] + sign * raw, 6)
+    c["usdt"] = round(c["usdt"] + sign * usdt, 6)
+    if c["count"] <= 0:
+        # 撤销后该国家该方向已无记录
+        del per_country[kind]
+        if not per_country:
+            del agg["countries"][country]
+
+def ensure_aggregates(state: dict) -> dict:
+    """取得群组聚合，不存在时（刚从磁盘加载）按当前记录重建一次"""
+    agg = state.get("_agg")
+    if agg is None:
+        agg = new_aggregates()
+        for direction in ("in", "out"):
+            for item in state["recent"][direction]:
+                agg_add(agg, record_kind(direction, item), item)
+        state["_agg"] = agg
+    return agg
+
+# 记录编号索引（state["_index"]）：记录编号 → (方向, 记录)，回复消息 ID → 记录编号。
+# 撤销时按被回复的消息直接找到对应记录，不再扫描记录列表、也不会误删金额相同的其他记录。
+
+def ensure_record_index(state: dict) -> dict:
+    """取得群组的记录索引，不存在时按当前记录重建（旧记录没有编号的在这里补上）"""
+    index = state.get("_index")
+    if index is None:
+        index = {"by_id": {}, "by_msg": {}, "next_id": 1}
+        pending = []
+        for direction in ("in", "out"):
+            for item in state["recent"][direction]:
+                if item.id is None:
+                    pending.append((direction, item))
+                else:
+                    index_record(index, direction, item)
+        # 旧记录按从早到晚的顺序编号（列表里最新的在前）
+        for direction, item in reversed(pending):
+            item.id = index["next_id"]
+            index_record(index, direction, item)
+        state["_index"] = index
+    return index
+
+def index_record(index: dict, direction: str, item: LedgerRecord):
+    index["by_id"][item.id] = (direction, item)
+    if item.msg is not None:
+        index["by_msg"][item.msg] = item.id
+    if item.id >= index["next_id"]:
+        index["next_id"] = item.id + 1
+
+def unindex_record(index: dict, item: LedgerRecord):
+    index["by_id"].pop(item.id, None)
+    if item.msg is not None:
+        index["by_msg"].pop(item.msg, None)
+
+def add_record(state: dict, direction: str, op_item: dict) -> LedgerRecord:
+    """新记录放到列表最前面并编号（编号写回操作里，回放日志时得到同样的编号）"""
+    item = LedgerRecord.from_dict(op_item)
+    index = ensure_record_index(state)
+    if item.id is None:
+        item.id = op_item["id"] = index["next_id"]
+    index_record(index, direction, item)
+    state["recent"][direction].insert(0, item)
+    agg_add(ensure_aggregates(state), record_kind(direction, item), item)
+    return item
+
+def remove_records(state: dict, direction: str, predicate) -> list:
+    """从记录列表中移除满足条件的记录，并同步更新聚合和索引"""
+    agg = ensure_aggregates(state)
+    index = ensure_record_index(state)
+    kept, removed = [], []
+    for r in state["recent"][direction]:
+        (removed if predicate(r) else kept).append(r)
+    state["recent"][direction] = kept
+    for r in removed:
+        agg_add(agg, record_kind(direction, r), r, -1)
+        unindex_record(index, r)
+    return removed
+
+def state_to_json(state: dict, indent: int | None = 2) -> str:
+    """序列化群组状态（去掉只存在于内存中的 "_" 开头的键，记录还原成字典）"""
+    return json.dumps({k: v for k, v in state.items() if not k.startswith("_")},
+                      ensure_ascii=False, indent=indent, default=LedgerRecord.to_dict)
+
+def apply_ledger_op(state: dict, op: dict):
+    """把一条账本操作应用到群组状态（实时处理和日志回放共用同一套逻辑）"""
+    kind = op["op"]
+    summary = state["summary"]
+    agg = ensure_aggregates(state)
+    
+    if kind == "in":
+        # 入金：记录 + 增加应下发
+        item = add_record(state, "in", op["item"])
+        summary["should_send_usdt"] = trunc2(summary["should_send_usdt"] + item.usdt)
+    elif kind == "out":
+        # 出金：记录 + 增加已下发
+        item = add_record(state, "out", op["item"])
+        summary["sent_usdt"] = trunc2(summary["sent_usdt"] + item.usdt)
+    elif kind == "send":
+        # 下发：正数扣除应下发，负数（撤销）增加应下发
+        item = add_record(state, "out", op["item"])
+        summary["should_send_usdt"] = trunc2(summary["should_send_usdt"] - item.usdt)
+    elif kind == "link":
+        # 记下这条记录对应的机器人回复消息
+        entry = ensure_record_index(state)["by_id"].get(op["id"])
+        if entry is not None:
+            item = entry[1]
+            item.msg = op["msg"]
+            state["_index"]["by_msg"][item.msg] = item.id
+    elif kind == "undo":
+        # 按记录编号撤销：直接定位记录，反向更新汇总和聚合
+        index = ensure_record_index(state)
+        entry = index["by_id"].get(op["id"])
+        if entry is not None:
+            direction, item = entry
+            rkind = record_kind(direction, item)
+            if rkind == "in":
+                summary["should_send_usdt"] = trunc2(summary["should_send_usdt"] - item.usdt)
+            elif rkind == "out":
+                summary["sent_usdt"] = trunc2(summary["sent_usdt"] - item.usdt)
+            else:
+                summary["should_send_usdt"] = trunc2(summary["should_send_usdt"] + item.usdt)
+            state["recent"][direction].remove(item)
+            agg_add(agg, rkind, item, -1)
+            unindex_record(index, item)
+    elif kind == "undo_in":
+        raw, usdt = op["raw"], op["usdt"]
+        summary["should_send_usdt"] = trunc2(summary["should_send_usdt"] - usdt)
+        remove_records(state, "in", lambda r: r.raw == raw and r.usdt == usdt)
+    elif kind == "undo_send":
+        usdt = op["usdt"]
+        summary["should_send_usdt"] = trunc2(summary["should_send_usdt"] + usdt)
+        remove_records(state, "out", lambda r: r.usdt == usdt)
+    elif kind == "set":
+        # 设置费率/汇率（scope 为 "默认" 或国家名）
+        if op["scope"] == "默认":
+            state["defaults"][op["direction"]][op["key"]] = op["value"]
+        else:
+            state["countries"].setdefault(op["scope"], {}).setdefault(op["direction"], {})[op["key"]] = op["value"]
+    elif kind == "reset_defaults":
+        state["defaults"] = {
+            "in":  {"rate": 0.10, "fx": 153},
+            "out": {"rate": -0.02, "fx": 137},
+        }
+    elif kind == "day":
+        # 日期切换：reset 为 True 时清空当天账单
+        if op.get("reset"):
+            state["recent"]["in"] = []
+            state["recent"]["out"] = []
+            state["_agg"] = new_aggregates()
+            state.pop("_index", None)
+            summary["should_send_usdt"] = 0.0
+            summary["sent_usdt"] = 0.0
+        state["last_date"] = op["date"]
+    
+    # 账本版本号：每次修改递增，汇总文本缓存以此判断是否过期（关联回复消息不改变显示内容，不递增）
+    if kind != "link":
+        state["_version"] = state.get("_version", 0) + 1
+
+# ========== 存储后端 ==========
+# 所有持久化都经过 storage 对象，通过环境变量 STORAGE_BACKEND 选择 json（默认）或 sqlite
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_PATH = Path(os.getenv("SQLITE_PATH", str(DATA_DIR / "bot.db")))
+
+class StorageBackend(ABC):
+    """存储后端接口（子类必须实现全部抽象方法，缺少时实例化即报错）"""
+    name = "base"
+    compacts = False  # 是否需要定期写完整快照来压缩操作日志
+    
+    @abstractmethod
+    def load_group(self, chat_id: int) -> dict | None:
+        """读取群组状态，不存在时返回 None"""
+    
+    @abstractmethod
+    def write_group(self, chat_id: int, snapshot: str | None, ops: list) -> int:
+        """写入群组：snapshot 为完整状态的 JSON 文本（可为 None），ops 为之后的新操作；返回实际写入的字节数"""
+    
+    @abstractmethod
+    def load_admins(self) -> list | None:
+        """读取管理员列表，从未保存过时返回 None"""
+    
+    @abstractmethod
+    def load_group_admins(self) -> dict:
+        """读取各群组的本群管理员 {chat_id: [user_id, ...]}"""
+    
+    @abstractmethod
+    def save_admins(self, admin_list: list, group_admins: dict | None = None):
+        """保存管理员列表（group_admins 为 None 时本群管理员保持不变）"""
+    
+    @abstractmethod
+    def load_recipients(self) -> dict | None:
+        """读取私聊用户登记表 {user_id: 信息}，从未保存过时返回 None"""
+    
+    @abstractmethod
+    def archive_day(self, chat_id: int, date: str, data: dict):
+        """保存群组某一天结束时的账单（日切前调用），同时更新按日期/国家的索引和当天合计"""
+    
+    @abstractmethod
+    def query_days(self, chat_id: int, start: str, end: str, country: str | None = None) -> list:
+        """查询日期范围内（含首尾）每天的合计 [(日期, 合计), ...]；指定国家时只返回该国家有记录的日期"""
+    
+    @abstractmethod
+    def save_recipients(self, changed: dict):
+        """保存私聊用户登记表中有变化的用户（changed 为这些用户信息的副本）"""
+    
+    def forget_group(self, chat_id: int):
+        """群组被淘汰出缓存后调用：丢掉该群组在后端里的内存缓存（默认没有）"""
+        pass
+    
+    def close(self):
+        pass
+
+class JsonStorage(StorageBackend):
+    """每个群组一个 JSON 快照 + 追加式操作日志"""
+    name = "json"
+    compacts = True
+    
+    def __init__(self):
+        self.recipients = None            # 已保存的登记表（压缩时写快照用），第一次读写时加载
+        self.recipient_journal_lines = 0
+        self.day_indexes = {}  # {chat_id: 索引}（同一群组的读写由 I/O 队列保证顺序；随群组淘汰出缓存一起丢掉）
+    
+    def replay_journal(self, chat_id: int, state: dict) -> int:
+        """把快照之后的操作日志回放到状态上，返回回放条数"""
+        path = group_journal_path(chat_id)
+        if not path.exists():
+            return 0
+        
+        snapshot_seq = state.get("journal_seq", 0)
+        count = 0
+        with path.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    # 最后一行可能因为进程中断只写了一半，直接忽略
+                    continue
+                if op.get("seq", 0) <= snapshot_seq:
+                    continue  # 已经包含在快照里
+                apply_ledger_op(state, op)
+                state["journal_seq"] = op["seq"]
+                count += 1
+        return count
+    
+    def load_group(self, chat_id: int) -> dict | None:
+        state = None
+        file_path = group_file_path(chat_id)
+        if file_path.exists():
+            try:
+                with file_path.open("r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except Exception as e:
+                print(f"⚠️ 加载群组状态文件失败: {e}")
+        
+        if state is None:
+            if not group_journal_path(chat_id).exists():
+                return None
+            state = get_default_state()
+        compact_records(state)
+        
+        # 回放快照之后的操作日志
         try:
-            with file_path.open("r", encoding="utf-8") as f:
-                state = json.load(f)
+            journal_counts[chat_id] = self.replay_journal(chat_id, state)
+        except Exception as e:
+            journal_counts[chat_id] = 0
+            print(f"⚠️ 回放群组操作日志失败: {e}")
+        return state
+    
+    def write_group(self, chat_id: int, snapshot: str | None, ops: list) -> int:
+        journal_path = group_journal_path(chat_id)
+        if snapshot is not None:
+            try:
+                # 原子写入：先写临时文件再 rename，中途崩溃不会留下半个文件
+                file_path = group_file_path(chat_id)
+                tmp_path = file_path.with_suffix(".json.tmp")
+                data = snapshot.encode("utf-8")
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, file_path)
+                # 快照已包含全部操作，截断日志（快照里的 journal_seq 保证中途崩溃也不会重复回放）
+                if journal_path.exists():
+                    journal_path.write_text("", encoding="utf-8")
+                return len(data)
+            except Exception as e:
+                print(f"❌ 保存群组状态文件失败 (群组 {chat_id}): {e}")
+        # 只有新操作，或快照写入失败时退回到追加日志
+        if not ops:
+            return 0
+        data = "".join(json.dumps(op, ensure_ascii=False, separators=(",", ":")) + "\n" for op in ops).encode("utf-8")
+        with journal_path.open("ab") as f:
+            f.write(data)
+        return len(data)
+    
+    def load_admins(self) -> list | None:
+        if not ADMINS_FILE.exists():
+            return None
+        try:
+            with ADMINS_FILE.open("r", encoding="utf-8") as f:
+                return json.load(f).get("admins", [])
+        except Exception as e:
+            print(f"⚠️ 加载管理员文件失败: {e}")
+            return None
+    
+    def load_group_admins(self) -> dict:
+        if not ADMINS_FILE.exists():
+            return {}
+        try:
+            with ADMINS_FILE.open("r", encoding="utf-8") as f:
+                return {int(k): v for k, v in json.load(f).get("groups", {}).items()}
+        except Exception as e:
+            print(f"⚠️ 加载管理员文件失败: {e}")
+            return {}
+    
+    def save_admins(self, admin_list: list, group_admins: dict | None = None):
+        if group_admins is None:
+            group_admins = self.load_group_admins()
+        data = {"admins": admin_list}
+        if group_admins:
+            data["groups"] = {str(k): v for k, v in group_admins.items()}
+        with ADMINS_FILE.open("w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    
+    # 私聊用户登记表：recipients.json 快照 + recipients.journal 追加日志（每行一个有变化的用户），
+    # 平时只追加变化的用户，日志累计 RECIPIENT_COMPACT_EVERY 行后才重写一次快照
+    RECIPIENT_COMPACT_EVERY = 1000
+    
+    def load_recipients(self) -> dict | None:
+        registry = None
+        if RECIPIENTS_FILE.exists():
+            try:
+                with RECIPIENTS_FILE.open("r", encoding="utf-8") as f:
+                    registry = {int(k): v for k, v in json.load(f).items()}
+            except Exception as e:
+                print(f"⚠️ 加载私聊用户登记表失败: {e}")
+        lines = 0
+        if RECIPIENTS_JOURNAL.exists():
+            with RECIPIENTS_JOURNAL.open("r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # 最后一行可能只写了一半
+                    if registry is None:
+                        registry = {}
+                    registry[int(entry["id"])] = entry["info"]
+                    lines += 1
+        if registry is None:
+            return None
+        self.recipients, self.recipient_journal_lines = registry, lines
+        return {k: dict(v) for k, v in registry.items()}
+    
+    def save_recipients(self, changed: dict):
+        if not changed:
+            return
+        if self.recipients is None:
+            self.load_recipients()
+            if self.recipients is None:
+                self.recipients = {}
+        with RECIPIENTS_JOURNAL.open("a", encoding="utf-8") as f:
+            f.write("".join(json.dumps({"id": k, "info": v}, ensure_ascii=False, separators=(",", ":")) + "\n"
+                            for k, v in changed.items()))
+        self.recipients.update(changed)
+        self.recipient_journal_lines += len(changed)
+        if self.recipient_journal_lines < self.RECIPIENT_COMPACT_EVERY:
+            return
+        # 压缩：写完整快照后清空追加日志
+        tmp_path = RECIPIENTS_FILE.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps({str(k): v for k, v in self.recipients.items()}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, RECIPIENTS_FILE)
+        RECIPIENTS_JOURNAL.write_text("", encoding="utf-8")
+        self.recipient_journal_lines = 0
+    
+    # 每个群组一个归档文件（每天一行）+ 一个索引文件：
+    # {"days": {日期: {"offset", "length", "totals"}}, "countries": {国家: [日期, ...]}}
+    # 范围查询只读索引里预先算好的每日合计，不需要打开归档文件
+    
+    @staticmethod
+    def archive_path(chat_id: int) -> Path:
+        return ARCHIVE_DIR / f"group_{chat_id}.jsonl"
+    
+    @staticmethod
+    def archive_index_path(chat_id: int) -> Path:
+        return ARCHIVE_DIR / f"group_{chat_id}.index.json"
+    
+    @staticmethod
+    def index_day(index: dict, date: str, offset: int, length: int, data: dict):
+        index["days"][date] = {"offset": offset, "length": length, "totals": day_totals(data)}
+        for country in data.get("countries", {}):
+            dates = index["countries"].setdefault(country, [])
+            if date not in dates:
+                dates.insert(bisect_left(dates, date), date)
+    
+    def load_day_index(self, chat_id: int) -> dict:
+        index = self.day_indexes.get(chat_id)
+        if index is not None:
+            return index
+        index_path = self.archive_index_path(chat_id)
+        if index_path.exists():
+            try:
+                index = json.loads(index_path.read_text(encoding="utf-8"))
+            except Exception as e:
+                print(f"⚠️ 读取归档索引失败，重新生成: {e}")
+        if index is None:
+            # 没有索引（或已损坏）：扫描一遍归档文件重建
+            index = {"days": {}, "countries": {}}
+            path = self.archive_path(chat_id)
+            if path.exists():
+                offset = 0
+                with path.open("rb") as f:
+                    for raw in f:
+                        try:
+                            data = json.loads(raw)
+                            self.index_day(index, data["date"], offset, len(raw), data)
+                        except (ValueError, KeyError):
+                            pass
+                        offset += len(raw)
+        self.day_indexes[chat_id] = index
+        return index
+    
+    def archive_day(self, chat_id: int, date: str, data: dict):
+        index = self.load_day_index(chat_id)
+        line = (json.dumps({"date": date, **data}, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with self.archive_path(chat_id).open("ab") as f:
+            offset = f.tell()
+            f.write(line)
+        self.index_day(index, date, offset, len(line), data)
+        index_path = self.archive_index_path(chat_id)
+        tmp_path = index_path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp_path, index_path)
+    
+    def forget_group(self, chat_id: int):
+        self.day_indexes.pop(chat_id, None)
+    
+    def query_days(self, chat_id: int, start: str, end: str, country: str | None = None) -> list:
+        index = self.load_day_index(chat_id)
+        if country is None:
+            dates = sorted(index["days"])
+        else:
+            dates = index["countries"].get(country, [])
+        dates = dates[bisect_left(dates, start):bisect_right(dates, end)]
+        return [(date, index["days"][date]["totals"]) for date in dates]
+
+class SqliteStorage(StorageBackend):
+    """嵌入式 SQLite（WAL 模式）：群组、账单记录、国家费率、管理员分表存储，每条操作只改动相关的行"""
+    name = "sqlite"
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS groups (
+            chat_id          INTEGER PRIMARY KEY,
+            bot_name         TEXT,
+            precision        TEXT,
+            in_rate          REAL DEFAULT 0,
+            in_fx            REAL DEFAULT 0,
+            out_rate         REAL DEFAULT 0,
+            out_fx           REAL DEFAULT 0,
+            should_send_usdt REAL DEFAULT 0,
+            sent_usdt        REAL DEFAULT 0,
+            last_date        TEXT DEFAULT '',
+            journal_seq      INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS records (
+            id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            kind    TEXT NOT NULL,
+            ts      TEXT,
+            raw     REAL,
+            usdt    REAL,
+            country TEXT,
+            fx      REAL,
+            rate    REAL,
+            type    TEXT,
+            line    TEXT,
+            rid     INTEGER,
+            msg     INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_records_chat ON records(chat_id, kind, id);
+        CREATE TABLE IF NOT EXISTS country_rates (
+            chat_id   INTEGER NOT NULL,
+            country   TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            rate      REAL,
+            fx        REAL,
+            PRIMARY KEY (chat_id, country, direction)
+        );
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS day_archive (
+            chat_id INTEGER NOT NULL,
+            date    TEXT NOT NULL,
+            data    TEXT NOT NULL,
+            PRIMARY KEY (chat_id, date)
+        );
+        CREATE TABLE IF NOT EXISTS day_totals (
+            chat_id INTEGER NOT NULL,
+            date    TEXT NOT NULL,
+            totals  TEXT NOT NULL,
+            PRIMARY KEY (chat_id, date)
+        );
+        CREATE TABLE IF NOT EXISTS day_countries (
+            chat_id INTEGER NOT NULL,
+            country TEXT NOT NULL,
+            date    TEXT NOT NULL,
+            PRIMARY KEY (chat_id, country, date)
+        );
+        CREATE TABLE IF NOT EXISTS group_admins (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS recipients (
+            user_id INTEGER PRIMARY KEY,
+            info    TEXT NOT NULL
+        );
+        -- 日志存档：只由 migrate_to_sqlite.py 导入一份历史日志备查，机器人运行时仍读写 data/logs 下的文件，不读这张表
+        CREATE TABLE IF NOT EXISTS logs (
+            id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope   TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            country TEXT,
+            date    TEXT,
+            line    TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_logs_chat_date ON logs(scope, chat_id, date);
+    """
+    
+    # 默认费率/汇率对应的列名（白名单，避免拼接任意字符串）
+    DEFAULT_COLUMNS = {
+        ("in", "rate"): "in_rate", ("in", "fx"): "in_fx",
+        ("out", "rate"): "out_rate", ("out", "fx"): "out_fx",
+    }
+    
+    # WAL 超过这个大小时在写入后做一次截断式 checkpoint（自动 checkpoint 已关闭，见下）
+    WAL_CHECKPOINT_BYTES = 4 * 1024 * 1024
+    
+    def __init__(self, path: Path):
+        import sqlite3
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.wal_path = path.with_name(path.name + "-wal")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.create_function("trunc2", 1, lambda x: trunc2(x), deterministic=True)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # 由 write_group 自己 checkpoint 并截断 WAL：WAL 只追加不回绕，写入前后的长度差就是这次写入的字节数
+        self.conn.execute("PRAGMA wal_autocheckpoint=0")
+        self.conn.executescript(self.SCHEMA)
+        # 旧数据库补充新增的列：line（记录的显示文本）、rid（记录编号）、msg（回复消息 ID）
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(records)")}
+        for column, ctype in (("line", "TEXT"), ("rid", "INTEGER"), ("msg", "INTEGER")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE records ADD COLUMN {column} {ctype}")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_records_rid ON records(chat_id, rid)")
+        # 旧数据库没有 admins_saved 标记：有管理员说明保存过
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) SELECT 'admins_saved', '1' WHERE EXISTS (SELECT 1 FROM admins)")
+        self.conn.commit()
+    
+    @staticmethod
+    def record_from_row(row) -> LedgerRecord:
+        return LedgerRecord(row["ts"], row["raw"], row["usdt"], row["country"],
+                            row["fx"], row["rate"], row["type"], row["line"], row["rid"], row["msg"])
+    
+    def load_group(self, chat_id: int) -> dict | None:
+        with self.lock:
+            g = self.conn.execute("SELECT * FROM groups WHERE chat_id = ?", (chat_id,)).fetchone()
+            if g is None:
+                return None
+            state = get_default_state()
+            state["bot_name"] = g["bot_name"] or state["bot_name"]
+            if g["precision"]:
+                state["precision"] = json.loads(g["precision"])
+            state["defaults"] = {
+                "in":  {"rate": g["in_rate"], "fx": g["in_fx"]},
+                "out": {"rate": g["out_rate"], "fx": g["out_fx"]},
+            }
+            state["summary"] = {"should_send_usdt": g["should_send_usdt"], "sent_usdt": g["sent_usdt"]}
+            state["last_date"] = g["last_date"] or ""
+            state["journal_seq"] = g["journal_seq"] or 0
+            
+            for row in self.conn.execute(
+                "SELECT country, direction, rate, fx FROM country_rates WHERE chat_id = ?", (chat_id,)
+            ):
+                d = state["countries"].setdefault(row["country"], {}).setdefault(row["direction"], {})
+                if row["rate"] is not None:
+                    d["rate"] = row["rate"]
+                if row["fx"] is not None:
+                    d["fx"] = row["fx"]
             
-            groups_state[chat_id] = state
+            # 最新的记录排在最前面（与 JSON 格式一致）
+            for row in self.conn.execute(
+                "SELECT * FROM records WHERE chat_id = ? ORDER BY id DESC", (chat_id,)
+            ):
+                state["recent"][row["kind"]].append(self.record_from_row(row))
             return state
-        except Exception as e:
-            print(f"⚠️ 加载群组状态文件失败: {e}")
     
-    # 创建新群组状态
-    state = get_default_state()
-    groups_state[chat_id] = state
-    save_group_state(chat_id)
+    def insert_record(self, chat_id: int, kind: str, item: dict):
+        self.conn.execute(
+            "INSERT INTO records (chat_id, kind, ts, raw, usdt, country, fx, rate, type, line, rid, msg) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, kind, item.get("ts"), item.get("raw"), item.get("usdt"), item.get("country"),
+             item.get("fx"), item.get("rate"), item.get("type"), item.get("line"), item.get("id"), item.get("msg")),
+        )
+    
+    def replace_group(self, chat_id: int, state: dict):
+        """用完整状态覆盖群组的所有行"""
+        d = state["defaults"]
+        self.conn.execute(
+            """INSERT OR REPLACE INTO groups
+               (chat_id, bot_name, precision, in_rate, in_fx, out_rate, out_fx, should_send_usdt, sent_usdt, last_date, journal_seq)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (chat_id, state.get("bot_name"), json.dumps(state.get("precision"), ensure_ascii=False),
+             d["in"]["rate"], d["in"]["fx"], d["out"]["rate"], d["out"]["fx"],
+             state["summary"]["should_send_usdt"], state["summary"]["sent_usdt"],
+             state.get("last_date", ""), state.get("journal_seq", 0)),
+        )
+        self.conn.execute("DELETE FROM country_rates WHERE chat_id = ?", (chat_id,))
+        for country, dirs in state.get("countries", {}).items():
+            for direction, vals in dirs.items():
+                self.conn.execute(
+                    "INSERT INTO country_rates (chat_id, country, direction, rate, fx) VALUES (?, ?, ?, ?, ?)",
+                    (chat_id, country, direction, vals.get("rate"), vals.get("fx")),
+                )
+        self.conn.execute("DELETE FROM records WHERE chat_id = ?", (chat_id,))
+        for kind in ("in", "out"):
+            # 列表里最新的在前，倒序插入保证自增 id 与时间顺序一致
+            for item in reversed(state["recent"][kind]):
+                self.insert_record(chat_id, kind, item)
+    
+    def apply_op(self, chat_id: int, op: dict):
+        """把一条账本操作翻译成行级更新"""
+        kind = op["op"]
+        ex = self.conn.execute
+        if kind == "in":
+            self.insert_record(chat_id, "in", op["item"])
+            ex("UPDATE groups SET should_send_usdt = trunc2(should_send_usdt + ?) WHERE chat_id = ?", (op["item"]["usdt"], chat_id))
+        elif kind == "out":
+            self.insert_record(chat_id, "out", op["item"])
+            ex("UPDATE groups SET sent_usdt = trunc2(sent_usdt + ?) WHERE chat_id = ?", (op["item"]["usdt"], chat_id))
+        elif kind == "send":
+            self.insert_record(chat_id, "out", op["item"])
+            ex("UPDATE groups SET should_send_usdt = trunc2(should_send_usdt - ?) WHERE chat_id = ?", (op["item"]["usdt"], chat_id))
+        elif kind == "link":
+            ex("UPDATE records SET msg = ? WHERE chat_id = ? AND rid = ?", (op["msg"], chat_id, op["id"]))
+        elif kind == "undo":
+            column, sign = {"in": ("should_send_usdt", "-"), "out": ("sent_usdt", "-"), "send": ("should_send_usdt", "+")}[op["kind"]]
+            ex(f"UPDATE groups SET {column} = trunc2({column} {sign} ?) WHERE chat_id = ?", (op["usdt"], chat_id))
+            ex("DELETE FROM records WHERE chat_id = ? AND rid = ?", (chat_id, op["id"]))
+        elif kind == "undo_in":
+            ex("UPDATE groups SET should_send_usdt = trunc2(should_send_usdt - ?) WHERE chat_id = ?", (op["usdt"], chat_id))
+            ex("DELETE FROM records WHERE chat_id = ? AND kind = 'in' AND raw = ? AND usdt = ?", (chat_id, op["raw"], op["usdt"]))
+        elif kind == "undo_send":
+            ex("UPDATE groups SET should_send_usdt = trunc2(should_send_usdt + ?) WHERE chat_id = ?", (op["usdt"], chat_id))
+            ex("DELETE FROM records WHERE chat_id = ? AND kind = 'out' AND usdt = ?", (chat_id, op["usdt"]))
+        elif kind == "set":
+            if op["scope"] == "默认":
+                column = self.DEFAULT_COLUMNS[(op["direction"], op["key"])]
+                ex(f"UPDATE groups SET {column} = ? WHERE chat_id = ?", (op["value"], chat_id))
+            else:
+                column = "rate" if op["key"] == "rate" else "fx"
+                ex(f"""INSERT INTO country_rates (chat_id, country, direction, {column}) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (chat_id, country, direction) DO UPDATE SET {column} = excluded.{column}""",
+                   (chat_id, op["scope"], op["direction"], op["value"]))
+        elif kind == "reset_defaults":
+            ex("UPDATE groups SET in_rate = 0.10, in_fx = 153, out_rate = -0.02, out_fx = 137 WHERE chat_id = ?", (chat_id,))
+        elif kind == "day":
+            if op.get("reset"):
+                ex("DELETE FROM records WHERE chat_id = ?", (chat_id,))
+                ex("UPDATE groups SET should_send_usdt = 0, sent_usdt = 0 WHERE chat_id = ?", (chat_id,))
+            ex("UPDATE groups SET last_date = ? WHERE chat_id = ?", (op["date"], chat_id))
+        ex("UPDATE groups SET journal_seq = ? WHERE chat_id = ?", (op["seq"], chat_id))
+    
+    def wal_size(self) -> int:
+        try:
+            return self.wal_path.stat().st_size
+        except OSError:
+            return 0
+    
+    def checkpoint_if_needed(self, size: int):
+        """（持有 self.lock 时调用）WAL 过大时写回数据库文件并截断"""
+        if size >= self.WAL_CHECKPOINT_BYTES:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    
+    def write_group(self, chat_id: int, snapshot: str | None, ops: list) -> int:
+        with self.lock:
+            before = self.wal_size()
+            with self.conn:
+                if snapshot is not None:
+                    # 快照已包含全部操作
+                    self.replace_group(chat_id, json.loads(snapshot))
+                else:
+                    for op in ops:
+                        self.apply_op(chat_id, op)
+            after = self.wal_size()
+            self.checkpoint_if_needed(after)
+        return max(0, after - before)
+    
+    def load_admins(self) -> list | None:
+        with self.lock:
+            rows = self.conn.execute("SELECT user_id FROM admins ORDER BY rowid").fetchall()
+            saved = self.conn.execute("SELECT 1 FROM meta WHERE key = 'admins_saved'").fetchone()
+        # 管理员全部删除后是空列表；只有从未保存过（新数据库）才返回 None，与 json 后端一致
+        if not rows and saved is None:
+            return None
+        return [row["user_id"] for row in rows]
+    
+    def load_group_admins(self) -> dict:
+        with self.lock:
+            rows = self.conn.execute("SELECT chat_id, user_id FROM group_admins ORDER BY rowid").fetchall()
+        result = {}
+        for row in rows:
+            result.setdefault(row["chat_id"], []).append(row["user_id"])
+        return result
+    
+    def save_admins(self, admin_list: list, group_admins: dict | None = None):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM admins")
+            self.conn.executemany("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", [(a,) for a in admin_list])
+            self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('admins_saved', '1')")
+            if group_admins is not None:
+                self.conn.execute("DELETE FROM group_admins")
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO group_admins (chat_id, user_id) VALUES (?, ?)",
+                    [(chat_id, a) for chat_id, ids in group_admins.items() for a in ids],
+                )
+    
+    def archive_day(self, chat_id: int, date: str, data: dict):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO day_archive (chat_id, date, data) VALUES (?, ?, ?)",
+                (chat_id, date, json.dumps(data, ensure_ascii=False, separators=(",", ":"))),
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO day_totals (chat_id, date, totals) VALUES (?, ?, ?)",
+                (chat_id, date, json.dumps(day_totals(data), ensure_ascii=False, separators=(",", ":"))),
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO day_countries (chat_id, country, date) VALUES (?, ?, ?)",
+                [(chat_id, country, date) for country in data.get("countries", {})],
+            )
+    
+    def query_days(self, chat_id: int, start: str, end: str, country: str | None = None) -> list:
+        with self.lock:
+            if country is None:
+                rows = self.conn.execute(
+                    "SELECT date, totals FROM day_totals WHERE chat_id = ? AND date BETWEEN ? AND ? ORDER BY date",
+                    (chat_id, start, end),
+                ).fetchall()
+            else:
+                rows = self.conn.execute(
+                    """SELECT t.date, t.totals FROM day_countries c
+                       JOIN day_totals t ON t.chat_id = c.chat_id AND t.date = c.date
+                       WHERE c.chat_id = ? AND c.country = ? AND c.date BETWEEN ? AND ? ORDER BY c.date""",
+                    (chat_id, country, start, end),
+                ).fetchall()
+        return [(row["date"], json.loads(row["totals"])) for row in rows]
+    
+    def load_recipients(self) -> dict | None:
+        with self.lock:
+            rows = self.conn.execute("SELECT user_id, info FROM recipients").fetchall()
+        return {row["user_id"]: json.loads(row["info"]) for row in rows} if rows else None
+    
+    def save_recipients(self, changed: dict):
+        # 只写有变化的行
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO recipients (user_id, info) VALUES (?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False)) for k, v in changed.items()],
+            )
+    
+    def import_log_lines(self, scope: str, chat_id: int, country: str | None, date: str | None, lines: list):
+        """导入一个 (范围, ID, 国家, 日期) 下的全部日志行（重复导入会先删除该键下的旧数据，同一个键要一次导入）"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM logs WHERE scope = ? AND chat_id = ? AND country IS ? AND date IS ?",
+                (scope, chat_id, country, date),
+            )
+            self.conn.executemany(
+                "INSERT INTO logs (scope, chat_id, country, date, line) VALUES (?, ?, ?, ?, ?)",
+                [(scope, chat_id, country, date, line) for line in lines],
+            )
+        with self.lock:
+            self.checkpoint_if_needed(self.wal_size())
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def create_storage(backend: str = STORAGE_BACKEND) -> StorageBackend:
+    """根据配置创建存储后端"""
+    if backend == "sqlite":
+        return SqliteStorage(SQLITE_PATH)
+    return JsonStorage()
+
+storage = create_storage()
+
+# ========== 存储 I/O 线程池 ==========
+# 所有读写存储的操作都放进有界线程池执行，不阻塞事件循环。
+# 同一个 key（群组 chat_id，或 "admins"）的操作按提交顺序串行执行：
+# 每个任务先等上一个任务结束再开始，所以同一群组的写入永远不会乱序。
+STORAGE_IO_THREADS = int(os.getenv("STORAGE_IO_THREADS", "4"))
+
+io_executor = ThreadPoolExecutor(max_workers=max(1, STORAGE_IO_THREADS), thread_name_prefix="storage-io")
+io_tails = {}                   # {key: 该 key 最后提交的任务}
+io_tails_lock = threading.Lock()
+
+def submit_io(key, fn, *args):
+    """把存储操作提交到线程池（同一 key 保持顺序），返回 concurrent.futures.Future"""
+    def run(prev):
+        if prev is not None:
+            # 线程池按先进先出取任务，prev 一定已经在执行或已完成，不会死锁
+            try:
+                prev.result()
+            except Exception:
+                pass
+        return fn(*args)
+    
+    with io_tails_lock:
+        prev = io_tails.get(key)
+        future = io_executor.submit(run, prev)
+        io_tails[key] = future
+    
+    def done(f):
+        with io_tails_lock:
+            if io_tails.get(key) is f:
+                del io_tails[key]
+    future.add_done_callback(done)
+    return future
+
+async def run_io(key, fn, *args):
+    """在线程池中执行存储操作并等待结果"""
+    return await asyncio.wrap_future(submit_io(key, fn, *args))
+
+def wait_io(key=None):
+    """同步等待某个 key（None 表示全部）之前提交的存储操作完成"""
+    with io_tails_lock:
+        futures = list(io_tails.values()) if key is None else [io_tails[key]] if key in io_tails else []
+    for f in futures:
+        try:
+            f.result()
+        except Exception:
+            pass
+
+def install_group_state(chat_id: int, state: dict | None) -> dict:
+    """把从存储读到的状态放进缓存（不存在时新建默认状态）"""
+    if state is None:
+        # 创建新群组状态
+        state = get_default_state()
+        groups_state.put(chat_id, state)
+        save_group_state(chat_id)
+        return state
+    groups_state.put(chat_id, state)
     return state
 
+def load_group_state(chat_id: int) -> dict:
+    """加载群组状态（缓存 → 存储后端 → 新建默认状态）"""
+    # 先检查缓存（同一条消息里会多次调用，不计入命中统计，也不调整 LRU 顺序）
+    state = groups_state.peek(chat_id)
+    if state is not None:
+        return state
+    
+    # 先等该群组还没写完的数据（例如刚被淘汰时的写回）落盘，再读取
+    wait_io(chat_id)
+    return install_group_state(chat_id, read_group(chat_id))
+
+# ========== 群组串行锁 ==========
+# 不同群组的消息并发处理，同一群组的账本操作按到达顺序逐条执行。
+# 锁只在有消息正在处理或排队时存在，最后一个使用者离开就删除，空闲群组不占内存；
+# 持有锁期间该群组的状态被钉在缓存里，不会在处理中途被淘汰。
+chat_locks = {}  # {chat_id: [asyncio.Lock, 使用者数量]}
+
+@contextlib.asynccontextmanager
+async def chat_lock(chat_id: int):
+    entry = chat_locks.get(chat_id)
+    if entry is None:
+        entry = chat_locks[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    groups_state.pinned.add(chat_id)
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del chat_locks[chat_id]
+            groups_state.pinned.discard(chat_id)
+
+async def aload_group_state(chat_id: int) -> dict:
+    """异步加载群组状态：缓存未命中时在线程池中读取存储（排在该群组未完成的写入之后）"""
+    state = groups_state.get(chat_id)
+    if state is not None:
+        return state
+    
+    loaded = await run_io(chat_id, read_group, chat_id)
+    # 等待期间其他请求可能已经加载过（并且修改过），以缓存中的为准（同一次查找，不再计入命中/未命中）
+    state = groups_state.peek(chat_id)
+    if state is not None:
+        return state
+    return install_group_state(chat_id, loaded)
+
 def save_group_state(chat_id: int):
-    """保存群组状态到JSON文件"""
+    """标记群组需要写入完整快照（真正的写盘由后台刷新任务完成）"""
     if chat_id not in groups_state:
         return
+    mark_dirty(chat_id)
+
+def commit_op(chat_id: int, op: dict) -> dict:
+    """执行一条账本操作：更新内存状态，并把操作放进待写缓冲（写入成本与账单大小无关），返回该操作"""
+    state = load_group_state(chat_id)
+    apply_ledger_op(state, op)
+    groups_state.resize(chat_id)
+    
+    seq = state.get("journal_seq", 0) + 1
+    state["journal_seq"] = seq
+    with flush_lock:
+        pending_ops.setdefault(chat_id, []).append({"seq": seq, **op})
     
-    file_path = group_file_path(chat_id)
+    # 定期压缩：日志过长或日期切换时写一次完整快照（SQLite 按行更新，不需要压缩）
+    journal_counts[chat_id] = journal_counts.get(chat_id, 0) + 1
+    if storage.compacts and (journal_counts[chat_id] >= JOURNAL_COMPACT_EVERY or op["op"] == "day"):
+        mark_dirty(chat_id)
+    else:
+        request_flush()
+    return op
+
+def link_reply(chat_id: int, op: dict, reply):
+    """把记账操作产生的记录和机器人的回复消息关联起来（回复这条消息"撤销"即可精确撤销）"""
+    if reply is None or "id" not in op.get("item", {}):
+        return
+    link = {"op": "link", "id": op["item"]["id"], "msg": reply.message_id}
+    with flush_lock:
+        # 记账操作通常还在待写缓冲里（和缓冲共用同一个 item）：直接把消息 ID 写进这条操作，不再多写一条
+        pending = any(p.get("item") is op["item"] for p in pending_ops.get(chat_id, ()))
+        if pending:
+            op["item"]["msg"] = reply.message_id
+    if pending:
+        apply_ledger_op(load_group_state(chat_id), link)
+    else:
+        commit_op(chat_id, link)
+
+# ========== 后台写入（write-behind）==========
+# 修改只在内存里标记，后台任务按防抖间隔合并写盘，避免阻塞事件循环
+FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))
+
+dirty_groups = set()      # 需要写完整快照的群组
+pending_ops = {}          # 待写入的操作 {chat_id: [op, ...]}
+flush_lock = threading.Lock()   # 保护上面两个缓冲区
+flusher_task = None
+flush_event = None
+
+def mark_dirty(chat_id: int):
+    """标记群组快照已过期"""
+    with flush_lock:
+        dirty_groups.add(chat_id)
+    request_flush()
+
+def request_flush():
+    """通知后台任务有数据待写；后台任务未运行时（脚本/工具调用）直接同步写盘"""
+    if flusher_task is None:
+        flush_all_groups()
+    elif flush_event is not None:
+        flush_event.set()
+
+def collect_flush_batch(chat_ids=None) -> list:
+    """取出待写数据：[(chat_id, 快照文本或None, 操作列表), ...]（在事件循环线程调用）"""
+    batch = []
+    with flush_lock:
+        targets = set(dirty_groups) | set(pending_ops) if chat_ids is None else set(chat_ids)
+        for chat_id in targets:
+            ops = pending_ops.pop(chat_id, [])
+            snapshot = None
+            if chat_id in dirty_groups:
+                dirty_groups.discard(chat_id)
+                state = groups_state.peek(chat_id)
+                if state is not None:
+                    snapshot = state_to_json(state)
+                    journal_counts[chat_id] = 0
+            if snapshot is not None or ops:
+                batch.append((chat_id, snapshot, ops))
+    return batch
+
+def read_group(chat_id: int) -> dict | None:
+    """从存储读取一个群组（记录耗时）"""
+    with STATE_LOAD_SECONDS.time():
+        return storage.load_group(chat_id)
+
+def write_group(chat_id: int, snapshot: str | None, ops: list):
+    """写入一个群组（在 I/O 线程池中运行）"""
     try:
-        with file_path.open("w", encoding="utf-8") as f:
-            json.dump(groups_state[chat_id], f, ensure_ascii=False, indent=2)
+        with STATE_SAVE_SECONDS.time():
+            written = storage.write_group(chat_id, snapshot, ops)
+        STATE_BYTES_WRITTEN.inc("snapshot" if snapshot is not None else "journal", amount=written)
     except Exception as e:
-        print(f"❌ 保存群组状态文件失败: {e}")
+        print(f"❌ 保存群组状态失败 (群组 {chat_id}): {e}")
 
-# 管理员缓存（从JSON文件加载）
-admins_cache = None
+def submit_flush_batch(batch: list) -> list:
+    """把每个群组的写入提交到线程池（不同群组并行，同一群组按顺序）"""
+    return [submit_io(chat_id, write_group, chat_id, snapshot, ops) for chat_id, snapshot, ops in batch]
 
-def load_admins():
-    """从JSON文件加载管理员列表"""
-    global admins_cache
-    if admins_cache is not None:
-        return admins_cache
-    
-    if ADMINS_FILE.exists():
+def write_back_group(chat_id: int):
+    """群组被淘汰出缓存时提交未保存的修改（重新加载会排在这次写入之后，能读到最新数据）"""
+    submit_flush_batch(collect_flush_batch([chat_id]))
+    journal_counts.pop(chat_id, None)
+    # 归档索引等后端缓存跟着群组一起释放（排在该群组的写入之后）
+    submit_io(chat_id, storage.forget_group, chat_id)
+
+groups_state.on_evict = write_back_group
+
+def flush_all_groups():
+    """写出所有待写数据并等待完成（关闭时强制刷新）"""
+    submit_flush_batch(collect_flush_batch())
+    submit_recipient_batch()
+    wait_io()
+
+async def state_flusher():
+    """后台刷新任务：有修改时等待一个防抖间隔，把这段时间内的修改合并成一次写盘"""
+    while True:
+        await flush_event.wait()
+        await asyncio.sleep(FLUSH_INTERVAL)
+        flush_event.clear()
+        futures = submit_flush_batch(collect_flush_batch()) + submit_recipient_batch()
+        if futures:
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+
+async def start_state_flusher(application=None):
+    """启动后台刷新任务（Application.post_init 回调）"""
+    global flusher_task, flush_event
+    flush_event = asyncio.Event()
+    flusher_task = asyncio.create_task(state_flusher())
+    flush_event.set()  # 启动前积累的修改也一并写出
+    # 管理员列表、私聊用户登记表在启动时预先读入，之后只读内存
+    await run_io("admins", admin_registry.load)
+    await run_io("recipients", load_recipients)
+
+async def stop_state_flusher(application=None):
+    """停止后台刷新任务并强制写出剩余数据（Application.post_shutdown 回调）"""
+    global flusher_task
+    if flusher_task is not None:
+        flusher_task.cancel()
         try:
-            with ADMINS_FILE.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-                admins_cache = data.get("admins", [])
-                return admins_cache
-        except Exception as e:
-            print(f"⚠️ 加载管理员文件失败: {e}")
+            await flusher_task
+        except asyncio.CancelledError:
+            pass
+        flusher_task = None
+    flush_all_groups()
+    wait_io()
+    storage.close()
+    log_writer.close()
+    st = groups_state.stats()
+    print(f"💾 群组状态已全部写入磁盘（缓存命中 {st['hits']} / 未命中 {st['misses']} / 淘汰 {st['evictions']}）")
+
+# ========== 管理员登记 ==========
+# 管理员名单保存为不可变的 frozenset 快照：读取（每条记账命令都要检查权限）不加锁、O(1)；
+# 修改时整体替换快照，并通知订阅者（写盘、打印日志），不再重新读取文件。
+# 管理员分两种：机器人管理员（所有群组有效）和本群管理员（只在某个群组有效）。
+class AdminRegistry:
+    """管理员登记表"""
+    
+    def __init__(self):
+        self.global_ids = frozenset()
+        self.global_order = ()       # 按添加顺序（用于显示）
+        self.group_ids = {}          # {chat_id: frozenset}
+        self.group_order = {}        # {chat_id: tuple}
+        self.loaded = False
+        self.listeners = []
+        self.lock = threading.Lock()  # 只保护修改，读取直接用快照
+    
+    def subscribe(self, listener):
+        """订阅变更通知：listener(action, user_id, chat_id)，action 为 "add" / "remove"，chat_id 为 None 表示机器人管理员"""
+        self.listeners.append(listener)
     
-    # 初始化管理员（如果有OWNER_ID）
-    admins_cache = []
-    if OWNER_ID and OWNER_ID.isdigit():
-        admins_cache.append(int(OWNER_ID))
-    save_admins(admins_cache)
-    return admins_cache
-
-def save_admins(admin_list):
-    """保存管理员列表到JSON文件"""
-    global admins_cache
-    admins_cache = admin_list
+    def load(self):
+        """从存储后端加载（只在第一次调用时读取）"""
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            admin_list = storage.load_admins()
+            first_run = admin_list is None
+            if first_run:
+                # 初始化管理员（如果有OWNER_ID）
+                admin_list = [OWNER_USER_ID] if OWNER_USER_ID is not None else []
+            self.global_order = tuple(admin_list)
+            self.global_ids = frozenset(admin_list)
+            groups = storage.load_group_admins()
+            self.group_order = {chat_id: tuple(ids) for chat_id, ids in groups.items()}
+            self.group_ids = {chat_id: frozenset(ids) for chat_id, ids in groups.items()}
+            self.loaded = True
+        if first_run:
+            persist_admins()
+    
+    def is_admin(self, user_id: int, chat_id: int | None = None) -> bool:
+        if user_id == OWNER_USER_ID:
+            return True
+        if not self.loaded:
+            self.load()
+        if user_id in self.global_ids:
+            return True
+        return chat_id is not None and user_id in self.group_ids.get(chat_id, ())
+    
+    def admins(self, chat_id: int | None = None) -> tuple:
+        """机器人管理员（chat_id 为 None）或某个群组的本群管理员，按添加顺序"""
+        self.load()
+        if chat_id is None:
+            return self.global_order
+        return self.group_order.get(chat_id, ())
+    
+    def change(self, action: str, user_id: int, chat_id: int | None = None) -> bool:
+        self.load()
+        with self.lock:
+            order = self.global_order if chat_id is None else self.group_order.get(chat_id, ())
+            if (user_id in order) == (action == "add"):
+                return False
+            order = order + (user_id,) if action == "add" else tuple(a for a in order if a != user_id)
+            if chat_id is None:
+                self.global_order, self.global_ids = order, frozenset(order)
+            elif order:
+                self.group_order[chat_id], self.group_ids[chat_id] = order, frozenset(order)
+            else:
+                self.group_order.pop(chat_id, None)
+                self.group_ids.pop(chat_id, None)
+        for listener in self.listeners:
+            try:
+                listener(action, user_id, chat_id)
+            except Exception as e:
+                print(f"⚠️ 管理员变更通知失败: {e}")
+        return True
+
+admin_registry = AdminRegistry()
+
+def load_admins():
+    """从存储后端加载管理员登记表"""
+    admin_registry.load()
+    return list(admin_registry.admins())
+
+def persist_admins(*_):
+    """把当前管理员快照写入存储（变更通知的订阅者）"""
+    submit_io("admins", write_admins, list(admin_registry.global_order),
+              {chat_id: list(ids) for chat_id, ids in admin_registry.group_order.items()})
+
+def write_admins(admin_list: list, group_admins: dict):
+    """写入管理员列表（在 I/O 线程池中运行）"""
     try:
-        with ADMINS_FILE.open("w", encoding="utf-8") as f:
-            json.dump({"admins": admin_list}, f, ensure_ascii=False, indent=2)
+        storage.save_admins(admin_list, group_admins)
     except Exception as e:
         print(f"❌ 保存管理员文件失败: {e}")
 
-def add_admin(user_id: int) -> bool:
-    """添加管理员"""
-    admins = load_admins()
-    if user_id not in admins:
-        admins.append(user_id)
-        save_admins(admins)
-        return True
-    return False
+def log_admin_change(action: str, user_id: int, chat_id: int | None):
+    scope = "机器人管理员" if chat_id is None else f"群组 {chat_id} 的本群管理员"
+    print(f"👥 {'添加' if action == 'add' else '移除'}{scope}: {user_id}")
 
-def remove_admin(user_id: int) -> bool:
+admin_registry.subscribe(persist_admins)
+admin_registry.subscribe(log_admin_change)
+
+def add_admin(user_id: int, chat_id: int | None = None) -> bool:
+    """添加管理员（chat_id 不为 None 时只在该群组有效）"""
+    return admin_registry.change("add", user_id, chat_id)
+
+def remove_admin(user_id: int, chat_id: int | None = None) -> bool:
     """移除管理员"""
-    admins = load_admins()
-    if user_id in admins:
-        admins.remove(user_id)
-        save_admins(admins)
-        return True
-    return False
+    return admin_registry.change("remove", user_id, chat_id)
+
+# ========== 私聊用户登记 ==========
+# 所有私聊过机器人的用户：最后活跃时间、状态（active / blocked / failed）、连续失败次数、是否退订。
+# 私聊时增量更新，修改和群组状态一样由后台任务合并写盘；广播直接从这里取收件人。
+RECIPIENT_MAX_FAILS = 3  # 连续发送失败这么多次后广播跳过该用户
+
+recipients = None            # {user_id: 信息}
+dirty_recipients = set()
+
+def load_recipients() -> dict:
+    """读取私聊用户登记表（第一次运行时从私聊日志文件名导入）"""
+    global recipients
+    if recipients is not None:
+        return recipients
+    loaded = storage.load_recipients()
+    if loaded is None:
+        loaded = {}
+        private_log_dir = LOG_DIR / "private_chats"
+        if private_log_dir.exists():
+            for log_file in private_log_dir.glob("user_*.log"):
+                try:
+                    user_id = int(log_file.stem.split("_")[1])
+                except (ValueError, IndexError):
+                    continue
+                seen = datetime.datetime.fromtimestamp(log_file.stat().st_mtime).isoformat(timespec="seconds")
+                loaded[user_id] = new_recipient(seen)
+        if loaded:
+            print(f"📇 已从私聊日志导入 {len(loaded)} 个用户")
+            dirty_recipients.update(loaded)
+    recipients = loaded
+    return recipients
+
+def new_recipient(seen: str) -> dict:
+    return {"name": "", "username": "", "first_seen": seen, "last_seen": seen,
+            "status": "active", "fails": 0, "opt_out": False}
+
+def update_recipient(user_id: int, **changes):
+    """修改一个用户的登记信息并安排写盘"""
+    registry = load_recipients()
+    info = registry.get(user_id)
+    if info is None:
+        seen = changes.get("last_seen") or datetime.datetime.now().isoformat(timespec="seconds")
+        info = registry[user_id] = new_recipient(seen)
+    info.update(changes)
+    with flush_lock:
+        dirty_recipients.add(user_id)
+    request_flush()
+
+def touch_recipient(user):
+    """用户私聊了机器人：更新最后活跃时间，之前拉黑/失败的状态也恢复正常"""
+    update_recipient(user.id, name=user.full_name, username=user.username or "",
+                     last_seen=datetime.datetime.now().isoformat(timespec="seconds"),
+                     status="active", fails=0)
+
+def record_delivery(user_id: int, error: str | None = None, blocked: bool = False):
+    """记录一次广播发送结果"""
+    info = load_recipients().get(user_id)
+    if error is None:
+        if info is not None and (info["status"] != "active" or info["fails"]):
+            update_recipient(user_id, status="active", fails=0)
+    elif blocked:
+        update_recipient(user_id, status="blocked", reason=error)
+    else:
+        fails = (info["fails"] if info else 0) + 1
+        update_recipient(user_id, status="failed", fails=fails, reason=error)
+
+def broadcastable(info: dict) -> bool:
+    if info.get("opt_out") or info["status"] == "blocked":
+        return False
+    return info["fails"] < RECIPIENT_MAX_FAILS
+
+def collect_recipient_batch():
+    """取出有变化的登记信息（只复制变化的用户）；没有变化时返回 None"""
+    with flush_lock:
+        if not dirty_recipients or recipients is None:
+            return None
+        changed = {k: dict(recipients[k]) for k in dirty_recipients if k in recipients}
+        dirty_recipients.clear()
+    return changed or None
+
+def write_recipients(changed: dict):
+    """写入私聊用户登记表（在 I/O 线程池中运行）"""
+    try:
+        storage.save_recipients(changed)
+    except Exception as e:
+        print(f"❌ 保存私聊用户登记表失败: {e}")
+
+def submit_recipient_batch() -> list:
+    batch = collect_recipient_batch()
+    return [] if batch is None else [submit_io("recipients", write_recipients, batch)]
 
 
 # ========== 工具函数 ==========
@@ -142,46 +1616,154 @@ def trunc2(x: float) -> float:
 def fmt_usdt(x: float) -> str:
     return f"{x:.2f} USDT"
 
+SUPERSCRIPT_TABLE = str.maketrans("0123456789-", "⁰¹²³⁴⁵⁶⁷⁸⁹⁻")
+
 def to_superscript(num: int) -> str:
     """将数字转换为上标，用于显示费率"""
-    superscript_map = {
-        '0': '⁰', '1': '¹', '2': '²', '3': '³', '4': '⁴',
-        '5': '⁵', '6': '⁶', '7': '⁷', '8': '⁸', '9': '⁹',
-        '-': '⁻'
-    }
-    return ''.join(superscript_map.get(c, c) for c in str(num))
+    return str(num).translate(SUPERSCRIPT_TABLE)
+
+def format_record_line(item: LedgerRecord, defaults: dict | None = None) -> str:
+    """生成账单里一条记录的显示文本（defaults 用于旧记录缺少汇率/费率时的回退）"""
+    if item.type == "下发":
+        return f"{item.ts} {trunc2(abs(item.usdt))}"  # 使用绝对值，避免负数
+    defaults = defaults or {}
+    fx = item.fx if item.fx is not None else defaults.get("fx")
+    rate = item.rate if item.rate is not None else defaults.get("rate", 0)
+    rate_sup = to_superscript(int(rate * 100))  # 费率百分比转换为上标
+    return f"{item.ts} {item.raw if item.raw is not None else 0}  {rate_sup}/ {fx} = {trunc2(item.usdt)}"
+
+def new_ledger_item(ts: str, raw: float, usdt: float, country: str | None, params: dict) -> dict:
+    """创建入金/出金记录（操作日志中的字典格式），并在创建时算好显示文本"""
+    item = LedgerRecord(ts, raw, usdt, country, params["fx"], params["rate"])
+    item.line = format_record_line(item)
+    return item.to_dict()
+
+def new_send_item(ts: str, usdt: float) -> dict:
+    """创建下发记录（操作日志中的字典格式），并在创建时算好显示文本"""
+    item = LedgerRecord(ts, usdt=usdt, type="下发")
+    item.line = format_record_line(item)
+    return item.to_dict()
+
+# 使用北京时间（UTC+8）
+BEIJING_TZ = datetime.timezone(datetime.timedelta(hours=8))
+BEIJING_OFFSET = 8 * 3600
 
 def now_ts():
-    # 使用北京时间（UTC+8）
-    beijing_tz = datetime.timezone(datetime.timedelta(hours=8))
-    return datetime.datetime.now(beijing_tz).strftime("%H:%M")
+    return datetime.datetime.now(BEIJING_TZ).strftime("%H:%M")
+
+def day_number() -> int:
+    """北京时间的天数编号（只做一次除法，用于快速判断是否跨天）"""
+    return int((time.time() + BEIJING_OFFSET) // 86400)
+
+_today = [None, ""]  # [天数编号, 日期字符串]
 
 def today_str():
-    # 使用北京时间（UTC+8）
-    beijing_tz = datetime.timezone(datetime.timedelta(hours=8))
-    return datetime.datetime.now(beijing_tz).strftime("%Y-%m-%d")
+    day = day_number()
+    if _today[0] != day:
+        _today[1] = datetime.datetime.now(BEIJING_TZ).strftime("%Y-%m-%d")
+        _today[0] = day
+    return _today[1]
+
+def day_totals(data: dict) -> dict:
+    """从每日归档中取出当天的合计（汇总 + 按类型/国家的笔数和金额）"""
+    return {key: data[key] for key in ("summary", "count", "raw", "usdt", "countries") if key in data}
+
+def day_archive_data(state: dict) -> dict:
+    """群组当天账单的紧凑格式：汇总 + 聚合 + 记录，不含显示文本"""
+    def compact(item: LedgerRecord) -> dict:
+        d = item.to_dict()
+        for key in ("line", "id", "msg"):
+            d.pop(key, None)
+        return d
+    
+    agg = ensure_aggregates(state)
+    return {
+        "summary": dict(state["summary"]),
+        "count": dict(agg["count"]),
+        "raw": dict(agg["raw"]),
+        "usdt": dict(agg["usdt"]),
+        "countries": json.loads(json.dumps(agg["countries"])),
+        "in": [compact(r) for r in state["recent"]["in"]],
+        "out": [compact(r) for r in state["recent"]["out"]],
+    }
+
+def archive_group_day(chat_id: int, state: dict):
+    """日切前把这一天的最终账单写入每日归档"""
+    # 和该群组的其他写入走同一条顺序队列，保证归档先于日切后的快照
+    submit_io(chat_id, write_day_archive, chat_id, state["last_date"], day_archive_data(state))
+
+def write_day_archive(chat_id: int, date: str, data: dict):
+    """写入每日归档（在 I/O 线程池中运行）"""
+    try:
+        storage.archive_day(chat_id, date, data)
+    except Exception as e:
+        print(f"❌ 保存每日归档失败 (群组 {chat_id} {date}): {e}")
 
 def check_and_reset_daily(chat_id: int):
-    """检查日期，如果日期变了（过了0点），清空账单"""
+    """检查日期，如果日期变了（过了0点），归档并清空账单"""
     state = load_group_state(chat_id)
+    day = day_number()
+    if state.get("_day") == day:
+        return False  # 今天已经检查过（每条消息只比较一次整数）
+    
     current_date = today_str()
     last_date = state.get("last_date", "")
-    
+    reset = False
     if last_date and last_date != current_date:
-        # 日期变了，清空账单
-        state["recent"]["in"] = []
-        state["recent"]["out"] = []
-        state["summary"]["should_send_usdt"] = 0.0
-        state["summary"]["sent_usdt"] = 0.0
-        state["last_date"] = current_date
-        save_group_state(chat_id)
-        return True  # 返回True表示已重置
+        # 日期变了，先归档前一天，再清空账单
+        archive_group_day(chat_id, state)
+        commit_op(chat_id, {"op": "day", "date": current_date, "reset": True})
+        reset = True
     elif not last_date:
         # 首次运行，设置日期
-        state["last_date"] = current_date
-        save_group_state(chat_id)
+        commit_op(chat_id, {"op": "day", "date": current_date})
     
-    return False  # 返回False表示未重置
+    state["_day"] = day
+    return reset  # 返回True表示已重置
+
+# ========== 零点日切任务 ==========
+# 每天北京时间 0 点一次性处理所有已加载的群组；没有加载的群组在下次收到消息时再处理
+rollover_task = None
+
+def seconds_until_midnight() -> float:
+    now = time.time() + BEIJING_OFFSET
+    return 86400 - now % 86400
+
+async def rollover_all_groups() -> int:
+    """对所有已加载的群组执行日切，返回重置的群组数"""
+    count = 0
+    for chat_id in list(groups_state.entries):
+        async with chat_lock(chat_id):
+            if chat_id in groups_state and check_and_reset_daily(chat_id):
+                count += 1
+    return count
+
+async def midnight_rollover():
+    await run_log_compaction()  # 启动时先压缩停机期间留下的旧日志
+    while True:
+        await asyncio.sleep(seconds_until_midnight() + 1)
+        try:
+            count = await rollover_all_groups()
+            print(f"🌙 {today_str()} 日切完成：已归档并重置 {count} 个群组")
+        except Exception as e:
+            print(f"❌ 日切失败: {e}")
+        # 等零点附近的最后几条日志写完再压缩昨天的日志
+        await asyncio.sleep(LOG_COMPACT_GRACE)
+        await run_log_compaction()
+
+def start_rollover():
+    global rollover_task
+    rollover_task = asyncio.create_task(midnight_rollover())
+
+async def stop_rollover():
+    global rollover_task
+    if rollover_task is not None:
+        rollover_task.cancel()
+        try:
+            await rollover_task
+        except asyncio.CancelledError:
+            pass
+        rollover_task = None
 
 def log_path(chat_id: int, country: str|None, date_str: str) -> Path:
     folder = f"group_{chat_id}"
@@ -189,19 +1771,323 @@ def log_path(chat_id: int, country: str|None, date_str: str) -> Path:
         folder = f"{folder}/{country}"
     else:
         folder = f"{folder}/通用"
-    p = LOG_DIR / folder
-    p.mkdir(parents=True, exist_ok=True)
-    return p / f"{date_str}.log"
+    return LOG_DIR / folder / f"{date_str}.log"
+
+def private_log_path(user_id: int) -> Path:
+    return LOG_DIR / "private_chats" / f"user_{user_id}.log"
+
+# ========== 日志写入 ==========
+# 日志行先放进队列，由后台线程批量写入；打开的文件句柄放在 LRU 池里复用，
+# 目录只在第一次用到时创建，过了零点关闭所有句柄（新日期的日志自然写进新文件）；
+# 私聊日志不按日期分文件，超过 PRIVATE_LOG_MAX_BYTES 时改名为 user_<id>.<日期>.log 另起新文件
+LOG_POOL_SIZE = int(os.getenv("LOG_POOL_SIZE", "64"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "0.2"))
+LOG_BATCH_MAX = 1000
+PRIVATE_LOG_MAX_BYTES = int(os.getenv("PRIVATE_LOG_MAX_BYTES", str(1024 * 1024)))
+
+class LogWriter:
+    """异步日志写入器（后台线程 + 文件句柄池）"""
+    
+    def __init__(self, max_open: int = LOG_POOL_SIZE, interval: float = LOG_FLUSH_INTERVAL):
+        self.max_open = max(1, max_open)
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.handles = OrderedDict()  # {path: file}，最近使用的在最后
+        self.known_dirs = set()
+        self.day = None
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def write(self, path: Path, text: str):
+        """把一行日志放进队列（不阻塞调用方）"""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+                self.thread.start()
+        self.queue.put((path, text.strip() + "\n"))
+    
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            # 等一小段时间，把这期间到达的日志合并成一批写入
+            deadline = time.monotonic() + self.interval
+            while batch[-1] is not None and len(batch) < LOG_BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            try:
+                self.write_batch([entry for entry in batch if entry is not None])
+            except Exception as e:
+                print(f"❌ 写入日志失败: {e}")
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                self.close_handles()
+                return
+    
+    def write_batch(self, batch: list):
+        day = today_str()
+        if day != self.day:
+            # 零点轮换：旧日期的文件不会再写入
+            self.close_handles()
+            self.day = day
+        
+        grouped = {}
+        release = False
+        for path, line in batch:
+            if path is None:
+                release = True  # release() 发来的标记
+                continue
+            grouped.setdefault(path, []).append(line)
+        for path, lines in grouped.items():
+            try:
+                f = self.handle(path)
+                f.write("".join(lines))
+                f.flush()
+                if path.parent.name == "private_chats" and f.tell() >= PRIVATE_LOG_MAX_BYTES:
+                    self.roll(path)
+            except OSError as e:
+                print(f"❌ 写入日志失败 ({path}): {e}")
+                self.handles.pop(path, None)
+        if release:
+            self.close_handles()
+    
+    def roll(self, path: Path):
+        """私聊日志按大小轮换：当前文件改名为 user_<id>.<日期>[.<n>].log，之后的日志写进新文件"""
+        self.handles.pop(path).close()
+        target = path.with_name(f"{path.stem}.{self.day}.log")
+        n = 1
+        while target.exists() or target.with_name(target.name + ".gz").exists():
+            n += 1
+            target = path.with_name(f"{path.stem}.{self.day}.{n}.log")
+        path.rename(target)
+    
+    def handle(self, path: Path):
+        f = self.handles.get(path)
+        if f is not None:
+            self.handles.move_to_end(path)
+            return f
+        if path.parent not in self.known_dirs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.known_dirs.add(path.parent)
+        f = path.open("a", encoding="utf-8")
+        self.handles[path] = f
+        while len(self.handles) > self.max_open:
+            self.handles.popitem(last=False)[1].close()
+        return f
+    
+    def close_handles(self):
+        while self.handles:
+            self.handles.popitem()[1].close()
+    
+    def release(self):
+        """写完队列里的日志并关闭所有文件句柄（压缩旧日志前调用）"""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put((None, None))
+            self.queue.join()
+    
+    def flush(self):
+        """等待队列里的日志全部写入"""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+    
+    def close(self):
+        """写完剩余日志并停止后台线程"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None and thread.is_alive():
+            self.queue.put(None)
+            thread.join()
+
+log_writer = LogWriter()
 
 def append_log(path: Path, text: str):
-    with path.open("a", encoding="utf-8") as f:
-        f.write(text.strip() + "\n")
+    log_writer.write(path, text)
 
-def push_recent(chat_id: int, kind: str, item: dict):
-    state = load_group_state(chat_id)
-    arr = state["recent"][kind]
-    arr.insert(0, item)
-    save_group_state(chat_id)
+# ========== 日志压缩 ==========
+# 已经结束的日志（前几天的群组日志、按大小轮换出来的私聊日志）压缩成 <原文件名>.gz：
+# 每 LOG_COMPACT_BLOCK 字节左右的整行单独压成一个 gzip 成员，整个文件仍是合法的 gzip（zcat 可直接查看），
+# 旁边的 <原文件名>.idx 记录每块的偏移、长度、行数和块内最早/最晚时间（"YYYY-MM-DD HH:MM"），按时间读取时只解压需要的块。
+# 私聊日志按大小轮换，一个文件跨好几天而行里只有 HH:MM，无法知道日期，所以不记录时间、读取时不按时间过滤
+LOG_COMPACT_BLOCK = int(os.getenv("LOG_COMPACT_BLOCK", str(64 * 1024)))
+LOG_COMPACT_GRACE = 300  # 最近这么多秒内还有写入的文件先不压缩
+LOG_TIME_PATTERN = re.compile(r"(?:^\[|时间:|\"ts\":\"(\d{4}-\d{2}-\d{2})T)(\d{1,2}:\d{2})")
+
+def log_archive_path(path: Path) -> Path:
+    return path.with_name(path.name + ".gz")
+
+def log_index_path(archive: Path) -> Path:
+    return archive.with_suffix(".idx")
+
+def log_line_stamp(line: bytes, date: str) -> str | None:
+    """一行日志的时间 "YYYY-MM-DD HH:MM"：JSONL 事件带日期，文本日志用文件所属的日期"""
+    m = LOG_TIME_PATTERN.search(line.decode("utf-8", "replace"))
+    if m is None:
+        return None
+    return f"{m.group(1) or date} {m.group(2).zfill(5)}"
+
+def load_log_index(archive: Path) -> dict | None:
+    try:
+        return json.loads(log_index_path(archive).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+def compact_log(path: Path, date: str) -> tuple[int, int]:
+    """把一个日志文件压缩成分块 gzip + 偏移索引，返回 (压缩前字节数, 压缩后字节数)；已有压缩文件时追加新块"""
+    data = path.read_bytes()
+    archive = log_archive_path(path)
+    index = load_log_index(archive) if archive.exists() else None
+    if index is None:
+        index = {"date": date, "blocks": []}
+        archive.unlink(missing_ok=True)
+    
+    lines = data.splitlines(keepends=True)
+    multi_day = path.parent.name == "private_chats"
+    written = 0
+    with archive.open("ab") as f:
+        offset = f.tell()
+        start = 0
+        while start < len(lines):
+            end, size = start, 0
+            while end < len(lines) and (size == 0 or size + len(lines[end]) <= LOG_COMPACT_BLOCK):
+                size += len(lines[end])
+                end += 1
+            block = lines[start:end]
+            compressed = gzip.compress(b"".join(block), mtime=0)
+            f.write(compressed)
+            # 取块内最早/最晚而不是首尾行：零点后补记的行时间会比前面的小
+            stamps = [] if multi_day else [t for t in (log_line_stamp(line, date) for line in block) if t]
+            index["blocks"].append({"offset": offset, "length": len(compressed), "lines": len(block),
+                                    "first": min(stamps, default=None), "last": max(stamps, default=None)})
+            offset += len(compressed)
+            written += len(compressed)
+            start = end
+        f.flush()
+        os.fsync(f.fileno())
+    
+    index_path = log_index_path(archive)
+    tmp_path = index_path.with_suffix(".idx.tmp")
+    tmp_path.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp_path, index_path)
+    path.unlink()
+    return len(data), written
+
+def read_log_blocks(archive: Path, start: str | None = None, end: str | None = None):
+    """按索引只解压时间范围 [start, end]（"YYYY-MM-DD HH:MM"）内的块，逐行返回；索引丢失时解压整个文件。
+    没有时间（私聊日志）或只有 HH:MM（旧索引）的块总是返回"""
+    index = load_log_index(archive)
+    if index is None:
+        with gzip.open(archive, "rt", encoding="utf-8") as f:
+            yield from f
+        return
+    with archive.open("rb") as f:
+        for block in index["blocks"]:
+            first, last = block["first"], block["last"]
+            if first and last and len(first) > 5:
+                if (start and last < start) or (end and first > end):
+                    continue
+            f.seek(block["offset"])
+            yield from gzip.decompress(f.read(block["length"])).decode("utf-8").splitlines(keepends=True)
+
+def read_log_lines(path: Path) -> list:
+    """读取一个日志文件的全部行（.log 或压缩后的 .log.gz）"""
+    if path.suffix == ".gz":
+        return [line.rstrip("\n") for line in read_log_blocks(path)]
+    return path.read_text(encoding="utf-8").splitlines()
+
+def compactable_logs(today: str):
+    """找出可以压缩的日志：今天以前的群组日志和事件日志 + 已轮换的私聊日志，返回 [(路径, 日期)]"""
+    found = []
+    for path in list(LOG_DIR.glob("group_*/*/*.log")) + list(LOG_DIR.glob("group_*/*.jsonl")):
+        if path.stem < today:
+            found.append((path, path.stem))
+    for path in (LOG_DIR / "private_chats").glob("user_*.*.log"):
+        found.append((path, path.stem.split(".")[1]))
+    return found
+
+def compact_logs() -> tuple[int, int, int]:
+    """压缩所有已结束的日志，返回 (文件数, 压缩前字节数, 压缩后字节数)"""
+    log_writer.release()
+    files = before = after = 0
+    cutoff = time.time() - LOG_COMPACT_GRACE
+    for path, date in compactable_logs(today_str()):
+        try:
+            if path.parent.name != "private_chats" and path.stat().st_mtime > cutoff:
+                continue  # 零点附近刚写过，下次再压缩
+            raw, packed = compact_log(path, date)
+        except OSError as e:
+            print(f"❌ 压缩日志失败 ({path}): {e}")
+            continue
+        files += 1
+        before += raw
+        after += packed
+    return files, before, after
+
+async def run_log_compaction():
+    try:
+        files, before, after = await asyncio.to_thread(compact_logs)
+    except Exception as e:
+        print(f"❌ 压缩日志失败: {e}")
+        return
+    if files:
+        print(f"🗜️ 已压缩 {files} 个日志文件：{before / 1024:.1f}KB → {after / 1024:.1f}KB")
+
+# ========== 账本事件日志 ==========
+# 每笔记账/撤销写一行紧凑的 JSONL（data/logs/group_<群ID>/<日期>.jsonl），字段固定且带类型，
+# 统计和恢复工具逐行 json.loads 即可，不用再用正则解析中文文本日志；
+# 原来的文本日志改为由同一个事件渲染，设置 LEDGER_TEXT_LOG=0 可以不再写
+LEDGER_TEXT_LOG = os.getenv("LEDGER_TEXT_LOG", "1") != "0"
+
+def event_log_path(chat_id: int, date_str: str) -> Path:
+    return LOG_DIR / f"group_{chat_id}" / f"{date_str}.jsonl"
+
+def ledger_date(chat_id: int) -> str:
+    """群组当前账本的日期（记录写进的是这一天的账单，事件日志也写进这一天的文件）"""
+    return load_group_state(chat_id).get("last_date") or today_str()
+
+def ledger_event(chat_id: int, user_id: int, kind: str, ts: str, date: str, record_id: int | None = None,
+                 amount: float | None = None, usdt: float = 0.0, country: str | None = None,
+                 params: dict | None = None) -> dict:
+    """账本事件：kind 为 in / out / send / undo_in / undo_out / undo_send，不适用的字段为 None；
+    ts（HH:MM）和 date 使用记录本身的时间和所在账本的日期，回放时得到完全相同的记录"""
+    return {
+        "ts": f"{date}T{ts}+08:00",
+        "chat": chat_id,
+        "id": record_id,
+        "kind": kind,
+        "amount": amount,
+        "rate": params["rate"] if params else None,
+        "fx": params["fx"] if params else None,
+        "usdt": usdt,
+        "country": country,
+        "user": user_id,
+    }
+
+def render_event_text(event: dict) -> str:
+    """把账本事件渲染成原来的文本日志行"""
+    kind, ts, usdt = event["kind"], event["ts"][11:16], event["usdt"]
+    if kind in ("in", "out"):
+        label, result = ("入金", "结果") if kind == "in" else ("出金", "下发")
+        return (f"[{label}] 时间:{ts} 国家:{event['country'] or '通用'} 原始:{event['amount']} "
+                f"汇率:{event['fx']} 费率:{event['rate']*100:.2f}% {result}:{usdt}")
+    if kind == "send":
+        if usdt > 0:
+            return f"[下发USDT] 时间:{ts} 金额:{usdt} USDT"
+        return f"[撤销下发] 时间:{ts} 金额:{trunc2(abs(usdt))} USDT"
+    if kind == "undo_send":
+        return f"[撤销下发] 时间:{ts} USDT:{usdt} 标记:无效操作"
+    label = "撤销入金" if kind == "undo_in" else "撤销出金"
+    return f"[{label}] 时间:{ts} 原金额:{event['amount']} USDT:{usdt} 标记:无效操作"
+
+def log_event(event: dict):
+    """写入事件日志（按事件所属账本的日期分文件），需要时同时写文本日志"""
+    date_str = event["ts"][:10]
+    log_writer.write(event_log_path(event["chat"], date_str), json.dumps(event, ensure_ascii=False, separators=(",", ":")))
+    if LEDGER_TEXT_LOG:
+        append_log(log_path(event["chat"], event["country"], date_str), render_event_text(event))
 
 def resolve_params(chat_id: int, direction: str, country: str|None) -> dict:
     state = load_group_state(chat_id)
@@ -222,78 +2108,121 @@ def resolve_params(chat_id: int, direction: str, country: str|None) -> dict:
     
     return d
 
+AMOUNT_PATTERN = re.compile(r"^[\+\-]\s*([0-9]+(?:\.[0-9]+)?)")
+COUNTRY_SUFFIX_PATTERN = re.compile(r"/\s*([^\s]+)$")
+
 def parse_amount_and_country(text: str):
-    m = re.match(r"^[\+\-]\s*([0-9]+(?:\.[0-9]+)?)", text.strip())
+    m = AMOUNT_PATTERN.match(text.strip())
     if not m: return None, None
     amount = float(m.group(1))
-    m2 = re.search(r"/\s*([^\s]+)$", text)
+    m2 = COUNTRY_SUFFIX_PATTERN.search(text)
     country = m2.group(1) if m2 else None
     return amount, country
 
 # ========== 管理员系统 ==========
-def is_admin(user_id: int) -> bool:
-    if OWNER_ID and OWNER_ID.isdigit() and int(OWNER_ID) == user_id:
-        return True
-    admin_list = load_admins()
-    return user_id in admin_list
+def is_admin(user_id: int, chat_id: int | None = None) -> bool:
+    """是否是管理员（OWNER、机器人管理员，或 chat_id 群组的本群管理员）"""
+    return admin_registry.is_admin(user_id, chat_id)
 
 
-def list_admins():
-    """获取管理员列表"""
-    return load_admins()
+def list_admins(chat_id: int | None = None):
+    """获取管理员列表（chat_id 不为 None 时为该群组的本群管理员）"""
+    return list(admin_registry.admins(chat_id))
 
 # ========== 群内汇总显示 ==========
+# Telegram 单条消息最多 4096 个字符
+TELEGRAM_MAX_MESSAGE = 4096
+# 完整账单每页显示的记录条数
+FULL_BILL_PAGE_SIZE = int(os.getenv("FULL_BILL_PAGE_SIZE", "40"))
+
+def cached_render(state: dict, key: str, build, *args):
+    """按账本版本号缓存汇总文本：账本没有变化时（+0、更多记录）直接返回上次的结果"""
+    version = state.get("_version", 0)
+    cache = state.setdefault("_render", {})
+    cached = cache.get(key)
+    if cached is not None and cached[0] == version:
+        render_cache_stats["hit"] += 1
+        return cached[1]
+    render_cache_stats["miss"] += 1
+    text = build(state, *args)
+    cache[key] = (version, text)
+    return text
+
+def split_message(text: str, limit: int = TELEGRAM_MAX_MESSAGE) -> list:
+    """按行把长文本拆成多段，每段不超过 Telegram 的消息长度限制"""
+    if len(text) <= limit:
+        return [text]
+    chunks, current, size = [], [], 0
+    for line in text.split("\n"):
+        # 单行超长时硬切
+        while len(line) > limit:
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if size + len(line) + 1 > limit and current:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
 def render_group_summary(chat_id: int) -> str:
+    return cached_render(load_group_state(chat_id), "summary", build_group_summary)
+
+def render_full_summary(chat_id: int, page: int = 1) -> tuple:
+    """显示当天记录的第 page 页，返回 (文本, 总页数)"""
     state = load_group_state(chat_id)
+    pages = full_bill_pages(state)
+    page = min(max(page, 1), pages)
+    return cached_render(state, f"full:{page}", build_full_summary, page, pages), pages
+
+def full_bill_pages(state: dict) -> int:
+    counts = ensure_aggregates(state)["count"]
+    total = counts["in"] + counts["out"] + counts["send"]
+    return max(1, math.ceil(total / FULL_BILL_PAGE_SIZE))
+
+def build_group_summary(state: dict) -> str:
     bot = state["bot_name"]
     rec_in, rec_out = state["recent"]["in"], state["recent"]["out"]
     should, sent = trunc2(state["summary"]["should_send_usdt"]), trunc2(state["summary"]["sent_usdt"])
     diff = trunc2(should - sent)
-    rin, fin = state["defaults"]["in"]["rate"], state["defaults"]["in"]["fx"]
-    rout, fout = state["defaults"]["out"]["rate"], state["defaults"]["out"]["fx"]
+    din, dout = state["defaults"]["in"], state["defaults"]["out"]
+    rin, fin = din["rate"], din["fx"]
+    rout, fout = dout["rate"], dout["fx"]
+
+    counts = ensure_aggregates(state)["count"]
 
     lines = []
     lines.append(f"📊【{bot} 账单汇总】\n")
     
-    # 分离出金记录中的"下发"和普通出金
-    normal_out = [r for r in rec_out if r.get('type') != '下发']
-    send_out = [r for r in rec_out if r.get('type') == '下发']
+    # 只取要显示的最近5笔出金/下发，不再把整个出金列表拆分一遍
+    normal_out = list(islice((r for r in rec_out if r.type != '下发'), 5)) if counts["out"] else []
+    send_out = list(islice((r for r in rec_out if r.type == '下发'), 5)) if counts["send"] else []
     
-    # 入金记录
-    lines.append(f"已入账 ({len(rec_in)}笔)")
-    if rec_in:
-        for r in rec_in[:5]:
-            raw = r.get('raw', 0)
-            fx = r.get('fx', fin)  # 如果没有保存汇率，使用默认汇率
-            rate = r.get('rate', rin)  # 获取费率
-            usdt = trunc2(r['usdt'])
-            rate_percent = int(rate * 100)  # 转换为百分比整数
-            rate_sup = to_superscript(rate_percent)  # 转换为上标
-            lines.append(f"{r['ts']} {raw}  {rate_sup}/ {fx} = {usdt}")
+    # 入金记录（每条记录的显示文本在创建时已经算好）
+    lines.append(f"已入账 ({counts['in']}笔)")
+    for r in rec_in[:5]:
+        lines.append(r.line or format_record_line(r, din))
     
     lines.append("")
     
     # 出金记录
-    lines.append(f"已出账 ({len(normal_out)}笔)")
-    if normal_out:
-        for r in normal_out[:5]:
-            if 'raw' in r:
-                raw = r.get('raw', 0)
-                fx = r.get('fx', fout)
-                rate = r.get('rate', rout)
-                usdt = trunc2(r['usdt'])
-                rate_percent = int(rate * 100)
-                rate_sup = to_superscript(rate_percent)
-                lines.append(f"{r['ts']} {raw}  {rate_sup}/ {fx} = {usdt}")
+    lines.append(f"已出账 ({counts['out']}笔)")
+    for r in normal_out:
+        if r.raw is not None:
+            lines.append(r.line or format_record_line(r, dout))
     
     lines.append("")
     
     # 下发记录（只有当有下发记录时才显示）
     if send_out:
-        lines.append(f"已下发 ({len(send_out)}笔)")
-        for r in send_out[:5]:
-            usdt = trunc2(abs(r['usdt']))  # 使用绝对值，避免负数
-            lines.append(f"{r['ts']} {usdt}")
+        lines.append(f"已下发 ({counts['send']}笔)")
+        for r in send_out:
+            lines.append(r.line or format_record_line(r))
         lines.append("")
     
     lines.append("━━━━━━━━━━━━━━")
@@ -306,58 +2235,56 @@ def render_group_summary(chat_id: int) -> str:
     lines.append("📚 **查看更多记录**：发送「更多记录」")
     return "\n".join(lines)
 
-def render_full_summary(chat_id: int) -> str:
-    """显示当天所有记录"""
-    state = load_group_state(chat_id)
+def build_full_summary(state: dict, page: int = 1, pages: int = 1) -> str:
     bot = state["bot_name"]
     rec_in, rec_out = state["recent"]["in"], state["recent"]["out"]
     should, sent = trunc2(state["summary"]["should_send_usdt"]), trunc2(state["summary"]["sent_usdt"])
     diff = trunc2(should - sent)
-    rin, fin = state["defaults"]["in"]["rate"], state["defaults"]["in"]["fx"]
-    rout, fout = state["defaults"]["out"]["rate"], state["defaults"]["out"]["fx"]
+    din, dout = state["defaults"]["in"], state["defaults"]["out"]
+    rin, fin = din["rate"], din["fx"]
+    rout, fout = dout["rate"], dout["fx"]
+
+    counts = ensure_aggregates(state)["count"]
+    n_in, n_out, n_send = counts["in"], counts["out"], counts["send"]
 
     lines = []
-    lines.append(f"📊【{bot} 完整账单】\n")
+    if pages > 1:
+        lines.append(f"📊【{bot} 完整账单】第 {page}/{pages} 页\n")
+    else:
+        lines.append(f"📊【{bot} 完整账单】\n")
     
-    # 分离出金记录中的"下发"和普通出金
-    normal_out = [r for r in rec_out if r.get('type') != '下发']
-    send_out = [r for r in rec_out if r.get('type') == '下发']
+    # 把 入金 → 出金 → 下发 看成一个连续序列，本页只取 [start, end) 这一段
+    start = (page - 1) * FULL_BILL_PAGE_SIZE
+    end = start + FULL_BILL_PAGE_SIZE
     
-    # 入金记录
-    lines.append(f"已入账 ({len(rec_in)}笔)")
-    if rec_in:
-        for r in rec_in:
-            raw = r.get('raw', 0)
-            fx = r.get('fx', fin)
-            rate = r.get('rate', rin)
-            usdt = trunc2(r['usdt'])
-            rate_percent = int(rate * 100)
-            rate_sup = to_superscript(rate_percent)
-            lines.append(f"{r['ts']} {raw}  {rate_sup}/ {fx} = {usdt}")
+    def section(offset: int, total: int):
+        """本页在该分组内的切片范围 (a, b)，不在本页时返回 None"""
+        a, b = max(start - offset, 0), min(end - offset, total)
+        return (a, b) if a < b else None
     
-    lines.append("")
+    # 入金记录
+    rng = section(0, n_in)
+    if rng or pages == 1:
+        lines.append(f"已入账 ({n_in}笔)")
+        if rng:
+            lines.extend(r.line or format_record_line(r, din) for r in rec_in[rng[0]:rng[1]])
+        lines.append("")
     
     # 出金记录
-    lines.append(f"已出账 ({len(normal_out)}笔)")
-    if normal_out:
-        for r in normal_out:
-            if 'raw' in r:
-                raw = r.get('raw', 0)
-                fx = r.get('fx', fout)
-                rate = r.get('rate', rout)
-                usdt = trunc2(r['usdt'])
-                rate_percent = int(rate * 100)
-                rate_sup = to_superscript(rate_percent)
-                lines.append(f"{r['ts']} {raw}  {rate_sup}/ {fx} = {usdt}")
-    
-    lines.append("")
+    rng = section(n_in, n_out)
+    if rng or pages == 1:
+        lines.append(f"已出账 ({n_out}笔)")
+        if rng:
+            normal_out = (r for r in rec_out if r.type != '下发')
+            lines.extend(r.line or format_record_line(r, dout) for r in islice(normal_out, rng[0], rng[1]) if r.raw is not None)
+        lines.append("")
     
     # 下发记录（只有当有下发记录时才显示）
-    if send_out:
-        lines.append(f"已下发 ({len(send_out)}笔)")
-        for r in send_out:
-            usdt = trunc2(abs(r['usdt']))
-            lines.append(f"{r['ts']} {usdt}")
+    rng = section(n_in + n_out, n_send)
+    if rng:
+        lines.append(f"已下发 ({n_send}笔)")
+        send_out = (r for r in rec_out if r.type == '下发')
+        lines.extend(r.line or format_record_line(r) for r in islice(send_out, rng[0], rng[1]))
         lines.append("")
     
     lines.append("━━━━━━━━━━━━━━")
@@ -367,22 +2294,207 @@ def render_full_summary(chat_id: int) -> str:
     lines.append(f"📤 已下发：{fmt_usdt(sent)}")
     lines.append(f"{'❗' if diff != 0 else '✅'} 未下发：{fmt_usdt(diff)}")
     lines.append("━━━━━━━━━━━━━━")
+    if page < pages:
+        lines.append(f"📚 下一页：发送「更多记录 {page + 1}」")
+    return "\n".join(lines)
+
+# ========== 历史账单查询 ==========
+def live_day_totals(state: dict) -> dict:
+    """当天（还没归档）的合计，格式与归档中的每日合计相同"""
+    agg = ensure_aggregates(state)
+    return {"summary": dict(state["summary"]), "count": agg["count"], "raw": agg["raw"],
+            "usdt": agg["usdt"], "countries": agg["countries"]}
+
+def add_today_totals(chat_id: int, days: list, start: str, end: str, country: str | None = None) -> list:
+    """范围包含今天时，把今天（还没归档，直接读内存中的聚合）加到查询结果后面"""
+    today = today_str()
+    if start <= today <= end and (not days or days[-1][0] != today):
+        state = load_group_state(chat_id)
+        if state.get("last_date") == today:
+            totals = live_day_totals(state)
+            if country is None or country in totals["countries"]:
+                days.append((today, totals))
+    return days
+
+def build_history_report(start: str, end: str, country: str | None, days: list) -> str:
+    """生成日期范围账单报告"""
+    title = f"📅【历史账单 {start} ~ {end}{' ' + country if country else ''}】\n"
+    if not days:
+        return title + "\n📭 该时间段没有记录"
+    
+    total = {"in": [0, 0.0, 0.0], "out": [0, 0.0, 0.0]}  # [笔数, 原始金额, USDT]
+    sent = [0, 0.0]
+    per_country = {}
+    daily = []
+    for date, t in days:
+        if country is None:
+            for kind in ("in", "out"):
+                total[kind][0] += t["count"].get(kind, 0)
+                total[kind][1] += t["raw"].get(kind, 0.0)
+                total[kind][2] += t["usdt"].get(kind, 0.0)
+            sent[0] += t["count"].get("send", 0)
+            sent[1] += t["usdt"].get("send", 0.0)
+            for c, dirs in t["countries"].items():
+                pc = per_country.setdefault(c, {"in": [0, 0.0, 0.0], "out": [0, 0.0, 0.0]})
+                for kind, v in dirs.items():
+                    pc[kind][0] += v["count"]
+                    pc[kind][1] += v["raw"]
+                    pc[kind][2] += v["usdt"]
+            daily.append((date, t["usdt"].get("in", 0.0), t["usdt"].get("out", 0.0), t["usdt"].get("send", 0.0)))
+        else:
+            dirs = t["countries"].get(country, {})
+            for kind in ("in", "out"):
+                v = dirs.get(kind)
+                if v:
+                    total[kind][0] += v["count"]
+                    total[kind][1] += v["raw"]
+                    total[kind][2] += v["usdt"]
+            daily.append((date, dirs.get("in", {}).get("usdt", 0.0), dirs.get("out", {}).get("usdt", 0.0), None))
+    
+    lines = [title]
+    lines.append(f"📆 有记录的天数：{len(days)} 天")
+    lines.append(f"📥 入金：{total['in'][0]} 笔　{trunc2(total['in'][1])} → {fmt_usdt(trunc2(total['in'][2]))}")
+    lines.append(f"📤 出金：{total['out'][0]} 笔　{trunc2(total['out'][1])} → {fmt_usdt(trunc2(total['out'][2]))}")
+    if country is None:
+        lines.append(f"💸 下发：{sent[0]} 笔　{fmt_usdt(trunc2(sent[1]))}")
+    
+    if per_country:
+        lines.append("\n🌍 按国家：")
+        for c, pc in sorted(per_country.items(), key=lambda kv: -kv[1]["in"][2]):
+            parts = []
+            if pc["in"][0]:
+                parts.append(f"入 {pc['in'][0]} 笔 {fmt_usdt(trunc2(pc['in'][2]))}")
+            if pc["out"][0]:
+                parts.append(f"出 {pc['out'][0]} 笔 {fmt_usdt(trunc2(pc['out'][2]))}")
+            lines.append(f"• {c}：{'，'.join(parts)}")
+    
+    lines.append("\n📋 每日明细（入金 / 出金" + (" / 下发）" if country is None else "）"))
+    for date, din, dout, dsend in daily:
+        row = f"{date}　{trunc2(din)} / {trunc2(dout)}"
+        if dsend is not None:
+            row += f" / {trunc2(dsend)}"
+        lines.append(row)
     return "\n".join(lines)
 
 # ========== Telegram ==========
-from telegram import Update
-from telegram.ext import ApplicationBuilder, MessageHandler, CommandHandler, filters, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ApplicationBuilder, MessageHandler, CommandHandler, CallbackQueryHandler, ChatMemberHandler, filters, ContextTypes
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
+from telegram.request import HTTPXRequest
 
-async def is_group_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
-    """检查用户是否是群组管理员或群主"""
-    chat = update.effective_chat
-    if chat.type == "private":
-        return False
+FULL_BILL_PATTERN = re.compile(r"^(?:更多记录|查看更多记录|更多账单|显示历史账单)\s*(\d+)?$")
+
+def bill_page_keyboard(page: int, pages: int):
+    """完整账单的翻页按钮（只有一页时不显示）"""
+    if pages <= 1:
+        return None
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton("◀️ 上一页", callback_data=f"bill:{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page}/{pages}", callback_data=f"bill:{page}"))
+    if page < pages:
+        buttons.append(InlineKeyboardButton("下一页 ▶️", callback_data=f"bill:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+async def send_full_bill(message, chat_id: int, page: int):
+    """发送完整账单的某一页，超长时拆成多条消息"""
+    text, pages = render_full_summary(chat_id, page)
+    page = min(max(page, 1), pages)
+    chunks = split_message(text)
+    for i, chunk in enumerate(chunks):
+        # 翻页按钮挂在最后一条消息上
+        markup = bill_page_keyboard(page, pages) if i == len(chunks) - 1 else None
+        await message.reply_text(chunk, reply_markup=markup)
+
+async def handle_bill_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理完整账单的翻页按钮"""
+    query = update.callback_query
     try:
-        member = await context.bot.get_chat_member(chat.id, user_id)
-        return member.status in ["creator", "administrator"]
-    except Exception:
-        return False
+        page = int(query.data.split(":", 1)[1])
+    except (IndexError, ValueError):
+        await query.answer()
+        return
+    chat_id = query.message.chat.id
+    async with chat_lock(chat_id):
+        await aload_group_state(chat_id)
+        text, pages = render_full_summary(chat_id, page)
+    page = min(max(page, 1), pages)
+    await query.answer()
+    # 超长的一页拆成多条：第一段替换原消息，其余作为新消息发出，翻页按钮挂在最后一条上
+    chunks = split_message(text)
+    markup = bill_page_keyboard(page, pages)
+    try:
+        await query.edit_message_text(chunks[0], reply_markup=markup if len(chunks) == 1 else None)
+    except Exception as e:
+        # 内容没有变化时 Telegram 会报错，忽略即可
+        print(f"翻页失败: {e}")
+    for i, chunk in enumerate(chunks[1:], 2):
+        await query.message.reply_text(chunk, reply_markup=markup if i == len(chunks) else None)
+
+# ========== 群成员信息缓存 ==========
+# get_chat_member 的结果按 (chat_id, user_id) 缓存一段时间，收到成员变动更新时直接覆盖
+MEMBER_CACHE_TTL = float(os.getenv("MEMBER_CACHE_TTL", "300"))
+MEMBER_CACHE_MAX_ENTRIES = 10000
+MEMBER_LOOKUP_CONCURRENCY = int(os.getenv("MEMBER_LOOKUP_CONCURRENCY", "8"))
+
+class MemberCache:
+    """带过期时间的群成员信息缓存"""
+    
+    def __init__(self, ttl: float = MEMBER_CACHE_TTL, max_entries: int = MEMBER_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {(chat_id, user_id): (过期时间, ChatMember)}
+        self.hits = self.misses = 0
+    
+    def get(self, chat_id: int, user_id: int):
+        key = (chat_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    def put(self, chat_id: int, user_id: int, member):
+        key = (chat_id, user_id)
+        self.entries[key] = (time.monotonic() + self.ttl, member)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+member_cache = MemberCache()
+
+async def get_chat_member_cached(bot, chat_id: int, user_id: int):
+    """查询群成员信息（优先读缓存）"""
+    member = member_cache.get(chat_id, user_id)
+    if member is None:
+        member = await bot.get_chat_member(chat_id, user_id)
+        member_cache.put(chat_id, user_id, member)
+    return member
+
+async def get_chat_members(bot, chat_id: int, user_ids: list) -> dict:
+    """并发查询多个群成员（限制同时请求数），返回 {user_id: ChatMember 或 None}"""
+    semaphore = asyncio.Semaphore(MEMBER_LOOKUP_CONCURRENCY)
+    
+    async def lookup(user_id: int):
+        async with semaphore:
+            try:
+                return await get_chat_member_cached(bot, chat_id, user_id)
+            except Exception:
+                return None
+    
+    members = await asyncio.gather(*(lookup(user_id) for user_id in user_ids))
+    return dict(zip(user_ids, members))
+
+async def handle_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """群成员状态变动（加入/退出/升降管理员）时刷新缓存"""
+    change = update.chat_member or update.my_chat_member
+    if change is not None:
+        member = change.new_chat_member
+        member_cache.put(change.chat.id, member.user.id, member)
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -397,7 +2509,8 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "📊 记账操作：\n"
                 "  入金：+10000 或 +10000 / 日本\n"
                 "  出金：-10000 或 -10000 / 日本\n"
-                "  查看账单：+0 或 更多记录\n\n"
+                "  查看账单：+0 或 更多记录（翻页：更多记录 2）\n"
+                "  历史账单：账单 2026-10-01 2026-10-15 [国家]（仅管理员）\n\n"
                 "💰 USDT下发（仅管理员）：\n"
                 "  下发35.04（记录下发并扣除应下发）\n"
                 "  下发-35.04（撤销下发并增加应下发）\n\n"
@@ -416,6 +2529,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "👥 管理员管理：\n"
                 "  设置机器人管理员（回复消息）\n"
                 "  删除机器人管理员（回复消息）\n"
+                "  设置本群管理员 / 删除本群管理员（只在本群有效）\n"
                 "  显示机器人管理员"
             )
         else:
@@ -462,7 +2576,8 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "📊 记账操作：\n"
             "  入金：+10000 或 +10000 / 日本\n"
             "  出金：-10000 或 -10000 / 日本\n"
-            "  查看账单：+0 或 更多记录\n\n"
+            "  查看账单：+0 或 更多记录（翻页：更多记录 2）\n"
+            "  历史账单：账单 2026-10-01 2026-10-15 [国家]（仅管理员）\n\n"
             "💰 USDT下发（仅管理员）：\n"
             "  下发35.04（记录下发并扣除应下发）\n"
             "  下发-35.04（撤销下发并增加应下发）\n\n"
@@ -481,31 +2596,265 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "👥 管理员管理：\n"
             "  设置机器人管理员（回复消息）\n"
             "  删除机器人管理员（回复消息）\n"
+            "  设置本群管理员 / 删除本群管理员（只在本群有效）\n"
             "  显示机器人管理员"
         )
 
+# ========== 广播 ==========
+# 广播在后台任务中执行：令牌桶限制全局发送速率（Telegram 对机器人约 30 条/秒），
+# 多个发送协程并行；遇到 RetryAfter（触发限流）时所有协程一起暂停指定的秒数后重试。
+# 进度定期写入检查点文件，进程重启后从检查点继续，已经收到的用户不会重复发送。
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))                 # 每秒最多发送条数
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))      # 同时进行的发送数
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # 进度更新间隔（秒）
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_CHECKPOINT = DATA_DIR / "broadcast.json"
+
+class TokenBucket:
+    """令牌桶限速（pause 用于 RetryAfter：在指定时间之前所有请求都等待）"""
+    
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = max(rate, 0.1)
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # 暂停期间不补充令牌：恢复后从零开始按速率发送，而不是一下子把桶里的令牌用完
+        self.tokens = 0.0
+        self.updated = self.paused_until
+    
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def retry_after_seconds(e: RetryAfter) -> float:
+    value = e.retry_after
+    return value.total_seconds() if isinstance(value, datetime.timedelta) else float(value)
+
+def write_broadcast_checkpoint(data: dict | None):
+    """写入（data 为 None 时删除）广播检查点（在 I/O 线程池中运行）"""
+    try:
+        if data is None:
+            BROADCAST_CHECKPOINT.unlink(missing_ok=True)
+            return
+        tmp_path = BROADCAST_CHECKPOINT.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, BROADCAST_CHECKPOINT)
+    except Exception as e:
+        print(f"❌ 保存广播进度失败: {e}")
+
+def read_broadcast_checkpoint() -> dict | None:
+    if not BROADCAST_CHECKPOINT.exists():
+        return None
+    try:
+        return json.loads(BROADCAST_CHECKPOINT.read_text(encoding="utf-8"))
+    except Exception as e:
+        print(f"⚠️ 读取广播进度失败: {e}")
+        return None
+
+class BroadcastJob:
+    """一次广播任务"""
+    
+    def __init__(self, bot, text: str, recipients: list, status_chat: int, status_message: int | None = None,
+                 sent=(), failed=None, started: str | None = None):
+        self.bot = bot
+        self.text = text
+        self.recipients = recipients
+        self.status_chat = status_chat
+        self.status_message = status_message
+        self.sent = set(sent)
+        self.failed = dict(failed or {})  # {user_id: 失败原因}
+        self.started = started or datetime.datetime.now().isoformat(timespec="seconds")
+        self.bucket = TokenBucket(BROADCAST_RATE)
+        self.finished = False
+    
+    @classmethod
+    def from_checkpoint(cls, bot, data: dict) -> "BroadcastJob":
+        return cls(bot, data["text"], data["recipients"], data["status_chat"], data.get("status_message"),
+                   data.get("sent", []), {int(k): v for k, v in data.get("failed", {}).items()}, data.get("started"))
+    
+    def checkpoint(self) -> dict:
+        return {
+            "text": self.text,
+            "recipients": self.recipients,
+            "status_chat": self.status_chat,
+            "status_message": self.status_message,
+            "sent": sorted(self.sent),
+            "failed": {str(k): v for k, v in self.failed.items()},
+            "started": self.started,
+        }
+    
+    def save(self):
+        submit_io("broadcast", write_broadcast_checkpoint, None if self.finished else self.checkpoint())
+    
+    def progress_text(self) -> str:
+        done = len(self.sent) + len(self.failed)
+        total = len(self.recipients)
+        head = "✅ 广播完成！" if self.finished else "📢 正在广播..."
+        return (
+            f"{head}\n\n"
+            f"📊 发送统计：\n"
+            f"• 成功：{len(self.sent)} 人\n"
+            f"• 失败：{len(self.failed)} 人\n"
+            f"• 进度：{done} / {total}"
+        )
+    
+    async def report(self):
+        """更新进度消息（编辑同一条消息，失败时忽略）"""
+        if self.status_message is None:
+            return
+        try:
+            await self.bot.edit_message_text(self.progress_text(), chat_id=self.status_chat, message_id=self.status_message)
+        except Exception as e:
+            print(f"更新广播进度失败: {e}")
+    
+    async def send_one(self, user_id: int):
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=user_id, text=f"📢 系统通知：\n\n{self.text}")
+                self.sent.add(user_id)
+                record_delivery(user_id)
+                return
+            except RetryAfter as e:
+                # 触发限流：全部发送协程一起暂停
+                self.bucket.pause(retry_after_seconds(e) + 1)
+            except (Forbidden, BadRequest) as e:
+                # 用户拉黑了机器人 / 聊天不存在：重试也不会成功
+                self.failed[user_id] = str(e)
+                record_delivery(user_id, str(e), blocked=True)
+                print(f"广播失败 (用户 {user_id}): {e}")
+                return
+            except (TimedOut, NetworkError) as e:
+                # 网络问题：指数退避后重试
+                print(f"广播发送超时 (用户 {user_id}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                self.failed[user_id] = str(e)
+                record_delivery(user_id, str(e))
+                print(f"广播失败 (用户 {user_id}): {e}")
+                return
+        self.failed[user_id] = "重试次数过多"
+        record_delivery(user_id, "重试次数过多")
+        print(f"广播失败 (用户 {user_id}): 重试次数过多")
+    
+    async def worker(self, pending: asyncio.Queue):
+        while True:
+            try:
+                user_id = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await self.send_one(user_id)
+    
+    async def reporter(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            self.save()
+            await self.report()
+    
+    async def run(self):
+        pending = asyncio.Queue()
+        for user_id in self.recipients:
+            if user_id not in self.sent and user_id not in self.failed:
+                pending.put_nowait(user_id)
+        self.save()
+        reporter = asyncio.create_task(self.reporter())
+        try:
+            await asyncio.gather(*(self.worker(pending) for _ in range(max(1, BROADCAST_CONCURRENCY))))
+        finally:
+            reporter.cancel()
+            # 被取消（停止广播 / 进程退出）时保留检查点，正常结束时删除
+            self.save()
+        self.finished = True
+        self.save()
+        await self.report()
+
+broadcast_job = None
+broadcast_task = None
+
+def start_broadcast(job: BroadcastJob):
+    global broadcast_job, broadcast_task
+    broadcast_job = job
+    broadcast_task = asyncio.create_task(job.run())
+
+def broadcast_running() -> bool:
+    return broadcast_task is not None and not broadcast_task.done()
+
+async def stop_broadcast(discard: bool = False):
+    """停止正在进行的广播；discard 为 True 时同时删除检查点（不再续发）"""
+    global broadcast_task
+    if broadcast_running():
+        broadcast_task.cancel()
+        try:
+            await broadcast_task
+        except asyncio.CancelledError:
+            pass
+    broadcast_task = None
+    if discard:
+        await run_io("broadcast", write_broadcast_checkpoint, None)
+    else:
+        await run_io("broadcast", lambda: None)  # 等检查点写完
+
+async def resume_broadcast(application):
+    """启动时检查未完成的广播并继续发送"""
+    data = await run_io("broadcast", read_broadcast_checkpoint)
+    if not data:
+        return
+    job = BroadcastJob.from_checkpoint(application.bot, data)
+    print(f"📢 继续未完成的广播（已发送 {len(job.sent)} / {len(job.recipients)}）")
+    start_broadcast(job)
+
+def broadcast_recipients() -> tuple:
+    """从私聊用户登记表取广播对象（不含 OWNER、已退订、已拉黑、连续失败过多的用户），返回 (用户列表, 跳过人数)"""
+    user_ids, skipped = [], 0
+    for user_id, info in load_recipients().items():
+        if user_id == OWNER_USER_ID:
+            continue
+        if broadcastable(info):
+            user_ids.append(user_id)
+        else:
+            skipped += 1
+    return user_ids, skipped
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
     chat_id = chat.id
     # 支持纯文本和图片说明文字
     text = (update.message.text or update.message.caption or "").strip()
-    ts, dstr = now_ts(), today_str()
     
     # ========== 私聊消息转发功能 ==========
     if chat.type == "private":
-        # 记录私聊日志
-        private_log_dir = LOG_DIR / "private_chats"
-        private_log_dir.mkdir(exist_ok=True)
-        user_log_file = private_log_dir / f"user_{user.id}.log"
+        ts = now_ts()
+        # 记录私聊日志，并更新私聊用户登记
+        append_log(private_log_path(user.id), f"[{ts}] {user.full_name} (@{user.username or 'N/A'}): {text}")
+        touch_recipient(user)
         
-        log_entry = f"[{ts}] {user.full_name} (@{user.username or 'N/A'}): {text}\n"
-        with open(user_log_file, "a", encoding="utf-8") as f:
-            f.write(log_entry)
+        # 退订 / 重新订阅广播通知
+        if text in ("退订", "取消订阅"):
+            update_recipient(user.id, opt_out=True)
+            await update.message.reply_text("✅ 已退订系统通知\n💡 发送「订阅」可重新接收")
+            return
+        if text == "订阅":
+            update_recipient(user.id, opt_out=False)
+            await update.message.reply_text("✅ 已订阅系统通知")
+            return
         
         # 如果设置了OWNER_ID，且发送者不是OWNER，则转发给OWNER
-        if OWNER_ID and OWNER_ID.isdigit():
-            owner_id = int(OWNER_ID)
+        if OWNER_USER_ID is not None:
+            owner_id = OWNER_USER_ID
             
             if user.id != owner_id:
                 # 非OWNER发送的私聊消息 - 转发给OWNER
@@ -565,10 +2914,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                 await update.message.reply_text("✅ 回复已发送")
                                 
                                 # 记录回复日志到目标用户的日志文件
-                                target_log_file = private_log_dir / f"user_{target_user_id}.log"
-                                reply_log_entry = f"[{ts}] OWNER回复: {text}\n"
-                                with open(target_log_file, "a", encoding="utf-8") as f:
-                                    f.write(reply_log_entry)
+                                append_log(private_log_path(target_user_id), f"[{ts}] OWNER回复: {text}")
                                 
                                 return
                             except Exception as e:
@@ -587,52 +2933,56 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         )
                         return
                     
-                    # 获取所有私聊过的用户ID
-                    user_ids = []
-                    try:
-                        if private_log_dir.exists():
-                            for log_file in private_log_dir.glob("user_*.log"):
-                                try:
-                                    user_id = int(log_file.stem.split("_")[1])
-                                    if user_id != int(OWNER_ID):  # 排除OWNER自己
-                                        user_ids.append(user_id)
-                                except (ValueError, IndexError):
-                                    continue
-                    except Exception as e:
-                        await update.message.reply_text(f"❌ 读取用户列表失败: {e}")
+                    if broadcast_running():
+                        await update.message.reply_text("⏳ 已有广播正在进行\n💡 发送「广播状态」查看进度，「停止广播」取消")
                         return
                     
+                    # 获取所有私聊过的用户ID
+                    user_ids, skipped = broadcast_recipients()
+                    
                     if not user_ids:
                         await update.message.reply_text("❌ 没有找到任何私聊用户")
                         return
                     
-                    # 开始群发
-                    await update.message.reply_text(
+                    # 开始群发（后台执行，进度消息会定期更新）
+                    status = await update.message.reply_text(
                         f"📢 开始广播...\n"
                         f"📊 目标用户数：{len(user_ids)}"
+                        + (f"\n⏭️ 已跳过（退订/拉黑/多次失败）：{skipped}" if skipped else "")
                     )
-                    
-                    success_count = 0
-                    fail_count = 0
-                    
-                    for user_id in user_ids:
-                        try:
-                            await context.bot.send_message(
-                                chat_id=user_id,
-                                text=f"📢 系统通知：\n\n{broadcast_text}"
-                            )
-                            success_count += 1
-                        except Exception as e:
-                            fail_count += 1
-                            print(f"广播失败 (用户 {user_id}): {e}")
-                    
-                    # 发送统计报告
+                    start_broadcast(BroadcastJob(context.bot, broadcast_text, user_ids, update.effective_chat.id, status.message_id))
+                    return
+                
+                if text == "广播状态":
+                    user_ids, skipped = broadcast_recipients()
+                    registry_text = f"\n\n📇 私聊用户：{len(user_ids) + skipped} 人（可广播 {len(user_ids)} 人）"
+                    if broadcast_job is None:
+                        await update.message.reply_text("📭 当前没有广播任务" + registry_text)
+                    else:
+                        await update.message.reply_text(broadcast_job.progress_text() + registry_text)
+                    return
+                
+                if text == "停止广播":
+                    if not broadcast_running():
+                        await update.message.reply_text("📭 当前没有正在进行的广播")
+                        return
+                    await stop_broadcast(discard=True)
+                    await update.message.reply_text(f"🛑 广播已停止\n\n{broadcast_job.progress_text()}")
+                    return
+                
+                # OWNER查看群组状态缓存统计
+                if text == "缓存状态":
+                    st = groups_state.stats()
                     await update.message.reply_text(
-                        f"✅ 广播完成！\n\n"
-                        f"📊 发送统计：\n"
-                        f"• 成功：{success_count} 人\n"
-                        f"• 失败：{fail_count} 人\n"
-                        f"• 总计：{len(user_ids)} 人"
+                        f"🗄️ 群组状态缓存\n\n"
+                        f"• 已加载群组：{st['entries']} 个\n"
+                        f"• 估算占用：{st['bytes'] / 1024:.1f} KB\n"
+                        f"• 命中：{st['hits']} 次\n"
+                        f"• 未命中：{st['misses']} 次\n"
+                        f"• 命中率：{st['hit_rate'] * 100:.1f}%\n"
+                        f"• 淘汰：{st['evictions']} 次\n"
+                        f"• 正在处理的群组：{len(chat_locks)} 个\n\n"
+                        f"👤 群成员信息缓存：{len(member_cache.entries)} 条（命中 {member_cache.hits} / 未命中 {member_cache.misses}）"
                     )
                     return
                 
@@ -643,446 +2993,707 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "• 在群组中使用记账功能\n\n"
                     "📢 广播功能：\n"
                     "• 广播 您的消息内容\n"
-                    "• 群发 您的消息内容"
+                    "• 群发 您的消息内容\n"
+                    "• 广播状态 / 停止广播\n\n"
+                    "🗄️ 缓存状态：查看群组状态缓存统计"
                 )
                 return
     
     # ========== 群组消息处理 ==========
-    # 检查日期并在需要时重置账单（每个群组独立）
-    check_and_reset_daily(chat_id)
+    # 一次性判断命令类型；普通聊天（绝大多数群消息）在这里直接返回
+    route = match_command(text)
+    if route is None:
+        return  # 无效操作不回复
+    name, handler, match = route
     
-    # 获取当前群组状态
-    state = load_group_state(chat_id)
+    started = time.perf_counter()
+    try:
+        async with chat_lock(chat_id):
+            CHAT_LOCK_WAIT_SECONDS.observe(time.perf_counter() - started)
+            # 缓存未命中时在线程池中读取状态，之后的同步访问都直接命中缓存
+            await aload_group_state(chat_id)
+            # 检查日期并在需要时重置账单（每个群组独立）
+            check_and_reset_daily(chat_id)
+            await handler(update, context, text, match)
+    except Exception:
+        HANDLER_ERRORS.inc(name)
+        raise
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+# ========== 群组命令路由 ==========
+# 每条命令：(命令名, 可能的首字符集合（None 表示任意）, 匹配函数, 处理函数)，按优先级排列。
+# 收到消息时先按首字符查表，只尝试这个首字符可能对应的命令。
+COMMAND_ROUTES = []
+
+UNDO_IN_PATTERN = re.compile(r'🕐\s*(\d+:\d+)\s*　\+(\d+(?:\.\d+)?)\s*→\s*(\d+(?:\.\d+)?)\s*USDT')
+UNDO_OUT_PATTERN = re.compile(r'🕐\s*(\d+:\d+)\s*　(-?\d+(?:\.\d+)?)\s*USDT')
+SET_COUNTRY_PATTERN = re.compile(r'^设置\s*(.+?)(入|出)(费率|汇率)\s*(\d+(?:\.\d+)?)\s*$')
+SET_OTHER_PATTERN = re.compile(r'^设置(?!入金|出金)')
+ADMIN_MANAGE_PREFIXES = ("设置机器人管理员", "删除机器人管理员", "显示机器人管理员", "设置本群管理员", "删除本群管理员")
+SET_DEFAULT_PREFIXES = ("设置入金费率", "设置入金汇率", "设置出金费率", "设置出金汇率")
+RESET_DEFAULTS_TEXTS = ("重置默认值", "恢复默认值")
+
+def exact_match(*texts):
+    return lambda text: text if text in texts else None
+
+def prefix_match(*prefixes):
+    return lambda text: text if text.startswith(prefixes) else None
+
+def first_chars(*texts) -> set:
+    return {t[0] for t in texts}
+
+def command(name: str, chars, matcher):
+    """注册一个群组命令处理函数（注册顺序即优先级）"""
+    def decorator(fn):
+        COMMAND_ROUTES.append((name, chars, matcher, fn))
+        return fn
+    return decorator
+
+# 首字符 → 候选命令列表（在所有命令注册完之后构建）
+ROUTES_BY_FIRST_CHAR = {}
+ANY_CHAR_ROUTES = []
+
+def build_route_index():
+    ROUTES_BY_FIRST_CHAR.clear()
+    ANY_CHAR_ROUTES[:] = [r for r in COMMAND_ROUTES if r[1] is None]
+    all_chars = set().union(*(r[1] for r in COMMAND_ROUTES if r[1] is not None))
+    for c in all_chars:
+        ROUTES_BY_FIRST_CHAR[c] = [r for r in COMMAND_ROUTES if r[1] is None or c in r[1]]
+
+def match_command(text: str):
+    """返回 (命令名, 处理函数, 匹配结果)，不是命令时返回 None"""
+    if not text:
+        return None
+    for name, _, matcher, handler in ROUTES_BY_FIRST_CHAR.get(text[0], ANY_CHAR_ROUTES):
+        match = matcher(text)
+        if match is not None:
+            return name, handler, match
+    return None
+
+@command("撤销", first_chars("撤销"), exact_match("撤销"))
+async def handle_undo(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """撤销操作（必须：回复机器人消息 + 输入"撤销"）"""
+    reply = update.message.reply_to_message
+    if not (reply and reply.from_user.is_bot):
+        return
+    if not is_admin(update.effective_user.id, update.effective_chat.id):
+        return  # 非管理员不回复
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    ts, dstr = now_ts(), ledger_date(chat_id)
     
-    # 撤销操作（必须：回复机器人消息 + 输入"撤销"）
-    if text == "撤销" and update.message.reply_to_message and update.message.reply_to_message.from_user.is_bot:
-        if not is_admin(user.id):
-            return  # 非管理员不回复
-        
-        # 获取被回复的消息内容
-        replied_text = update.message.reply_to_message.text or ""
-        
-        # 尝试从消息中提取最近的入金或下发记录
-        import re
-        
-        # 匹配所有入金记录: 🕐 14:30　+10000 → 58.82 USDT
-        in_matches = re.findall(r'🕐\s*(\d+:\d+)\s*　\+(\d+(?:\.\d+)?)\s*→\s*(\d+(?:\.\d+)?)\s*USDT', replied_text)
-        # 匹配所有下发记录: 🕐 14:30　35.04 USDT 或 🕐 14:30　-35.04 USDT
-        out_matches = re.findall(r'🕐\s*(\d+:\d+)\s*　(-?\d+(?:\.\d+)?)\s*USDT', replied_text)
-        
-        # 取最后一笔（最新的）记录
-        in_match = in_matches[-1] if in_matches else None
-        out_match = out_matches[-1] if out_matches else None
-        
-        if in_match:
-            # 撤销入金
-            raw_amt = trunc2(float(in_match[1]))
-            usdt_amt = trunc2(float(in_match[2]))
-            
-            # 反向操作：减少应下发
-            state["summary"]["should_send_usdt"] = trunc2(state["summary"]["should_send_usdt"] - usdt_amt)
-            save_group_state(chat_id)
-            
-            # 从最近记录中移除（如果存在）
-            state["recent"]["in"] = [r for r in state["recent"]["in"] if not (r.get("raw") == raw_amt and r.get("usdt") == usdt_amt)]
-            
-            save_group_state(chat_id)
-            append_log(log_path(chat_id, None, dstr), f"[撤销入金] 时间:{ts} 原金额:{raw_amt} USDT:{usdt_amt} 标记:无效操作")
-            await update.message.reply_text(f"✅ 已撤销入金记录\n📊 原金额：+{raw_amt} → {usdt_amt} USDT")
-            await update.message.reply_text(render_group_summary(chat_id))
-            return
-            
-        elif out_match:
-            # 撤销下发
-            usdt_amt = trunc2(float(out_match[1]))
-            
-            # 反向操作：如果是正数下发，撤销后增加应下发；如果是负数，则减少应下发
-            state["summary"]["should_send_usdt"] = trunc2(state["summary"]["should_send_usdt"] + usdt_amt)
-            
-            # 从最近记录中移除
-            state["recent"]["out"] = [r for r in state["recent"]["out"] if r.get("usdt") != usdt_amt]
-            
-            save_group_state(chat_id)
-            append_log(log_path(chat_id, None, dstr), f"[撤销下发] 时间:{ts} USDT:{usdt_amt} 标记:无效操作")
-            await update.message.reply_text(f"✅ 已撤销下发记录\n📊 原金额：{usdt_amt} USDT")
-            await update.message.reply_text(render_group_summary(chat_id))
-            return
+    # 记账时机器人的回复消息已关联到对应记录：按消息 ID 直接定位，精确撤销那一笔
+    state = load_group_state(chat_id)
+    index = ensure_record_index(state)
+    record_id = index["by_msg"].get(reply.message_id)
+    if record_id is not None:
+        direction, item = index["by_id"][record_id]
+        kind = record_kind(direction, item)
+        commit_op(chat_id, {"op": "undo", "id": record_id, "kind": kind, "usdt": item.usdt})
+        log_event(ledger_event(chat_id, user_id, f"undo_{kind}", ts, dstr, record_id,
+                               item.raw if kind != "send" else None, item.usdt,
+                               item.country if kind != "send" else None))
+        if kind == "in":
+            await update.message.reply_text(f"✅ 已撤销入金记录\n📊 原金额：+{item.raw} → {item.usdt} USDT")
+        elif kind == "out":
+            await update.message.reply_text(f"✅ 已撤销出金记录\n📊 原金额：-{item.raw} → {item.usdt} USDT")
         else:
-            await update.message.reply_text("❌ 无法识别要撤销的操作\n💡 请回复包含入金或下发记录的账单消息")
-            return
-
-    # 查看账单（+0 不记录）
-    if text == "+0":
+            await update.message.reply_text(f"✅ 已撤销下发记录\n📊 原金额：{item.usdt} USDT")
         await update.message.reply_text(render_group_summary(chat_id))
         return
     
-    # 管理员管理命令
-    if text.startswith(("设置机器人管理员", "删除机器人管理员", "显示机器人管理员")):
-        lst = list_admins()
-        if text.startswith("显示"):
-            lines = ["👥 机器人管理员列表\n"]
-            lines.append(f"⭐ 超级管理员：{OWNER_ID or '未设置'}\n")
-            
-            if lst:
-                lines.append("📋 机器人管理员：")
-                for admin_id in lst:
-                    try:
-                        # 尝试获取用户信息
-                        chat_member = await context.bot.get_chat_member(update.effective_chat.id, admin_id)
-                        user_info = chat_member.user
-                        
-                        # 构建显示信息
-                        name = user_info.full_name
-                        username = f"@{user_info.username}" if user_info.username else ""
-                        
-                        if username:
-                            lines.append(f"• {name} ({username}) - ID: {admin_id}")
-                        else:
-                            lines.append(f"• {name} - ID: {admin_id}")
-                    except Exception:
-                        # 如果获取失败，只显示ID
-                        lines.append(f"• ID: {admin_id}")
-            else:
-                lines.append("暂无机器人管理员")
-            
-            await update.message.reply_text("\n".join(lines))
-            return
-        
-        # 检查权限：只有机器人管理员可以设置
-        if not is_admin(user.id):
-            await update.message.reply_text("🚫 你没有权限设置机器人管理员。\n💡 只有机器人管理员可以执行此操作。")
-            return
-        
-        # 获取目标用户：优先使用@mention，其次使用回复消息
-        target = None
-        
-        # 方式1：检查消息中是否有@mention
-        if update.message.entities:
-            for entity in update.message.entities:
-                if entity.type == "text_mention":
-                    # @了一个没有用户名的用户
-                    target = entity.user
-                    break
-                elif entity.type == "mention":
-                    # @了一个有用户名的用户，但需要通过回复或其他方式获取完整信息
-                    # 这种情况我们还是优先用回复消息
-                    pass
-        
-        # 方式2：如果没有@mention，检查是否回复了消息
-        if not target and update.message.reply_to_message:
-            target = update.message.reply_to_message.from_user
+    # 没有关联记录的旧消息：从消息文本中识别
+    replied_text = reply.text or ""
+    
+    # 匹配所有入金记录: 🕐 14:30　+10000 → 58.82 USDT
+    in_matches = UNDO_IN_PATTERN.findall(replied_text)
+    # 匹配所有下发记录: 🕐 14:30　35.04 USDT 或 🕐 14:30　-35.04 USDT
+    out_matches = UNDO_OUT_PATTERN.findall(replied_text)
+    
+    # 取最后一笔（最新的）记录
+    in_match = in_matches[-1] if in_matches else None
+    out_match = out_matches[-1] if out_matches else None
+    
+    if in_match:
+        # 撤销入金
+        raw_amt = trunc2(float(in_match[1]))
+        usdt_amt = trunc2(float(in_match[2]))
         
-        # 如果两种方式都没有获取到目标用户
-        if not target:
-            await update.message.reply_text(
-                "❌ 请指定要操作的用户\n\n"
-                "方式1：@用户名 设置机器人管理员\n"
-                "方式2：回复用户消息 + 设置机器人管理员"
-            )
-            return
+        # 反向操作：减少应下发，并从最近记录中移除（如果存在）
+        commit_op(chat_id, {"op": "undo_in", "raw": raw_amt, "usdt": usdt_amt})
+        log_event(ledger_event(chat_id, user_id, "undo_in", ts, dstr, amount=raw_amt, usdt=usdt_amt))
+        await update.message.reply_text(f"✅ 已撤销入金记录\n📊 原金额：+{raw_amt} → {usdt_amt} USDT")
+        await update.message.reply_text(render_group_summary(chat_id))
+    elif out_match:
+        # 撤销下发
+        usdt_amt = trunc2(float(out_match[1]))
         
-        # 执行操作
-        if text.startswith("设置"):
-            add_admin(target.id)
-            await update.message.reply_text(f"✅ 已将 {target.mention_html()} 设置为机器人管理员。", parse_mode="HTML")
-        elif text.startswith("删除"):
-            remove_admin(target.id)
-            await update.message.reply_text(f"🗑️ 已移除 {target.mention_html()} 的机器人管理员权限。", parse_mode="HTML")
-        return
+        # 反向操作：如果是正数下发，撤销后增加应下发；如果是负数，则减少应下发
+        # 同时从最近记录中移除
+        commit_op(chat_id, {"op": "undo_send", "usdt": usdt_amt})
+        log_event(ledger_event(chat_id, user_id, "undo_send", ts, dstr, usdt=usdt_amt))
+        await update.message.reply_text(f"✅ 已撤销下发记录\n📊 原金额：{usdt_amt} USDT")
+        await update.message.reply_text(render_group_summary(chat_id))
+    else:
+        await update.message.reply_text("❌ 无法识别要撤销的操作\n💡 请回复包含入金或下发记录的账单消息")
 
-    # 查询国家点位（费率/汇率）
-    if text.endswith("当前点位"):
-        if not is_admin(user.id):
-            return  # 非管理员不回复
-        
-        # 提取国家名（去掉"当前点位"）
-        country = text.replace("当前点位", "").strip()
-        
-        if not country:
-            await update.message.reply_text("❌ 请指定国家名称\n例如：美国当前点位")
-            return
-        
-        # 获取该国家的费率和汇率
-        countries = state["countries"]
-        defaults = state["defaults"]
+@command("+0", first_chars("+0"), exact_match("+0"))
+async def handle_show_summary(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """查看账单（+0 不记录）"""
+    await update.message.reply_text(render_group_summary(update.effective_chat.id))
+
+@command("管理员", first_chars(*ADMIN_MANAGE_PREFIXES), prefix_match(*ADMIN_MANAGE_PREFIXES))
+async def handle_admin_manage(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """管理员管理命令"""
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    lst = list_admins()
+    if text.startswith("显示"):
+        lines = ["👥 机器人管理员列表\n"]
+        lines.append(f"⭐ 超级管理员：{OWNER_ID or '未设置'}\n")
         
-        # 查询入金费率和汇率
-        in_rate = None
-        in_fx = None
-        if country in countries and "in" in countries[country]:
-            in_rate = countries[country]["in"].get("rate")
-            in_fx = countries[country]["in"].get("fx")
+        group_lst = list_admins(chat_id)
+        # 一次并发查询所有管理员的用户信息
+        members = await get_chat_members(context.bot, chat_id, list(dict.fromkeys(lst + group_lst)))
         
-        # 如果没有专属设置，使用默认值
-        if in_rate is None:
-            in_rate = defaults["in"]["rate"]
-            in_rate_source = "默认"
-        else:
-            in_rate_source = f"{country}专属"
+        def admin_line(admin_id: int) -> str:
+            chat_member = members.get(admin_id)
+            if chat_member is None:
+                # 如果获取失败，只显示ID
+                return f"• ID: {admin_id}"
+            user_info = chat_member.user
             
-        if in_fx is None:
-            in_fx = defaults["in"]["fx"]
-            in_fx_source = "默认"
-        else:
-            in_fx_source = f"{country}专属"
-        
-        # 查询出金费率和汇率
-        out_rate = None
-        out_fx = None
-        if country in countries and "out" in countries[country]:
-            out_rate = countries[country]["out"].get("rate")
-            out_fx = countries[country]["out"].get("fx")
-        
-        if out_rate is None:
-            out_rate = defaults["out"]["rate"]
-            out_rate_source = "默认"
-        else:
-            out_rate_source = f"{country}专属"
+            # 构建显示信息
+            name = user_info.full_name
+            username = f"@{user_info.username}" if user_info.username else ""
             
-        if out_fx is None:
-            out_fx = defaults["out"]["fx"]
-            out_fx_source = "默认"
+            if username:
+                return f"• {name} ({username}) - ID: {admin_id}"
+            return f"• {name} - ID: {admin_id}"
+        
+        if lst:
+            lines.append("📋 机器人管理员：")
+            lines.extend(admin_line(admin_id) for admin_id in lst)
         else:
-            out_fx_source = f"{country}专属"
+            lines.append("暂无机器人管理员")
         
-        # 构建回复消息
-        lines = [
-            f"📍【{country} 当前点位】\n",
-            f"📥 入金设置：",
-            f"  • 费率：{in_rate*100:.0f}% ({in_rate_source})",
-            f"  • 汇率：{in_fx} ({in_fx_source})\n",
-            f"📤 出金设置：",
-            f"  • 费率：{abs(out_rate)*100:.0f}% ({out_rate_source})",
-            f"  • 汇率：{out_fx} ({out_fx_source})"
-        ]
+        if group_lst:
+            lines.append("\n🏠 本群管理员：")
+            lines.extend(admin_line(admin_id) for admin_id in group_lst)
         
         await update.message.reply_text("\n".join(lines))
         return
     
-    # 重置为推荐默认值
-    if text == "重置默认值" or text == "恢复默认值":
-        if not is_admin(user.id):
-            return  # 非管理员不回复
+    # 检查权限：只有机器人管理员可以设置
+    if not is_admin(user.id):
+        await update.message.reply_text("🚫 你没有权限设置机器人管理员。\n💡 只有机器人管理员可以执行此操作。")
+        return
+    
+    # 获取目标用户：优先使用@mention，其次使用回复消息
+    target = None
+    
+    # 方式1：检查消息中是否有@mention
+    if update.message.entities:
+        for entity in update.message.entities:
+            if entity.type == "text_mention":
+                # @了一个没有用户名的用户
+                target = entity.user
+                break
+            elif entity.type == "mention":
+                # @了一个有用户名的用户，但需要通过回复或其他方式获取完整信息
+                # 这种情况我们还是优先用回复消息
+                pass
+    
+    # 方式2：如果没有@mention，检查是否回复了消息
+    if not target and update.message.reply_to_message:
+        target = update.message.reply_to_message.from_user
+    
+    # 如果两种方式都没有获取到目标用户
+    if not target:
+        await update.message.reply_text(
+            "❌ 请指定要操作的用户\n\n"
+            "方式1：@用户名 设置机器人管理员\n"
+            "方式2：回复用户消息 + 设置机器人管理员"
+        )
+        return
+    
+    # 执行操作（"本群管理员" 只在当前群组有效）
+    scope, scope_name = (chat_id, "本群管理员") if "本群" in text else (None, "机器人管理员")
+    if text.startswith("设置"):
+        add_admin(target.id, scope)
+        await update.message.reply_text(f"✅ 已将 {target.mention_html()} 设置为{scope_name}。", parse_mode="HTML")
+    elif text.startswith("删除"):
+        remove_admin(target.id, scope)
+        await update.message.reply_text(f"🗑️ 已移除 {target.mention_html()} 的{scope_name}权限。", parse_mode="HTML")
+
+@command("点位", None, lambda text: text if text.endswith("当前点位") else None)
+async def handle_query_rates(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """查询国家点位（费率/汇率）"""
+    if not is_admin(update.effective_user.id, update.effective_chat.id):
+        return  # 非管理员不回复
+    
+    # 提取国家名（去掉"当前点位"）
+    country = text.replace("当前点位", "").strip()
+    
+    if not country:
+        await update.message.reply_text("❌ 请指定国家名称\n例如：美国当前点位")
+        return
+    
+    # 获取该国家的费率和汇率
+    state = load_group_state(update.effective_chat.id)
+    countries = state["countries"]
+    defaults = state["defaults"]
+    
+    # 查询入金费率和汇率
+    in_rate = None
+    in_fx = None
+    if country in countries and "in" in countries[country]:
+        in_rate = countries[country]["in"].get("rate")
+        in_fx = countries[country]["in"].get("fx")
+    
+    # 如果没有专属设置，使用默认值
+    if in_rate is None:
+        in_rate = defaults["in"]["rate"]
+        in_rate_source = "默认"
+    else:
+        in_rate_source = f"{country}专属"
         
-        # 重置为推荐默认值
-        state["defaults"] = {
-            "in":  {"rate": 0.10, "fx": 153},
-            "out": {"rate": -0.02, "fx": 137},
-        }
-        save_group_state(chat_id)
+    if in_fx is None:
+        in_fx = defaults["in"]["fx"]
+        in_fx_source = "默认"
+    else:
+        in_fx_source = f"{country}专属"
+    
+    # 查询出金费率和汇率
+    out_rate = None
+    out_fx = None
+    if country in countries and "out" in countries[country]:
+        out_rate = countries[country]["out"].get("rate")
+        out_fx = countries[country]["out"].get("fx")
+    
+    if out_rate is None:
+        out_rate = defaults["out"]["rate"]
+        out_rate_source = "默认"
+    else:
+        out_rate_source = f"{country}专属"
+        
+    if out_fx is None:
+        out_fx = defaults["out"]["fx"]
+        out_fx_source = "默认"
+    else:
+        out_fx_source = f"{country}专属"
+    
+    # 构建回复消息
+    lines = [
+        f"📍【{country} 当前点位】\n",
+        f"📥 入金设置：",
+        f"  • 费率：{in_rate*100:.0f}% ({in_rate_source})",
+        f"  • 汇率：{in_fx} ({in_fx_source})\n",
+        f"📤 出金设置：",
+        f"  • 费率：{abs(out_rate)*100:.0f}% ({out_rate_source})",
+        f"  • 汇率：{out_fx} ({out_fx_source})"
+    ]
+    
+    await update.message.reply_text("\n".join(lines))
+
+@command("重置", first_chars(*RESET_DEFAULTS_TEXTS), exact_match(*RESET_DEFAULTS_TEXTS))
+async def handle_reset_defaults(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """重置为推荐默认值"""
+    if not is_admin(update.effective_user.id, update.effective_chat.id):
+        return  # 非管理员不回复
+    
+    commit_op(update.effective_chat.id, {"op": "reset_defaults"})
+    
+    await update.message.reply_text(
+        "✅ 已重置为推荐默认值\n\n"
+        "📥 入金设置：\n"
+        "  • 费率：10%\n"
+        "  • 汇率：153\n\n"
+        "📤 出金设置：\n"
+        "  • 费率：2%\n"
+        "  • 汇率：137"
+    )
+
+@command("设置", first_chars(*SET_DEFAULT_PREFIXES), prefix_match(*SET_DEFAULT_PREFIXES))
+async def handle_set_default(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """简化的设置命令"""
+    if not is_admin(update.effective_user.id, update.effective_chat.id):
+        return  # 非管理员不回复
+    try:
+        direction = ""
+        key = ""
+        val = 0.0
+        display_val = ""
+        
+        # 解析命令
+        if "入金费率" in text:
+            direction, key = "in", "rate"
+            val = float(text.replace("设置入金费率", "").strip())
+            val /= 100.0  # 转换为小数
+            display_val = f"{val*100:.0f}%"
+        elif "入金汇率" in text:
+            direction, key = "in", "fx"
+            val = float(text.replace("设置入金汇率", "").strip())
+            display_val = str(val)
+        elif "出金费率" in text:
+            direction, key = "out", "rate"
+            val = float(text.replace("设置出金费率", "").strip())
+            val /= 100.0  # 转换为小数
+            display_val = f"{val*100:.0f}%"
+        elif "出金汇率" in text:
+            direction, key = "out", "fx"
+            val = float(text.replace("设置出金汇率", "").strip())
+            display_val = str(val)
         
+        # 更新默认设置
+        commit_op(update.effective_chat.id, {"op": "set", "scope": "默认", "direction": direction, "key": key, "value": val})
+        
+        # 构建回复消息
+        type_name = "费率" if key == "rate" else "汇率"
+        dir_name = "入金" if direction == "in" else "出金"
         await update.message.reply_text(
-            "✅ 已重置为推荐默认值\n\n"
-            "📥 入金设置：\n"
-            "  • 费率：10%\n"
-            "  • 汇率：153\n\n"
-            "📤 出金设置：\n"
-            "  • 费率：2%\n"
-            "  • 汇率：137"
+            f"✅ 已设置默认{dir_name}{type_name}\n"
+            f"📊 新值：{display_val}"
         )
-        return
+    except ValueError:
+        await update.message.reply_text("❌ 格式错误，请输入有效的数字\n例如：设置入金费率 10")
+
+@command("设置", first_chars("设置"), SET_OTHER_PATTERN.match)
+async def handle_set_country(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """高级设置命令（指定国家）- 支持无空格格式"""
+    if not is_admin(update.effective_user.id, update.effective_chat.id):
+        return  # 非管理员不回复
+    chat_id = update.effective_chat.id
     
-    # 简化的设置命令
-    if text.startswith(("设置入金费率", "设置入金汇率", "设置出金费率", "设置出金汇率")):
-        if not is_admin(user.id):
-            return  # 非管理员不回复
+    # 尝试匹配格式：设置 + 国家名 + 入/出 + 费率/汇率 + 数字
+    # 例如：设置美国入费率7, 设置美国入汇率10
+    match = SET_COUNTRY_PATTERN.match(text)
+    
+    if match:
+        scope = match.group(1).strip()  # 国家名
+        direction = "in" if match.group(2) == "入" else "out"
+        key = "rate" if match.group(3) == "费率" else "fx"
         try:
-            direction = ""
-            key = ""
-            val = 0.0
-            display_val = ""
-            
-            # 解析命令
-            if "入金费率" in text:
-                direction, key = "in", "rate"
-                val = float(text.replace("设置入金费率", "").strip())
+            val = float(match.group(4))
+            if key == "rate": 
                 val /= 100.0  # 转换为小数
-                display_val = f"{val*100:.0f}%"
-            elif "入金汇率" in text:
-                direction, key = "in", "fx"
-                val = float(text.replace("设置入金汇率", "").strip())
-                display_val = str(val)
-            elif "出金费率" in text:
-                direction, key = "out", "rate"
-                val = float(text.replace("设置出金费率", "").strip())
-                val /= 100.0  # 转换为小数
-                display_val = f"{val*100:.0f}%"
-            elif "出金汇率" in text:
-                direction, key = "out", "fx"
-                val = float(text.replace("设置出金汇率", "").strip())
-                display_val = str(val)
             
-            # 更新默认设置
-            state["defaults"][direction][key] = val
-            save_group_state(chat_id)
+            commit_op(chat_id, {"op": "set", "scope": scope, "direction": direction, "key": key, "value": val})
             
-            # 构建回复消息
+            # 构建友好的回复消息
             type_name = "费率" if key == "rate" else "汇率"
             dir_name = "入金" if direction == "in" else "出金"
+            display_val = f"{val*100:.0f}%" if key == "rate" else str(val)
+            
             await update.message.reply_text(
-                f"✅ 已设置默认{dir_name}{type_name}\n"
+                f"✅ 已设置 {scope} {dir_name}{type_name}\n"
                 f"📊 新值：{display_val}"
             )
         except ValueError:
-            await update.message.reply_text("❌ 格式错误，请输入有效的数字\n例如：设置入金费率 10")
-        return
-
-    # 高级设置命令（指定国家）- 支持无空格格式
-    if text.startswith("设置") and not text.startswith(("设置入金", "设置出金")):
-        if not is_admin(user.id):
-            return  # 非管理员不回复
-        
-        # 尝试匹配格式：设置 + 国家名 + 入/出 + 费率/汇率 + 数字
-        # 例如：设置美国入费率7, 设置美国入汇率10
-        import re
-        pattern = r'^设置\s*(.+?)(入|出)(费率|汇率)\s*(\d+(?:\.\d+)?)\s*$'
-        match = re.match(pattern, text)
-        
-        if match:
-            scope = match.group(1).strip()  # 国家名
-            direction = "in" if match.group(2) == "入" else "out"
-            key = "rate" if match.group(3) == "费率" else "fx"
+            await update.message.reply_text("❌ 数值格式错误")
+    else:
+        # 尝试旧格式（有空格）：设置 国家 入 费率 值
+        tokens = text.split()
+        if len(tokens) >= 3:
+            scope = tokens[1]
+            direction = "in" if "入" in text else "out"
+            key = "rate" if "费率" in text else "fx"
             try:
-                val = float(match.group(4))
-                if key == "rate": 
-                    val /= 100.0  # 转换为小数
-                
-                if scope == "默认":
-                    state["defaults"][direction][key] = val
-                else:
-                    state["countries"].setdefault(scope, {}).setdefault(direction, {})[key] = val
-                
-                save_group_state(chat_id)
-                
-                # 构建友好的回复消息
-                type_name = "费率" if key == "rate" else "汇率"
-                dir_name = "入金" if direction == "in" else "出金"
-                display_val = f"{val*100:.0f}%" if key == "rate" else str(val)
-                
-                await update.message.reply_text(
-                    f"✅ 已设置 {scope} {dir_name}{type_name}\n"
-                    f"📊 新值：{display_val}"
-                )
+                val = float(tokens[-1])
+                if key == "rate": val /= 100.0
+                commit_op(chat_id, {"op": "set", "scope": scope, "direction": direction, "key": key, "value": val})
+                await update.message.reply_text(f"✅ 已设置 {scope} {direction} {key} = {val}")
             except ValueError:
-                await update.message.reply_text("❌ 数值格式错误")
-            return
-        else:
-            # 尝试旧格式（有空格）：设置 国家 入 费率 值
-            tokens = text.split()
-            if len(tokens) >= 3:
-                scope = tokens[1]
-                direction = "in" if "入" in text else "out"
-                key = "rate" if "费率" in text else "fx"
-                try:
-                    val = float(tokens[-1])
-                    if key == "rate": val /= 100.0
-                    if scope == "默认": 
-                        state["defaults"][direction][key] = val
-                    else:
-                        state["countries"].setdefault(scope, {}).setdefault(direction, {})[key] = val
-                    save_group_state(chat_id)
-                    await update.message.reply_text(f"✅ 已设置 {scope} {direction} {key} = {val}")
-                except ValueError:
-                    return
                 return
 
-    # 入金
-    if text.startswith("+"):
-        if not is_admin(user.id):
-            return  # 非管理员不回复
-        amt, country = parse_amount_and_country(text)
-        p = resolve_params(chat_id, "in", country)
-        
-        # 检查汇率是否已设置（费率可以为0）
-        if p["fx"] == 0:
-            await update.message.reply_text("⚠️ 请先设置费率和汇率")
-            return
-        
-        usdt = trunc2(amt * (1 - p["rate"]) / p["fx"])
-        push_recent(chat_id, "in", {"ts": ts, "raw": amt, "usdt": usdt, "country": country, "fx": p["fx"], "rate": p["rate"]})
-        state["summary"]["should_send_usdt"] = trunc2(state["summary"]["should_send_usdt"] + usdt)
-        save_group_state(chat_id)
-        append_log(log_path(chat_id, country, dstr),
-                   f"[入金] 时间:{ts} 国家:{country or '通用'} 原始:{amt} 汇率:{p['fx']} 费率:{p['rate']*100:.2f}% 结果:{usdt}")
-        await update.message.reply_text(render_group_summary(chat_id))
+@command("入金", first_chars("+"), prefix_match("+"))
+async def handle_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """入金"""
+    if not is_admin(update.effective_user.id, update.effective_chat.id):
+        return  # 非管理员不回复
+    chat_id = update.effective_chat.id
+    ts = now_ts()
+    amt, country = parse_amount_and_country(text)
+    if amt is None:
+        return  # 不是金额（例如 "+1 同意" 以外的普通文字），不回复
+    p = resolve_params(chat_id, "in", country)
+    
+    # 检查汇率是否已设置（费率可以为0）
+    if p["fx"] == 0:
+        await update.message.reply_text("⚠️ 请先设置费率和汇率")
         return
+    
+    usdt = trunc2(amt * (1 - p["rate"]) / p["fx"])
+    op = commit_op(chat_id, {"op": "in", "item": new_ledger_item(ts, amt, usdt, country, p)})
+    log_event(ledger_event(chat_id, update.effective_user.id, "in", ts, ledger_date(chat_id), op["item"]["id"],
+                           amt, usdt, country, p))
+    link_reply(chat_id, op, await update.message.reply_text(render_group_summary(chat_id)))
 
-    # 出金
-    if text.startswith("-"):
-        if not is_admin(user.id):
-            return  # 非管理员不回复
-        amt, country = parse_amount_and_country(text)
-        p = resolve_params(chat_id, "out", country)
-        
-        # 检查汇率是否已设置（费率可以为0）
-        if p["fx"] == 0:
-            await update.message.reply_text("⚠️ 请先设置费率和汇率")
-            return
+@command("出金", first_chars("-"), prefix_match("-"))
+async def handle_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """出金"""
+    if not is_admin(update.effective_user.id, update.effective_chat.id):
+        return  # 非管理员不回复
+    chat_id = update.effective_chat.id
+    ts = now_ts()
+    amt, country = parse_amount_and_country(text)
+    if amt is None:
+        return  # 不是金额，不回复
+    p = resolve_params(chat_id, "out", country)
+    
+    # 检查汇率是否已设置（费率可以为0）
+    if p["fx"] == 0:
+        await update.message.reply_text("⚠️ 请先设置费率和汇率")
+        return
+    
+    usdt = trunc2(amt * (1 + p["rate"]) / p["fx"])
+    op = commit_op(chat_id, {"op": "out", "item": new_ledger_item(ts, amt, usdt, country, p)})
+    log_event(ledger_event(chat_id, update.effective_user.id, "out", ts, ledger_date(chat_id), op["item"]["id"],
+                           amt, usdt, country, p))
+    link_reply(chat_id, op, await update.message.reply_text(render_group_summary(chat_id)))
+
+@command("下发", first_chars("下发"), prefix_match("下发"))
+async def handle_send_usdt(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """下发USDT（仅管理员）"""
+    if not is_admin(update.effective_user.id, update.effective_chat.id):
+        return  # 非管理员不回复
+    chat_id = update.effective_chat.id
+    ts = now_ts()
+    try:
+        usdt_str = text.replace("下发", "").strip()
+        usdt = trunc2(float(usdt_str))  # 对输入也进行精度截断
         
-        usdt = trunc2(amt * (1 + p["rate"]) / p["fx"])
-        push_recent(chat_id, "out", {"ts": ts, "raw": amt, "usdt": usdt, "country": country, "fx": p["fx"], "rate": p["rate"]})
-        state["summary"]["sent_usdt"] = trunc2(state["summary"]["sent_usdt"] + usdt)
-        save_group_state(chat_id)
-        append_log(log_path(chat_id, country, dstr),
-                   f"[出金] 时间:{ts} 国家:{country or '通用'} 原始:{amt} 汇率:{p['fx']} 费率:{p['rate']*100:.2f}% 下发:{usdt}")
-        await update.message.reply_text(render_group_summary(chat_id))
+        # 正数：扣除应下发；负数：增加应下发（撤销）
+        op = commit_op(chat_id, {"op": "send", "item": new_send_item(ts, usdt)})
+        log_event(ledger_event(chat_id, update.effective_user.id, "send", ts, ledger_date(chat_id), op["item"]["id"],
+                               usdt=usdt))
+        link_reply(chat_id, op, await update.message.reply_text(render_group_summary(chat_id)))
+    except ValueError:
+        await update.message.reply_text("❌ 格式错误，请输入有效的数字\n例如：下发35.04 或 下发-35.04")
+
+HISTORY_PATTERN = re.compile(r"^账单\s+(\d{4}-\d{1,2}-\d{1,2})(?:\s*(?:~|至|到)?\s*(\d{4}-\d{1,2}-\d{1,2}))?(?:\s+(\S+))?$")
+
+@command("历史账单", first_chars("账单"), HISTORY_PATTERN.match)
+async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """历史账单查询：账单 2026-10-01 2026-10-15 [国家]"""
+    if not is_admin(update.effective_user.id, update.effective_chat.id):
+        return  # 非管理员不回复
+    try:
+        start = datetime.date.fromisoformat(normalize_date(match.group(1))).isoformat()
+        end = datetime.date.fromisoformat(normalize_date(match.group(2) or match.group(1))).isoformat()
+    except ValueError:
+        await update.message.reply_text("❌ 日期格式错误\n例如：账单 2026-10-01 2026-10-15 美国")
         return
+    if start > end:
+        start, end = end, start
+    country = match.group(3)
+    chat_id = update.effective_chat.id
+    
+    # 已归档的每日合计在线程池中读取（排在该群组的归档写入之后），今天的直接读内存
+    days = await run_io(chat_id, storage.query_days, chat_id, start, end, country)
+    days = add_today_totals(chat_id, days, start, end, country)
+    for chunk in split_message(build_history_report(start, end, country, days)):
+        await update.message.reply_text(chunk)
+
+def normalize_date(text: str) -> str:
+    """2026-1-5 → 2026-01-05"""
+    y, m, d = text.split("-")
+    return f"{int(y):04d}-{int(m):02d}-{int(d):02d}"
+
+@command("更多记录", first_chars("更多记录", "查看更多记录", "显示历史账单"), FULL_BILL_PATTERN.match)
+async def handle_full_bill(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, match):
+    """查看更多记录（支持分页：更多记录 2）"""
+    await send_full_bill(update.message, update.effective_chat.id, int(match.group(1) or 1))
 
-    # 下发USDT（仅管理员）
-    if text.startswith("下发"):
-        if not is_admin(user.id):
-            return  # 非管理员不回复
+build_route_index()
+
+# ========== 运行指标：Telegram 请求与运行状态 ==========
+class TimedRequest(HTTPXRequest):
+    """给每次 Bot API 请求计时并统计失败（按 API 方法名，不含 Token）"""
+    
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
         try:
-            usdt_str = text.replace("下发", "").strip()
-            usdt = trunc2(float(usdt_str))  # 对输入也进行精度截断
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            TELEGRAM_API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, api_method)
+        if code >= 400:
+            TELEGRAM_API_ERRORS.inc(api_method, str(code))
+        return code, payload
+
+CallbackMetric("bot_loaded_groups", "缓存中已加载的群组数", "gauge", lambda: len(groups_state))
+CallbackMetric("bot_group_cache_bytes", "群组状态缓存的估算内存占用", "gauge", lambda: groups_state.total_bytes)
+CallbackMetric("bot_group_cache_evictions_total", "群组状态缓存淘汰次数", "counter", lambda: groups_state.evictions)
+CallbackMetric("bot_active_chats", "正在处理或排队的群组数", "gauge", lambda: len(chat_locks))
+CallbackMetric("bot_log_queue_size", "等待写入的日志行数", "gauge", lambda: log_writer.queue.qsize())
+CallbackMetric("bot_cache_lookups_total", "缓存查询次数", "counter", lambda: {
+    ("group_state", "hit"): groups_state.hits, ("group_state", "miss"): groups_state.misses,
+    ("member", "hit"): member_cache.hits, ("member", "miss"): member_cache.misses,
+    ("render", "hit"): render_cache_stats["hit"], ("render", "miss"): render_cache_stats["miss"],
+}, ("cache", "result"))
+
+# ========== HTTP服务器 ==========
+# 一个 asyncio HTTP 服务器（和机器人共用事件循环，不再单独开线程）：
+# /health 用于 Render 健康检查和 UptimeRobot 保活，/metrics 输出 Prometheus 指标；
+# 设置了 WEBHOOK_URL 时同一端口还接收 Telegram 推送的更新
+HTTP_PORT = int(os.getenv("PORT", "10000"))
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_KEEPALIVE_TIMEOUT = 75  # 空闲的持久连接保持这么多秒
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # 公网地址，例如 https://xxx.onrender.com；不设置则使用 Polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Telegram 推送时会带上这个值（X-Telegram-Bot-Api-Secret-Token），用来拒绝伪造的请求；默认由 Token 派生
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                405: "Method Not Allowed", 413: "Payload Too Large"}
+
+http_server = None
+webhook_app = None  # Webhook 模式下接收更新的 Application
+
+async def handle_webhook(headers: dict, body: bytes) -> tuple:
+    """把 Telegram 推送的更新放进 Application 的更新队列（立即返回，由处理器异步处理）"""
+    if headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+        return 403, b"Forbidden", "text/plain"
+    try:
+        payload = json.loads(body)
+        if not isinstance(payload, dict):
+            return 400, b"Bad Request", "text/plain"
+        update = Update.de_json(payload, webhook_app.bot)
+    except (ValueError, TypeError, AttributeError, KeyError):
+        return 400, b"Bad Request", "text/plain"
+    if update is None:
+        return 400, b"Bad Request", "text/plain"
+    await webhook_app.update_queue.put(update)
+    return 200, b"OK", "text/plain"
+
+async def http_dispatch(method: str, path: str, headers: dict, body: bytes) -> tuple:
+    """按路径分发请求，返回 (状态码, 内容, Content-Type)"""
+    if path in ("/", "/health"):
+        if method not in ("GET", "HEAD"):
+            return 405, b"Method Not Allowed", "text/plain"
+        return 200, b"OK", "text/plain"
+    if path == "/metrics":
+        if method not in ("GET", "HEAD"):
+            return 405, b"Method Not Allowed", "text/plain"
+        return 200, render_metrics().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+    if webhook_app is not None and path == WEBHOOK_PATH:
+        if method != "POST":
+            return 405, b"Method Not Allowed", "text/plain"
+        return await handle_webhook(headers, body)
+    return 404, b"Not Found", "text/plain"
+
+async def write_http_response(writer, status: int, body: bytes, content_type: str, keep_alive: bool, head: bool = False):
+    header = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+              f"Content-Type: {content_type}\r\n"
+              f"Content-Length: {len(body)}\r\n"
+              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(header.encode("latin-1") if head else header.encode("latin-1") + body)
+    await writer.drain()
+
+async def handle_http(reader, writer):
+    """处理一个连接（支持 HTTP/1.1 持久连接，Telegram 推送会复用连接）"""
+    try:
+        while True:
+            request_line = await asyncio.wait_for(reader.readline(), HTTP_KEEPALIVE_TIMEOUT)
+            if not request_line:
+                break
+            try:
+                method, target, version = request_line.decode("latin-1").split()
+            except ValueError:
+                await write_http_response(writer, 400, b"Bad Request", "text/plain", False)
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
             
-            if usdt > 0:
-                # 正数：扣除应下发
-                state["summary"]["should_send_usdt"] = trunc2(state["summary"]["should_send_usdt"] - usdt)
-                push_recent(chat_id, "out", {"ts": ts, "usdt": usdt, "type": "下发"})
-                append_log(log_path(chat_id, None, dstr), f"[下发USDT] 时间:{ts} 金额:{usdt} USDT")
-            else:
-                # 负数：增加应下发（撤销）
-                usdt_abs = trunc2(abs(usdt))  # 对绝对值也进行精度截断
-                state["summary"]["should_send_usdt"] = trunc2(state["summary"]["should_send_usdt"] + usdt_abs)
-                push_recent(chat_id, "out", {"ts": ts, "usdt": usdt, "type": "下发"})
-                append_log(log_path(chat_id, None, dstr), f"[撤销下发] 时间:{ts} 金额:{usdt_abs} USDT")
+            length = int(headers.get("content-length") or 0)
+            if length > HTTP_MAX_BODY:
+                await write_http_response(writer, 413, b"Payload Too Large", "text/plain", False)
+                break
+            body = await reader.readexactly(length) if length else b""
             
-            save_group_state(chat_id)
-            await update.message.reply_text(render_group_summary(chat_id))
-        except ValueError:
-            await update.message.reply_text("❌ 格式错误，请输入有效的数字\n例如：下发35.04 或 下发-35.04")
-        return
+            status, payload, content_type = await http_dispatch(method, target.split("?", 1)[0], headers, body)
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            await write_http_response(writer, status, payload, content_type, keep_alive, head=method == "HEAD")
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+        with contextlib.suppress(Exception):
+            await writer.wait_closed()
 
-    # 查看更多记录
-    if text in ["更多记录", "查看更多记录", "更多账单", "显示历史账单"]:
-        await update.message.reply_text(render_full_summary(chat_id))
-        return
+async def start_http_server(application):
+    global http_server, webhook_app
+    webhook_app = application if WEBHOOK_URL else None
+    http_server = await asyncio.start_server(handle_http, "0.0.0.0", HTTP_PORT)
+    print(f"✅ HTTP服务器已启动: http://0.0.0.0:{HTTP_PORT}" + (f"（Webhook: {WEBHOOK_PATH}）" if webhook_app else ""))
 
-    # 无效操作不回复
+async def stop_http_server():
+    global http_server, webhook_app
+    if http_server is not None:
+        http_server.close()
+        await http_server.wait_closed()
+        http_server = None
+    webhook_app = None
 
-# ========== HTTP健康检查服务器 ==========
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    """简单的HTTP服务器，用于Render健康检查和UptimeRobot保活"""
-    
-    def do_GET(self):
-        """处理GET请求"""
-        if self.path in ["/", "/health"]:
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"OK")
-        else:
-            self.send_response(404)
-            self.end_headers()
+# ========== 初始化函数 ==========
+async def on_startup(application):
+    """Application.post_init：启动 HTTP 服务器、后台写入和零点日切任务，并继续上次未完成的广播"""
+    await start_http_server(application)
+    await start_state_flusher(application)
+    start_rollover()
+    await resume_broadcast(application)
+
+async def on_shutdown(application):
+    """Application.post_shutdown：暂停广播（保留检查点），写出所有数据"""
+    await stop_broadcast()
+    await stop_rollover()
+    await stop_state_flusher(application)
+    await stop_http_server()
+
+async def run_webhook(application):
+    """Webhook 模式：不轮询，Telegram 把更新推送到 HTTP 服务器的 WEBHOOK_PATH（与 run_polling 相同的启动/关闭顺序）"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
     
-    def log_message(self, format, *args):
-        """禁用默认的访问日志（减少输出）"""
-        pass
+    await application.initialize()
+    try:
+        await on_startup(application)
+        await application.start()
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,  # 包含 chat_member 更新（用于刷新群成员缓存）
+            max_connections=min(100, CONCURRENT_UPDATES),
+        )
+        print(f"✅ Webhook 已设置: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        await stop.wait()
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await on_shutdown(application)
+
+# 同时处理的更新数量上限
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
 
-# ========== 初始化函数 ==========
 def init_bot():
-    """初始化Bot - Polling模式"""
+    """初始化Bot - 设置了 WEBHOOK_URL 时使用 Webhook 模式，否则使用 Polling 模式"""
     print("=" * 50)
     print("🚀 正在启动财务记账机器人...")
     print("=" * 50)
@@ -1095,30 +3706,33 @@ def init_bot():
     print(f"📊 数据目录: {DATA_DIR}")
     print(f"👑 超级管理员: {OWNER_ID or '未设置'}")
     
-    # 启动HTTP健康检查服务器（后台线程）
-    port = int(os.getenv("PORT", "10000"))
-    print(f"\n🌐 启动HTTP健康检查服务器（端口 {port}）...")
+    mode = "Webhook" if WEBHOOK_URL else "Polling"
+    print(f"\n🤖 配置 Telegram Bot ({mode}模式)...")
     
-    def run_http_server():
-        server = HTTPServer(("0.0.0.0", port), HealthCheckHandler)
-        print(f"✅ HTTP服务器已启动: http://0.0.0.0:{port}")
-        server.serve_forever()
-    
-    http_thread = threading.Thread(target=run_http_server, daemon=True)
-    http_thread.start()
-    
-    print("\n🤖 配置 Telegram Bot (Polling模式)...")
-    from telegram.ext import ApplicationBuilder
-    
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(CONCURRENT_UPDATES)  # 不同群组并行处理，同一群组由 chat_lock 保证顺序
+        .request(TimedRequest(connection_pool_size=256))  # 与默认连接池大小相同，额外记录 API 耗时
+    )
+    if WEBHOOK_URL:
+        builder = builder.updater(None)  # 更新由 HTTP 服务器接收，不需要轮询
+    application = builder.build()
     application.add_handler(CommandHandler("start", cmd_start))
+    application.add_handler(CallbackQueryHandler(handle_bill_page, pattern=r"^bill:\d+$"))
+    application.add_handler(ChatMemberHandler(handle_member_update, ChatMemberHandler.ANY_CHAT_MEMBER))
     # 支持纯文本和图片说明文字
     application.add_handler(MessageHandler((filters.TEXT | filters.CAPTION) & ~filters.COMMAND, handle_text))
     print("✅ Bot 处理器已注册")
     
     print("\n🎉 机器人正在运行，等待消息...")
     print("=" * 50)
-    application.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)  # 包含 chat_member 更新（用于刷新群成员缓存）
 
 # ========== 程序入口 ==========
 if __name__ == "__main__":
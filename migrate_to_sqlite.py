@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""把现有的 JSON 数据（data/groups/*.json、data/admins.json、data/recipients.json、data/logs/**）导入 SQLite 存储后端
+
+用法：
+    python migrate_to_sqlite.py                 # 导入到 data/bot.db（或 SQLITE_PATH）
+    python migrate_to_sqlite.py --db other.db   # 指定数据库文件
+
+导入完成后设置环境变量 STORAGE_BACKEND=sqlite 重启机器人即可。重复运行会覆盖已导入的数据。
+日志导入到 logs 表只作存档（便于用 SQL 查询历史日志），机器人运行时不读这张表，日志仍写在 data/logs 下。
+"""
+import argparse
+import json
+from pathlib import Path
+
+import bot
+
+
+def chat_id_from_name(name: str, prefix: str) -> int | None:
+    """从 group_-100123 / user_123 这样的名字中解析ID"""
+    try:
+        return int(name[len(prefix):])
+    except ValueError:
+        return None
+
+
+def migrate_groups(src: bot.JsonStorage, dst: bot.SqliteStorage) -> int:
+    chat_ids = set()
+    for path in list(bot.GROUPS_DIR.glob("group_*.json")) + list(bot.GROUPS_DIR.glob("group_*.journal")):
+        chat_id = chat_id_from_name(path.stem, "group_")
+        if chat_id is not None:
+            chat_ids.add(chat_id)
+    
+    count = 0
+    for chat_id in sorted(chat_ids):
+        state = src.load_group(chat_id)  # 快照 + 操作日志回放
+        if state is None:
+            continue
+        dst.write_group(chat_id, bot.state_to_json(state, indent=None), [])
+        count += 1
+    return count
+
+
+def rolled_order(path: Path):
+    """轮换文件按 用户 / 日期 / 序号 排序：user_1.2026-10-17.log 在 user_1.2026-10-17.2.log 之前"""
+    parts = path.name.removesuffix(".gz").split(".")
+    return parts[0], parts[1], int(parts[2]) if len(parts) > 3 else 1
+
+
+def migrate_logs(dst: bot.SqliteStorage) -> tuple[int, int]:
+    files = lines = 0
+    if not bot.LOG_DIR.exists():
+        return files, lines
+    
+    # 同一个 (范围, ID, 国家, 日期) 可能对应多个文件（压缩后又追加的 .log、按大小轮换出的私聊日志），
+    # import_log_lines 会先删除该键下的旧数据，所以按键合并后一次导入，文件按写入先后排列
+    merged = {}
+    
+    # 群组日志：data/logs/group_<id>/<国家>/<日期>.log（已压缩的为 <日期>.log.gz，压缩之后又写入的仍在 .log）
+    for group_dir in bot.LOG_DIR.glob("group_*"):
+        chat_id = chat_id_from_name(group_dir.name, "group_")
+        if chat_id is None or not group_dir.is_dir():
+            continue
+        for log_file in sorted(group_dir.glob("*/*.log.gz")) + sorted(group_dir.glob("*/*.log")):
+            key = ("group", chat_id, log_file.parent.name, log_file.name.split(".")[0])
+            merged.setdefault(key, []).append(log_file)
+    
+    # 私聊日志：data/logs/private_chats/user_<id>.log，按大小轮换出的旧文件为 user_<id>.<日期>.log[.gz]
+    private_dir = bot.LOG_DIR / "private_chats"
+    rolled = sorted(private_dir.glob("user_*.*.log")) + sorted(private_dir.glob("user_*.log.gz"))
+    rolled.sort(key=rolled_order)
+    current = [path for path in private_dir.glob("user_*.log") if path.stem.count(".") == 0]
+    for log_file in rolled + current:
+        user_id = chat_id_from_name(log_file.name.split(".")[0], "user_")
+        if user_id is not None:
+            merged.setdefault(("private", user_id, None, None), []).append(log_file)
+    
+    for (scope, chat_id, country, date), log_files in merged.items():
+        content = [line for log_file in log_files for line in bot.read_log_lines(log_file)]
+        dst.import_log_lines(scope, chat_id, country, date, content)
+        files += len(log_files)
+        lines += len(content)
+    return files, lines
+
+
+def migrate_archive(dst: bot.SqliteStorage) -> int:
+    days = 0
+    # 每日归档：data/archive/group_<id>.jsonl，每行一天
+    for path in bot.ARCHIVE_DIR.glob("group_*.jsonl"):
+        chat_id = chat_id_from_name(path.stem, "group_")
+        if chat_id is None:
+            continue
+        for line in path.read_text(encoding="utf-8").splitlines():
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            date = data.pop("date", None)
+            if date:
+                dst.archive_day(chat_id, date, data)
+                days += 1
+    return days
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把 JSON 数据导入 SQLite 存储后端")
+    parser.add_argument("--db", default=str(bot.SQLITE_PATH), help="SQLite 数据库文件路径")
+    args = parser.parse_args()
+    
+    src = bot.JsonStorage()
+    dst = bot.SqliteStorage(Path(args.db))
+    print(f"📦 导入到 {args.db} ...")
+    
+    groups = migrate_groups(src, dst)
+    print(f"✅ 群组：{groups} 个")
+    
+    admins = src.load_admins()
+    if admins is not None:
+        dst.save_admins(admins, src.load_group_admins())
+        print(f"✅ 管理员：{len(admins)} 个")
+    
+    recipients = src.load_recipients()
+    if recipients is not None:
+        dst.save_recipients(recipients)
+        print(f"✅ 私聊用户：{len(recipients)} 个")
+    
+    files, lines = migrate_logs(dst)
+    print(f"✅ 日志：{files} 个文件，{lines} 行")
+    
+    days = migrate_archive(dst)
+    print(f"✅ 每日归档：{days} 天")
+    
+    dst.close()
+    print("🎉 导入完成，设置 STORAGE_BACKEND=sqlite 后重启机器人即可使用")
+
+
+if __name__ == "__main__":
+    main()
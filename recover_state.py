@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""从日志重建群组账单，并与当前状态对比（群组状态文件丢失或损坏时使用）
+
+用法：
+    python recover_state.py                         # 检查所有群组今天的账单
+    python recover_state.py --date 2026-10-01       # 检查某一天（与每日归档的合计对比）
+    python recover_state.py --group -100123 --apply # 只处理指定群组，并把重建结果写回
+
+每个群组目录（data/logs/group_<ID>/）由进程池里的一个进程处理：优先读取当天的 JSONL 事件日志，
+没有时解析文本日志（含已压缩的 .gz），按顺序回放入金/出金/下发/撤销，得到当天的记录和汇总。
+--apply 只写回今天仍在使用的账单（重建结果沿用当前的费率/汇率设置），以前的日期只做对比；写回前请先停止机器人。
+"""
+import argparse
+import json
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import bot
+
+# 文本日志格式（与 bot.render_event_text 对应）
+TEXT_PATTERNS = [
+    ("in", re.compile(r"^\[入金\] 时间:(\S+) 国家:(\S+) 原始:([\d.]+) 汇率:([\d.]+) 费率:(-?[\d.]+)% 结果:(-?[\d.]+)")),
+    ("out", re.compile(r"^\[出金\] 时间:(\S+) 国家:(\S+) 原始:([\d.]+) 汇率:([\d.]+) 费率:(-?[\d.]+)% 下发:(-?[\d.]+)")),
+    ("send", re.compile(r"^\[下发USDT\] 时间:(\S+) 金额:(-?[\d.]+) USDT")),
+    ("send_neg", re.compile(r"^\[撤销下发\] 时间:(\S+) 金额:([\d.]+) USDT")),
+    ("undo", re.compile(r"^\[撤销(入金|出金)\] 时间:(\S+) 原金额:([\d.]+) USDT:(-?[\d.]+)")),
+    ("undo_send", re.compile(r"^\[撤销下发\] 时间:(\S+) USDT:(-?[\d.]+)")),
+]
+
+
+def chat_id_from_name(name: str, prefix: str) -> int | None:
+    """从 group_-100123 这样的名字中解析ID"""
+    try:
+        return int(name[len(prefix):])
+    except ValueError:
+        return None
+
+
+def first_existing(*paths: Path) -> Path | None:
+    for path in paths:
+        if path.exists():
+            return path
+    return None
+
+
+def read_events(group_dir: Path, date: str) -> list | None:
+    """读取当天的 JSONL 事件日志，没有时返回 None"""
+    path = first_existing(group_dir / f"{date}.jsonl", group_dir / f"{date}.jsonl.gz")
+    if path is None:
+        return None
+    events = []
+    for line in bot.read_log_lines(path):
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            continue  # 最后一行可能只写了一半
+    return events
+
+
+def read_text_events(group_dir: Path, date: str) -> list:
+    """解析当天各国家目录下的文本日志，转换成与 JSONL 相同的事件（没有记录编号）"""
+    events = []
+    for country_dir in group_dir.iterdir():
+        if not country_dir.is_dir():
+            continue
+        path = first_existing(country_dir / f"{date}.log", country_dir / f"{date}.log.gz")
+        if path is None:
+            continue
+        for line in bot.read_log_lines(path):
+            for kind, pattern in TEXT_PATTERNS:
+                m = pattern.match(line)
+                if m is None:
+                    continue
+                event = {"id": None, "amount": None, "rate": None, "fx": None, "country": None}
+                if kind in ("in", "out"):
+                    ts, country, raw, fx, rate, usdt = m.groups()
+                    event.update(ts=ts, amount=float(raw), fx=float(fx), rate=round(float(rate) / 100, 6),
+                                 usdt=float(usdt), country=None if country == "通用" else country)
+                elif kind == "send":
+                    event.update(ts=m.group(1), usdt=float(m.group(2)))
+                elif kind == "send_neg":
+                    kind = "send"
+                    event.update(ts=m.group(1), usdt=-float(m.group(2)))
+                elif kind == "undo":
+                    label, ts, raw, usdt = m.groups()
+                    kind = "undo_in" if label == "入金" else "undo_out"
+                    event.update(ts=ts, amount=float(raw), usdt=float(usdt))
+                else:
+                    event.update(ts=m.group(1), usdt=float(m.group(2)))
+                event["kind"] = kind
+                events.append(event)
+                break
+    # 不同国家的日志分在不同文件里，按时间合并（同一分钟内保持文件内顺序）
+    events.sort(key=lambda e: e["ts"])
+    return events
+
+
+def find_record(state: dict, kind: str, event: dict) -> int | None:
+    """文本日志里的撤销没有记录编号：找最近一笔金额相同的记录"""
+    direction = "in" if kind == "in" else "out"
+    for item in state["recent"][direction]:
+        if bot.record_kind(direction, item) != kind or item.usdt != event["usdt"]:
+            continue
+        if kind != "send" and item.raw != event["amount"]:
+            continue
+        return item.id
+    return None
+
+
+def event_to_op(state: dict, event: dict) -> dict | None:
+    """把一条账本事件转换成 bot.apply_ledger_op 使用的操作"""
+    kind, ts = event["kind"], event["ts"][11:16] if "T" in event["ts"] else event["ts"]
+    index = bot.ensure_record_index(state)
+    logged_id = event["id"]
+    if logged_id is not None:
+        # 之后没有编号的记录从日志里出现过的最大编号之后开始编号，不会和日志中的编号重复
+        index["next_id"] = max(index["next_id"], logged_id + 1)
+    if kind in ("in", "out"):
+        params = {"fx": event["fx"], "rate": event["rate"]}
+        item = bot.new_ledger_item(ts, event["amount"], event["usdt"], event["country"], params)
+    elif kind == "send":
+        item = bot.new_send_item(ts, event["usdt"])
+    else:
+        target = kind[len("undo_"):]
+        record_id = logged_id if logged_id is not None else find_record(state, target, event)
+        if record_id is not None and record_id in index["by_id"]:
+            return {"op": "undo", "id": record_id}
+        # 找不到对应记录时和旧版撤销一样只调整汇总
+        if kind == "undo_in":
+            return {"op": "undo_in", "raw": event["amount"], "usdt": event["usdt"]}
+        if kind == "undo_send":
+            return {"op": "undo_send", "usdt": event["usdt"]}
+        return None
+    if logged_id is not None and logged_id not in index["by_id"]:
+        item["id"] = logged_id  # 编号已被占用（重复的日志行）时由 add_record 另行编号
+    return {"op": kind, "item": item}
+
+
+def rebuild_group(group_dir: str, date: str) -> tuple:
+    """（在子进程中运行）从一个群组目录的日志重建当天账单，返回 (群ID, 来源, 事件数, 记录和汇总)"""
+    group_dir = Path(group_dir)
+    chat_id = chat_id_from_name(group_dir.name, "group_")
+    events = read_events(group_dir, date)
+    source = "jsonl"
+    if events is None:
+        events, source = read_text_events(group_dir, date), "text"
+
+    state = bot.get_default_state()
+    for event in events:
+        op = event_to_op(state, event)
+        if op is not None:
+            bot.apply_ledger_op(state, op)
+    data = {"recent": state["recent"], "summary": state["summary"]}
+    return chat_id, source, len(events), bot.state_to_json(data, indent=None)
+
+
+def record_keys(state: dict) -> Counter:
+    keys = Counter()
+    for direction in ("in", "out"):
+        for item in state["recent"][direction]:
+            keys[(bot.record_kind(direction, item), item.ts, item.raw, item.usdt, item.country)] += 1
+    return keys
+
+
+def describe_key(key: tuple) -> str:
+    kind, ts, raw, usdt, country = key
+    if kind == "send":
+        return f"{ts} 下发 {usdt} USDT"
+    label = "入金" if kind == "in" else "出金"
+    return f"{ts} {label} {raw} / {country or '通用'} → {usdt} USDT"
+
+
+def diff_totals(rebuilt: dict, current: dict) -> list:
+    lines = []
+    for key, label in (("should_send_usdt", "应下发"), ("sent_usdt", "已下发")):
+        a, b = rebuilt["summary"].get(key, 0.0), current["summary"].get(key, 0.0)
+        if a != b:
+            lines.append(f"{label}：当前 {b} → 日志 {a}")
+    for key, label in (("in", "入金"), ("out", "出金"), ("send", "下发")):
+        a, b = rebuilt["count"].get(key, 0), current.get("count", {}).get(key, 0)
+        if a != b:
+            lines.append(f"{label}笔数：当前 {b} → 日志 {a}")
+    return lines
+
+
+def diff_records(rebuilt: dict, current: dict) -> list:
+    a, b = record_keys(rebuilt), record_keys(current)
+    lines = [f"缺少：{describe_key(key)}" for key in sorted((a - b).elements())]
+    lines += [f"多出：{describe_key(key)}" for key in sorted((b - a).elements())]
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="从日志重建群组账单并与当前状态对比")
+    parser.add_argument("--date", default=bot.today_str(), help="要重建的日期（默认今天）")
+    parser.add_argument("--group", type=int, action="append", help="只处理指定群组（可重复）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="进程数（默认 CPU 核数）")
+    parser.add_argument("--apply", action="store_true", help="把重建结果写回当天的群组状态")
+    args = parser.parse_args()
+    if args.apply and args.date != bot.today_str():
+        # 只有今天的账单还在群组状态里；以前的日期已经日切归档，写回会把旧账单当成当前账单再归档一次
+        parser.error("--apply 只能用于今天的账单")
+
+    group_dirs = [
+        path for path in sorted(bot.LOG_DIR.glob("group_*"))
+        if path.is_dir() and chat_id_from_name(path.name, "group_") is not None
+        and (args.group is None or chat_id_from_name(path.name, "group_") in args.group)
+    ]
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        results = list(pool.map(rebuild_group, map(str, group_dirs), [args.date] * len(group_dirs)))
+
+    storage = bot.storage
+    changed = applied = 0
+    for chat_id, source, count, rebuilt_json in results:
+        if count == 0:
+            continue
+        rebuilt = bot.compact_records(json.loads(rebuilt_json))
+        rebuilt_totals = bot.day_archive_data(rebuilt)
+        live = storage.load_group(chat_id)
+        if live is not None and live.get("last_date") == args.date:
+            current = bot.day_archive_data(live)
+            problems = diff_totals(rebuilt_totals, current) + diff_records(rebuilt, live)
+            target = "当前账单"
+        elif live is None and args.date == bot.today_str():
+            problems = ["群组状态不存在或无法读取"] + diff_totals(rebuilt_totals, {"summary": {}})
+            target = "当前账单"
+        else:
+            days = storage.query_days(chat_id, args.date, args.date)
+            current = days[0][1] if days else {"summary": {}}
+            problems = diff_totals(rebuilt_totals, current)
+            if not days:
+                problems.insert(0, "没有这一天的归档")
+            target = "每日归档"
+
+        if not problems:
+            print(f"✅ 群组 {chat_id}：与{target}一致（{source}，{count} 条事件）")
+            continue
+        changed += 1
+        print(f"⚠️ 群组 {chat_id}：与{target}不一致（{source}，{count} 条事件）")
+        for line in problems:
+            print(f"    {line}")
+
+        if args.apply and target == "当前账单":
+            # 沿用当前的费率/汇率等设置，只替换当天的记录和汇总；写快照会同时清空操作日志
+            state = live or bot.get_default_state()
+            state["recent"], state["summary"] = rebuilt["recent"], rebuilt["summary"]
+            state["last_date"] = args.date
+            storage.write_group(chat_id, bot.state_to_json(state), [])
+            applied += 1
+            print("    ✏️ 已写回" + ("（费率/汇率设置无法从日志恢复，请重新设置）" if live is None else ""))
+
+    storage.close()
+    print(f"🎉 共检查 {len(results)} 个群组，{changed} 个不一致，写回 {applied} 个，用时 {time.monotonic() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import asyncio
+import importlib
+import itertools
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """在临时目录里使用 bot 模块（数据目录都是相对路径），并清空内存中的群组状态和写入缓冲"""
+    monkeypatch.chdir(tmp_path)
+    module = importlib.import_module("bot")
+    for path in (module.DATA_DIR, module.GROUPS_DIR, module.LOG_DIR, module.ARCHIVE_DIR):
+        path.mkdir(parents=True, exist_ok=True)
+    cache = module.GroupStateCache(module.GROUP_CACHE_MAX_ENTRIES, module.GROUP_CACHE_MAX_BYTES)
+    cache.on_evict = module.write_back_group
+    monkeypatch.setattr(module, "groups_state", cache)
+    monkeypatch.setattr(module, "journal_counts", {})
+    monkeypatch.setattr(module, "pending_ops", {})
+    monkeypatch.setattr(module, "dirty_groups", set())
+    monkeypatch.setattr(module, "recipients", None)
+    monkeypatch.setattr(module, "dirty_recipients", set())
+    monkeypatch.setattr(module, "storage", module.JsonStorage())
+    yield module
+    module.wait_io()
+    module.storage.close()
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, bot, monkeypatch):
+    """分别用两种存储后端运行"""
+    monkeypatch.setattr(bot, "storage", bot.create_storage(request.param))
+    return bot.storage
+
+
+@pytest.fixture
+def reopen(bot):
+    """丢掉缓存并重新打开存储后端（模拟重启），返回重新加载群组的函数"""
+    def reload_group(chat_id: int) -> dict:
+        bot.wait_io()
+        bot.storage.close()
+        bot.storage = bot.create_storage(bot.storage.name)
+        bot.groups_state = bot.GroupStateCache(bot.GROUP_CACHE_MAX_ENTRIES, bot.GROUP_CACHE_MAX_BYTES)
+        bot.groups_state.on_evict = bot.write_back_group
+        return bot.load_group_state(chat_id)
+    return reload_group
+
+
+class FakeMessage:
+    """只实现处理器用到的属性：文本、发送者、回复"""
+    ids = itertools.count(1000)
+    
+    def __init__(self, text, chat, user, reply_to_message=None):
+        self.text, self.caption, self.chat, self.from_user = text, None, chat, user
+        self.reply_to_message = reply_to_message
+        self.message_id = next(self.ids)
+        self.replies = []
+    
+    async def reply_text(self, text, **kwargs):
+        reply = FakeMessage(text, self.chat, SimpleNamespace(id=0, is_bot=True))
+        reply.reply_markup = kwargs.get("reply_markup")
+        self.replies.append(reply)
+        return reply
+
+
+@pytest.fixture
+def send(bot, monkeypatch):
+    """以管理员身份向群组发一条消息，返回这条消息（机器人的回复在 .replies 里）；不写日志文件"""
+    monkeypatch.setattr(bot, "is_admin", lambda user_id, chat_id=None: True)
+    monkeypatch.setattr(bot, "log_event", lambda event: None)
+    monkeypatch.setattr(bot, "append_log", lambda path, text: None)
+    
+    def send_message(text: str, chat_id: int = -100, user_id: int = 1, reply_to=None) -> FakeMessage:
+        user = SimpleNamespace(id=user_id, is_bot=False, full_name=f"user{user_id}", username=None)
+        chat = SimpleNamespace(id=chat_id, type="group")
+        message = FakeMessage(text, chat, user, reply_to)
+        update = SimpleNamespace(message=message, effective_user=user, effective_chat=chat)
+        asyncio.run(bot.handle_text(update, SimpleNamespace(bot=None, bot_data={})))
+        return message
+    return send_message
@@ -0,0 +1,106 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeBot:
+    """记录发出的广播；发给 block_on 时一直挂起（模拟广播中途被停止）"""
+
+    def __init__(self, block_on=None):
+        self.sent = []
+        self.block_on = block_on
+        self.blocked = asyncio.Event()
+
+    async def send_message(self, chat_id, text):
+        if chat_id == self.block_on:
+            self.blocked.set()
+            await asyncio.Event().wait()
+        self.sent.append(chat_id)
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        pass
+
+
+@pytest.fixture
+def clock(bot, monkeypatch):
+    """让令牌桶使用假时钟：sleep 直接把时钟往前拨"""
+    now = [0.0]
+
+    async def sleep(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(bot, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    monkeypatch.setattr(bot, "asyncio", SimpleNamespace(sleep=sleep))
+    return now
+
+
+def test_token_bucket_paces_to_rate(bot, clock):
+    bucket = bot.TokenBucket(4)
+
+    async def drain():
+        for _ in range(12):
+            await bucket.acquire()
+
+    asyncio.run(drain())
+    # 前 4 个令牌立即可用，其余 8 个按每秒 4 个补充
+    assert clock[0] == pytest.approx(2.0)
+
+
+def test_token_bucket_pause_holds_every_request(bot, clock):
+    bucket = bot.TokenBucket(4)
+    bucket.pause(3)
+
+    async def take():
+        await bucket.acquire()
+
+    asyncio.run(take())
+    # 暂停结束后令牌从零开始补充，第一个请求还要再等一个令牌的时间
+    assert clock[0] == pytest.approx(3.25)
+
+
+def test_broadcast_resumes_from_checkpoint(bot, monkeypatch):
+    monkeypatch.setattr(bot, "BROADCAST_CONCURRENCY", 1)
+    monkeypatch.setattr(bot, "broadcast_job", None)
+    monkeypatch.setattr(bot, "broadcast_task", None)
+    recipients = [11, 12, 13, 14, 15]
+
+    async def interrupted():
+        fake = FakeBot(block_on=13)
+        bot.start_broadcast(bot.BroadcastJob(fake, "维护通知", recipients, status_chat=1))
+        await fake.blocked.wait()
+        await bot.stop_broadcast()
+        return fake.sent
+
+    assert asyncio.run(interrupted()) == [11, 12]
+    data = bot.read_broadcast_checkpoint()
+    assert data["sent"] == [11, 12] and data["recipients"] == recipients and data["text"] == "维护通知"
+
+    async def resumed():
+        fake = FakeBot()
+        await bot.resume_broadcast(SimpleNamespace(bot=fake))
+        await bot.broadcast_task
+        return fake.sent
+
+    # 重启后只发送还没发过的用户，完成后删除检查点
+    assert asyncio.run(resumed()) == [13, 14, 15]
+    bot.wait_io()
+    assert bot.read_broadcast_checkpoint() is None
+    assert bot.broadcast_job.sent == set(recipients)
+
+
+def test_stop_with_discard_drops_checkpoint(bot, monkeypatch):
+    monkeypatch.setattr(bot, "BROADCAST_CONCURRENCY", 1)
+    monkeypatch.setattr(bot, "broadcast_job", None)
+    monkeypatch.setattr(bot, "broadcast_task", None)
+
+    async def run():
+        fake = FakeBot(block_on=22)
+        bot.start_broadcast(bot.BroadcastJob(fake, "通知", [21, 22, 23], status_chat=1))
+        await fake.blocked.wait()
+        await bot.stop_broadcast(discard=True)
+        await bot.resume_broadcast(SimpleNamespace(bot=FakeBot()))
+
+    asyncio.run(run())
+    assert bot.read_broadcast_checkpoint() is None
+    assert not bot.broadcast_running()
@@ -0,0 +1,76 @@
+CHATS = [-2001, -2002, -2003, -2004, -2005]
+
+
+def setup_groups(send):
+    for chat_id in CHATS:
+        send("设置入金汇率 7", chat_id)
+
+
+def test_one_lookup_per_message(bot, send):
+    setup_groups(send)
+    cache = bot.groups_state
+    before = cache.hits + cache.misses
+    message = send("+100", CHATS[0])
+    assert message.replies  # 真的处理了（记账并回复汇总）
+    assert cache.hits + cache.misses == before + 1
+
+    send("你好", CHATS[0])  # 不是命令，不查缓存
+    assert cache.hits + cache.misses == before + 1
+
+
+def test_hit_rate_reflects_cold_loads(bot, send, monkeypatch):
+    cache = bot.GroupStateCache(max_entries=2)
+    cache.on_evict = bot.write_back_group
+    monkeypatch.setattr(bot, "groups_state", cache)
+    setup_groups(send)
+    for _ in range(2):
+        for chat_id in CHATS:
+            send("+100", chat_id)
+
+    # 15 条消息，缓存只放得下 2 个群组，轮流访问 5 个群组时每次都要从存储加载
+    assert (cache.hits, cache.misses) == (0, 15)
+    assert cache.stats()["hit_rate"] == 0.0
+    assert 'bot_cache_lookups_total{cache="group_state",result="miss"} 15' in bot.render_metrics()
+
+
+def deposit(bot, chat_id: int, raw: float):
+    bot.commit_op(chat_id, {"op": "in", "item": bot.new_ledger_item("10:00", raw, raw / 10, None, {"fx": 7.0, "rate": 0.1})})
+
+
+def test_byte_budget_evicts_lru_and_writes_back(bot, backend, reopen, monkeypatch):
+    monkeypatch.setattr(bot, "flusher_task", object())  # 后台刷新任务"在运行"：操作留在待写缓冲里
+    budget = 2 * bot.GroupStateCache.BASE_BYTES + 4 * bot.GroupStateCache.RECORD_BYTES
+    cache = bot.GroupStateCache(max_bytes=budget)
+    cache.on_evict = bot.write_back_group
+    monkeypatch.setattr(bot, "groups_state", cache)
+    a, b, c = CHATS[:3]
+    for chat_id in (a, b):
+        bot.load_group_state(chat_id)
+        deposit(bot, chat_id, 100)
+        deposit(bot, chat_id, 200)
+    assert cache.total_bytes == budget and cache.evictions == 0
+    assert a in bot.pending_ops
+
+    bot.load_group_state(c)  # 超出字节预算：淘汰最久未使用的 a，并把它的待写操作提交
+    assert a not in cache and b in cache and c in cache
+    assert cache.evictions == 1 and cache.total_bytes <= budget
+    assert a not in bot.pending_ops and b in bot.pending_ops
+
+    state = reopen(a)
+    assert [r.raw for r in state["recent"]["in"]] == [200, 100]
+    assert state["summary"]["should_send_usdt"] == 30.0
+
+
+def test_byte_budget_skips_pinned_groups(bot, monkeypatch):
+    monkeypatch.setattr(bot, "flusher_task", object())
+    cache = bot.GroupStateCache(max_bytes=2 * bot.GroupStateCache.BASE_BYTES)
+    cache.on_evict = bot.write_back_group
+    monkeypatch.setattr(bot, "groups_state", cache)
+    a, b, c = CHATS[:3]
+    bot.load_group_state(a)
+    bot.load_group_state(b)
+    cache.pinned.add(a)  # a 正在处理消息，不能淘汰
+
+    bot.load_group_state(c)
+    assert a in cache and b not in cache and c in cache
+    assert cache.evictions == 1
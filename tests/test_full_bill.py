@@ -0,0 +1,79 @@
+import asyncio
+from types import SimpleNamespace
+
+CHAT = -4001
+PARAMS = {"fx": 7.0, "rate": 0.1}
+
+
+def fill(bot, n_in: int, n_out: int = 0, n_send: int = 0):
+    """记 n_in 笔入金、n_out 笔出金、n_send 笔下发，金额 50001 起各不相同"""
+    bot.load_group_state(CHAT)
+    bot.commit_op(CHAT, {"op": "set", "scope": "默认", "direction": "in", "key": "fx", "value": 7.0})
+    amounts = iter(range(50001, 60000))
+    for _ in range(n_in):
+        bot.commit_op(CHAT, {"op": "in", "item": bot.new_ledger_item("10:00", next(amounts), 1.0, None, PARAMS)})
+    for _ in range(n_out):
+        bot.commit_op(CHAT, {"op": "out", "item": bot.new_ledger_item("11:00", next(amounts), 1.0, None, PARAMS)})
+    for _ in range(n_send):
+        bot.commit_op(CHAT, {"op": "send", "item": bot.new_send_item("12:00", next(amounts) / 100)})
+    return list(range(50001, 50001 + n_in + n_out + n_send))
+
+
+def buttons(markup) -> list:
+    return [] if markup is None else [b.callback_data for row in markup.inline_keyboard for b in row]
+
+
+def test_split_message_respects_limit(bot):
+    text = "\n".join(f"line {i}" for i in range(2000))
+    chunks = bot.split_message(text, 100)
+    assert all(len(c) <= 100 for c in chunks)
+    assert "\n".join(chunks) == text
+    assert bot.split_message("x" * 250, 100) == ["x" * 100, "x" * 100, "x" * 50]
+    assert bot.split_message("short") == ["short"]
+
+
+def test_pages_cover_every_record_once(bot):
+    amounts = fill(bot, 60, 30, 10)
+    pages = [bot.render_full_summary(CHAT, page) for page in (1, 2, 3)]
+    assert {n for _, n in pages} == {3}
+    for amount in amounts[:90]:
+        label = str(amount)
+        assert sum(label in text for text, _ in pages) == 1, label
+    assert sum(f"{amounts[-1] / 100}" in text for text, _ in pages) == 1
+    assert "「更多记录 2」" in pages[0][0] and "更多记录" not in pages[2][0]
+    assert bot.render_full_summary(CHAT, 9) == pages[2]  # 超出范围时显示最后一页
+
+
+def test_full_bill_command_puts_keyboard_on_last_message(bot, send):
+    fill(bot, 100)
+    message = send("更多记录 2", CHAT)
+    [reply] = message.replies
+    assert reply.text.startswith("📊") and "第 2/3 页" in reply.text
+    assert buttons(reply.reply_markup) == ["bill:1", "bill:2", "bill:3"]
+
+
+def test_page_button_splits_long_page(bot, monkeypatch):
+    monkeypatch.setattr(bot, "FULL_BILL_PAGE_SIZE", 300)
+    fill(bot, 400)
+    edited, replies = [], []
+
+    async def reply_text(text, reply_markup=None):
+        replies.append((text, reply_markup))
+
+    async def edit_message_text(text, reply_markup=None):
+        edited.append((text, reply_markup))
+
+    async def answer():
+        pass
+
+    query = SimpleNamespace(data="bill:1", answer=answer, edit_message_text=edit_message_text,
+                            message=SimpleNamespace(chat=SimpleNamespace(id=CHAT), reply_text=reply_text))
+    asyncio.run(bot.handle_bill_page(SimpleNamespace(callback_query=query), None))
+
+    text, pages = bot.render_full_summary(CHAT, 1)
+    sent = edited + replies
+    assert pages == 2 and len(sent) > 1
+    assert all(len(chunk) <= bot.TELEGRAM_MAX_MESSAGE for chunk, _ in sent)
+    assert "\n".join(chunk for chunk, _ in sent) == text
+    assert [buttons(markup) for _, markup in sent[:-1]] == [[]] * (len(sent) - 1)
+    assert buttons(sent[-1][1]) == ["bill:1", "bill:2"]
@@ -0,0 +1,66 @@
+CHAT = -1004
+
+
+def day(country: str | None, usdt: float) -> dict:
+    data = {"summary": {"should_send_usdt": usdt, "sent_usdt": 0.0}, "count": {"in": 1, "out": 0, "send": 0},
+            "raw": {"in": 100.0, "out": 0.0}, "usdt": {"in": usdt, "out": 0.0, "send": 0.0}, "countries": {},
+            "in": [], "out": []}
+    if country:
+        data["countries"][country] = {"in": {"count": 1, "raw": 100.0, "usdt": usdt}}
+    return data
+
+
+def archive(storage):
+    storage.archive_day(CHAT, "2026-10-01", day("美国", 1.0))
+    storage.archive_day(CHAT, "2026-10-02", day("日本", 2.0))
+    storage.archive_day(CHAT, "2026-10-05", day("美国", 5.0))
+
+
+def test_query_days_by_range(bot, backend):
+    archive(backend)
+    days = backend.query_days(CHAT, "2026-10-02", "2026-10-31")
+    assert [d for d, _ in days] == ["2026-10-02", "2026-10-05"]
+    assert days[1][1]["summary"]["should_send_usdt"] == 5.0
+    assert "in" not in days[1][1]  # 只返回合计，不含记录
+    assert backend.query_days(CHAT, "2026-09-01", "2026-09-30") == []
+    assert backend.query_days(-1, "2026-10-01", "2026-10-31") == []
+
+
+def test_query_days_by_country(bot, backend):
+    archive(backend)
+    assert [d for d, _ in backend.query_days(CHAT, "2026-10-01", "2026-10-31", "美国")] == ["2026-10-01", "2026-10-05"]
+    assert [d for d, _ in backend.query_days(CHAT, "2026-10-02", "2026-10-04", "美国")] == []
+    assert backend.query_days(CHAT, "2026-10-01", "2026-10-31", "英国") == []
+
+
+def test_json_index_rebuilt_from_archive(bot):
+    archive(bot.storage)
+    bot.storage.archive_index_path(CHAT).unlink()
+    days = bot.JsonStorage().query_days(CHAT, "2026-10-01", "2026-10-31", "日本")
+    assert days == [("2026-10-02", bot.day_totals(day("日本", 2.0)))]
+
+
+def test_today_appended_from_memory(bot):
+    today = bot.today_str()
+    bot.load_group_state(CHAT)
+    bot.commit_op(CHAT, {"op": "day", "date": today})
+    bot.commit_op(CHAT, {"op": "in", "item": bot.new_ledger_item("09:00", 100, 12.85, "美国", {"fx": 7.0, "rate": 0.1})})
+
+    days = bot.add_today_totals(CHAT, [], "2026-01-01", today)
+    assert [d for d, _ in days] == [today]
+    assert days[0][1]["summary"]["should_send_usdt"] == 12.85
+    assert bot.add_today_totals(CHAT, [], "2026-01-01", today, "日本") == []
+
+
+def test_json_day_index_dropped_with_group_eviction(bot, monkeypatch):
+    cache = bot.GroupStateCache(max_entries=1)
+    cache.on_evict = bot.write_back_group
+    monkeypatch.setattr(bot, "groups_state", cache)
+    archive(bot.storage)
+    bot.load_group_state(CHAT)
+    assert CHAT in bot.storage.day_indexes
+
+    bot.load_group_state(CHAT - 1)  # 挤掉 CHAT
+    bot.wait_io()
+    assert CHAT not in cache and CHAT not in bot.storage.day_indexes
+    assert [d for d, _ in bot.storage.query_days(CHAT, "2026-10-01", "2026-10-31")] == ["2026-10-01", "2026-10-02", "2026-10-05"]
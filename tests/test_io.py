@@ -0,0 +1,36 @@
+import asyncio
+import threading
+import time
+
+
+def test_same_key_runs_in_order(bot):
+    done = []
+    for i in range(5):
+        # 先提交的任务睡得更久，同一 key 仍按提交顺序完成
+        bot.submit_io("k", lambda i=i: (time.sleep(0.02 * (5 - i)), done.append(i)))
+    bot.wait_io("k")
+    assert done == [0, 1, 2, 3, 4]
+
+
+def test_different_keys_run_in_parallel(bot):
+    started = threading.Barrier(2, timeout=5)
+    futures = [bot.submit_io(key, started.wait) for key in ("a", "b")]
+    bot.wait_io()
+    assert all(f.exception() is None for f in futures)
+
+
+def test_failed_task_does_not_block_key(bot):
+    def fail():
+        raise OSError("disk full")
+
+    bot.submit_io("k", fail)
+    assert asyncio.run(bot.run_io("k", lambda: "ok")) == "ok"
+
+
+def test_load_waits_for_pending_write(bot):
+    chat_id = -1005
+    op = {"seq": 1, "op": "day", "date": "2026-10-01"}
+    bot.submit_io(chat_id, lambda: (time.sleep(0.05), bot.storage.write_group(chat_id, None, [op])))
+
+    state = asyncio.run(bot.aload_group_state(chat_id))
+    assert state["last_date"] == "2026-10-01"
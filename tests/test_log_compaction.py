@@ -0,0 +1,134 @@
+import gzip
+import os
+import time
+
+
+def write_log(path, minutes) -> list:
+    lines = [f"[10:{m:02d}] 入金 {m}\n" for m in minutes]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("".join(lines), encoding="utf-8")
+    return lines
+
+
+def test_range_read_only_decompresses_matching_blocks(bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "LOG_COMPACT_BLOCK", 60)  # 每块三四行
+    path = tmp_path / "2026-10-01.log"
+    lines = write_log(path, range(30))
+    raw, packed = bot.compact_log(path, "2026-10-01")
+
+    archive = bot.log_archive_path(path)
+    assert not path.exists() and raw == len("".join(lines).encode("utf-8")) and packed == archive.stat().st_size
+    blocks = bot.load_log_index(archive)["blocks"]
+    assert len(blocks) > 5 and sum(b["lines"] for b in blocks) == 30
+
+    decompressed, decompress = [], gzip.decompress
+    monkeypatch.setattr(gzip, "decompress", lambda data: decompressed.append(data) or decompress(data))
+    selected = list(bot.read_log_blocks(archive, "2026-10-01 10:12", "2026-10-01 10:14"))
+    assert set(lines[12:15]) <= set(selected)
+    assert len(selected) < 10 and len(decompressed) < len(blocks)
+
+    assert list(bot.read_log_blocks(archive)) == lines
+    with gzip.open(archive, "rt", encoding="utf-8") as f:
+        assert f.readlines() == lines  # 整个文件仍是合法的 gzip
+
+
+def test_private_log_across_midnight_is_not_filtered(bot, monkeypatch):
+    monkeypatch.setattr(bot, "LOG_COMPACT_BLOCK", 30)
+    path = bot.LOG_DIR / "private_chats" / "user_7.2026-10-02.log"
+    path.parent.mkdir(parents=True)
+    lines = [f"[{t}] user7 (@N/A): hi\n" for t in ("23:58", "23:59", "00:01", "00:02", "09:00")]
+    path.write_text("".join(lines), encoding="utf-8")
+    bot.compact_log(path, "2026-10-02")
+
+    archive = bot.log_archive_path(path)
+    assert all(b["first"] is None for b in bot.load_log_index(archive)["blocks"])
+    assert list(bot.read_log_blocks(archive, "2026-10-01 23:58", "2026-10-01 23:59")) == lines
+
+
+def test_event_log_block_range_covers_lines_after_midnight(bot, monkeypatch):
+    monkeypatch.setattr(bot, "LOG_COMPACT_BLOCK", 80)
+    path = bot.LOG_DIR / "group_-1006" / "2026-10-01.jsonl"
+    path.parent.mkdir(parents=True)
+    # 账本日期 10-01 的最后几笔在零点之后才记（日切之前）
+    lines = [f'{{"ts":"2026-10-01T{t}+08:00","kind":"in"}}\n' for t in ("23:58", "00:01", "23:59", "00:02")]
+    path.write_text("".join(lines), encoding="utf-8")
+    bot.compact_log(path, "2026-10-01")
+
+    archive = bot.log_archive_path(path)
+    blocks = bot.load_log_index(archive)["blocks"]
+    assert all(b["first"] <= b["last"] for b in blocks)
+    assert set(bot.read_log_blocks(archive, "2026-10-01 00:00", "2026-10-01 00:01")) >= {lines[1]}
+    assert set(bot.read_log_blocks(archive, "2026-10-01 23:59", "2026-10-01 23:59")) >= {lines[2]}
+    assert list(bot.read_log_blocks(archive, "2026-10-02 00:00", "2026-10-02 23:59")) == []
+
+
+def test_legacy_time_only_index_reads_everything(bot, tmp_path):
+    path = tmp_path / "2026-10-01.log"
+    lines = write_log(path, range(10))
+    bot.compact_log(path, "2026-10-01")
+    archive = bot.log_archive_path(path)
+    index = bot.load_log_index(archive)
+    for block in index["blocks"]:
+        block["first"], block["last"] = block["first"][-5:], block["last"][-5:]
+    bot.log_index_path(archive).write_text(bot.json.dumps(index), encoding="utf-8")
+
+    assert list(bot.read_log_blocks(archive, "2026-10-01 23:00", "2026-10-01 23:59")) == lines
+
+
+def test_compacting_again_appends_blocks(bot, tmp_path):
+    path = tmp_path / "2026-10-01.log"
+    first = write_log(path, range(0, 5))
+    bot.compact_log(path, "2026-10-01")
+    second = write_log(path, range(5, 10))
+    bot.compact_log(path, "2026-10-01")
+
+    archive = bot.log_archive_path(path)
+    assert len(bot.load_log_index(archive)["blocks"]) == 2
+    assert bot.read_log_lines(archive) == [line.rstrip("\n") for line in first + second]
+
+
+def test_missing_index_falls_back_to_full_read(bot, tmp_path):
+    path = tmp_path / "2026-10-01.log"
+    lines = write_log(path, range(10))
+    bot.compact_log(path, "2026-10-01")
+    archive = bot.log_archive_path(path)
+    bot.log_index_path(archive).unlink()
+
+    assert list(bot.read_log_blocks(archive, "2026-10-01 10:05", "2026-10-01 10:05")) == lines
+
+
+def test_compact_logs_skips_today_and_recent_files(bot, monkeypatch):
+    today = bot.today_str()
+    group_dir = bot.LOG_DIR / "group_-1006" / "美国"
+    old, recent, current = (group_dir / "2026-10-01.log", group_dir / "2026-10-02.log", group_dir / f"{today}.log")
+    for path in (old, recent, current):
+        write_log(path, range(3))
+    stale = time.time() - bot.LOG_COMPACT_GRACE - 60
+    os.utime(old, (stale, stale))
+
+    files, _, _ = bot.compact_logs()
+    assert files == 1
+    assert bot.log_archive_path(old).exists() and not old.exists()
+    assert recent.exists() and current.exists()
+
+
+def test_migration_keeps_compacted_and_rolled_logs(bot):
+    import migrate_to_sqlite
+
+    group_log = bot.LOG_DIR / "group_-1006" / "美国" / "2026-10-01.log"
+    write_log(group_log, range(0, 3))
+    bot.compact_log(group_log, "2026-10-01")
+    write_log(group_log, range(3, 5))  # 压缩之后又写入的
+    private_dir = bot.LOG_DIR / "private_chats"
+    rolled = private_dir / "user_7.2026-10-01.log"
+    write_log(rolled, range(0, 4))
+    bot.compact_log(rolled, "2026-10-01")
+    write_log(private_dir / "user_7.2026-10-01.2.log", range(4, 6))
+    write_log(private_dir / "user_7.log", range(6, 7))
+
+    dst = bot.SqliteStorage(bot.DATA_DIR / "migrated.db")
+    assert migrate_to_sqlite.migrate_logs(dst) == (5, 12)
+    rows = dst.conn.execute("SELECT scope, chat_id, line FROM logs ORDER BY id").fetchall()
+    dst.close()
+    assert [line for scope, _, line in rows if scope == "group"] == [f"[10:{m:02d}] 入金 {m}" for m in range(5)]
+    assert [line for scope, _, line in rows if scope == "private"] == [f"[10:{m:02d}] 入金 {m}" for m in range(7)]
@@ -0,0 +1,35 @@
+def test_writes_lines_in_order_with_bounded_handles(bot, tmp_path):
+    writer = bot.LogWriter(max_open=2, interval=0.01)
+    paths = [tmp_path / "logs" / f"{name}.log" for name in ("a", "b", "c")]
+    for i in range(30):
+        writer.write(paths[i % 3], f"line {i}\n")
+    writer.flush()
+    assert len(writer.handles) <= 2
+    writer.close()
+
+    for n, path in enumerate(paths):
+        assert path.read_text(encoding="utf-8").splitlines() == [f"line {i}" for i in range(n, 30, 3)]
+
+
+def test_release_closes_handles(bot, tmp_path):
+    writer = bot.LogWriter(interval=0.01)
+    writer.write(tmp_path / "a.log", "hello")
+    writer.release()
+    assert writer.handles == {}
+    writer.write(tmp_path / "a.log", "again")
+    writer.close()
+    assert (tmp_path / "a.log").read_text(encoding="utf-8") == "hello\nagain\n"
+
+
+def test_private_log_rolls_by_size(bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "PRIVATE_LOG_MAX_BYTES", 15)
+    writer = bot.LogWriter(interval=0.01)
+    path = tmp_path / "private_chats" / "user_1.log"
+    writer.write(path, "0123456789abcdef")
+    writer.flush()
+    writer.write(path, "x")
+    writer.close()
+
+    rolled = path.with_name(f"user_1.{bot.today_str()}.log")
+    assert rolled.read_text(encoding="utf-8") == "0123456789abcdef\n"
+    assert path.read_text(encoding="utf-8") == "x\n"
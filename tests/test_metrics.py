@@ -0,0 +1,44 @@
+import pytest
+
+
+def written(bot) -> dict:
+    return {key[0]: value for key, value in bot.STATE_BYTES_WRITTEN.values.items()}
+
+
+def test_json_bytes_match_files(bot, monkeypatch):
+    monkeypatch.setattr(bot.STATE_BYTES_WRITTEN, "values", {})
+    chat_id = -3001
+    bot.load_group_state(chat_id)  # 新群组写一次快照
+    snapshot = bot.group_file_path(chat_id).stat().st_size
+    for i in range(3):
+        bot.commit_op(chat_id, {"op": "in", "item": bot.new_ledger_item("10:00", 100 + i, 1.0, "美国", {"fx": 7.0, "rate": 0.1})})
+
+    assert written(bot) == {"snapshot": snapshot, "journal": bot.group_journal_path(chat_id).stat().st_size}
+
+
+@pytest.fixture
+def backend(bot, monkeypatch):
+    """只用 sqlite 后端"""
+    monkeypatch.setattr(bot, "storage", bot.create_storage("sqlite"))
+    return bot.storage
+
+
+def test_sqlite_bytes_are_wal_growth(bot, backend, monkeypatch):
+    monkeypatch.setattr(bot.STATE_BYTES_WRITTEN, "values", {})
+    chat_id = -3002
+    bot.load_group_state(chat_id)
+    bot.commit_op(chat_id, {"op": "in", "item": bot.new_ledger_item("10:00", 100, 1.0, None, {"fx": 7.0, "rate": 0.1})})
+
+    counts = written(bot)
+    assert counts["snapshot"] > 0 and counts["journal"] > 0
+    assert counts["snapshot"] + counts["journal"] <= backend.wal_size()
+
+
+def test_sqlite_truncates_large_wal(bot, backend, monkeypatch):
+    monkeypatch.setattr(backend, "WAL_CHECKPOINT_BYTES", 1)
+    chat_id = -3003
+    bot.load_group_state(chat_id)
+    assert backend.wal_size() == 0
+    bot.commit_op(chat_id, {"op": "day", "date": "2026-10-01"})
+    assert backend.wal_size() == 0
+    assert backend.load_group(chat_id)["last_date"] == "2026-10-01"
@@ -0,0 +1,39 @@
+import asyncio
+import datetime
+
+CHAT = -1003
+
+
+def days_ago(bot, n: int) -> str:
+    return (datetime.date.fromisoformat(bot.today_str()) - datetime.timedelta(days=n)).isoformat()
+
+
+def test_rollover_archives_and_resets(bot, backend, reopen):
+    yesterday = days_ago(bot, 1)
+    bot.load_group_state(CHAT)
+    bot.commit_op(CHAT, {"op": "day", "date": yesterday})
+    bot.commit_op(CHAT, {"op": "in", "item": bot.new_ledger_item("23:50", 100, 12.85, "美国", {"fx": 7.0, "rate": 0.1})})
+    bot.commit_op(CHAT, {"op": "send", "item": bot.new_send_item("23:55", 5.0)})
+
+    assert asyncio.run(bot.rollover_all_groups()) == 1
+
+    state = reopen(CHAT)
+    assert state["last_date"] == bot.today_str()
+    assert state["recent"] == {"in": [], "out": []}
+    assert state["summary"] == {"should_send_usdt": 0.0, "sent_usdt": 0.0}
+    [(date, totals)] = bot.storage.query_days(CHAT, yesterday, yesterday)
+    assert date == yesterday
+    assert totals["summary"] == {"should_send_usdt": 7.85, "sent_usdt": 0.0}
+    assert totals["count"] == {"in": 1, "out": 0, "send": 1}
+    assert totals["countries"]["美国"]["in"]["raw"] == 100
+
+
+def test_rollover_keeps_todays_ledger(bot, backend):
+    bot.load_group_state(CHAT)
+    bot.commit_op(CHAT, {"op": "day", "date": bot.today_str()})
+    bot.commit_op(CHAT, {"op": "in", "item": bot.new_ledger_item("09:00", 100, 12.85, None, {"fx": 7.0, "rate": 0.1})})
+
+    assert asyncio.run(bot.rollover_all_groups()) == 0
+    assert len(bot.load_group_state(CHAT)["recent"]["in"]) == 1
+    bot.wait_io()
+    assert bot.storage.query_days(CHAT, days_ago(bot, 7), bot.today_str()) == []
@@ -0,0 +1,19 @@
+import pytest
+
+
+@pytest.mark.parametrize("text, name", [
+    ("撤销", "撤销"),
+    ("+100", "入金"),
+    ("+0", "+0"),
+    ("-50/美国", "出金"),
+    ("下发10", "下发"),
+    ("设置入金费率 10", "设置"),
+    ("美国当前点位", "点位"),
+])
+def test_router_matches_commands(bot, text, name):
+    assert bot.match_command(text)[0] == name
+
+
+def test_router_ignores_plain_text(bot):
+    assert bot.match_command("你好") is None
+    assert bot.match_command("") is None
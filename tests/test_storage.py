@@ -0,0 +1,81 @@
+import pytest
+
+CHAT = -1001
+
+
+def record(bot, chat_id: int, kind: str, raw: float, usdt: float, country=None) -> dict:
+    item = (bot.new_send_item("10:00", usdt) if kind == "send"
+            else bot.new_ledger_item("10:00", raw, usdt, country, {"fx": 7.0, "rate": 0.1}))
+    return bot.commit_op(chat_id, {"op": kind, "item": item})
+
+
+def test_round_trip(bot, backend, reopen):
+    bot.load_group_state(CHAT)
+    bot.commit_op(CHAT, {"op": "day", "date": "2026-10-01"})
+    bot.commit_op(CHAT, {"op": "set", "scope": "默认", "direction": "in", "key": "fx", "value": 7.0})
+    bot.commit_op(CHAT, {"op": "set", "scope": "美国", "direction": "out", "key": "rate", "value": -0.02})
+    record(bot, CHAT, "in", 100, 12.85, "美国")
+    record(bot, CHAT, "out", 50, 7.0)
+    record(bot, CHAT, "send", None, 5.0)
+
+    state = reopen(CHAT)
+    assert state["last_date"] == "2026-10-01"
+    assert state["defaults"]["in"]["fx"] == 7.0
+    assert state["countries"]["美国"]["out"]["rate"] == -0.02
+    assert state["summary"] == {"should_send_usdt": 7.85, "sent_usdt": 7.0}
+    assert [(r.raw, r.usdt, r.country) for r in state["recent"]["in"]] == [(100, 12.85, "美国")]
+    assert [(r.type, r.usdt) for r in state["recent"]["out"]] == [("下发", 5.0), (None, 7.0)]
+    assert bot.ensure_aggregates(state)["count"] == {"in": 1, "out": 1, "send": 1}
+
+
+def test_json_journal_replays_after_snapshot(bot, reopen):
+    bot.load_group_state(CHAT)
+    record(bot, CHAT, "in", 100, 10.0)
+    bot.mark_dirty(CHAT)  # 写快照并截断操作日志
+    assert bot.group_journal_path(CHAT).read_text(encoding="utf-8") == ""
+    record(bot, CHAT, "in", 200, 20.0)
+    assert len(bot.group_journal_path(CHAT).read_text(encoding="utf-8").splitlines()) == 1
+
+    state = reopen(CHAT)
+    assert [r.raw for r in state["recent"]["in"]] == [200, 100]
+    assert state["summary"]["should_send_usdt"] == 30.0
+
+
+def test_recipients_round_trip(bot, backend, reopen):
+    backend.save_recipients({})
+    assert backend.load_recipients() is None
+    backend.save_recipients({1: {"status": "active"}, 2: {"status": "active"}})
+    backend.save_recipients({2: {"status": "blocked"}})
+
+    reopen(CHAT)
+    assert bot.storage.load_recipients() == {1: {"status": "active"}, 2: {"status": "blocked"}}
+
+
+def test_json_recipients_compact_into_snapshot(bot, monkeypatch):
+    monkeypatch.setattr(bot.JsonStorage, "RECIPIENT_COMPACT_EVERY", 2)
+    bot.storage.save_recipients({1: {"status": "active"}})
+    assert not bot.RECIPIENTS_FILE.exists()
+    bot.storage.save_recipients({2: {"status": "active"}})
+    assert bot.RECIPIENTS_JOURNAL.read_text(encoding="utf-8") == ""
+    bot.storage.save_recipients({1: {"status": "blocked"}})
+
+    assert bot.JsonStorage().load_recipients() == {1: {"status": "blocked"}, 2: {"status": "active"}}
+
+
+def test_incomplete_backend_fails_at_instantiation(bot):
+    class PartialStorage(bot.StorageBackend):
+        def load_group(self, chat_id):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialStorage()
+
+
+def test_admins_empty_after_removal_is_not_first_run(bot, backend, reopen):
+    assert backend.load_admins() is None  # 从未保存过
+    backend.save_admins([1, 2], {CHAT: [3]})
+    backend.save_admins([], {})
+
+    reopen(CHAT)
+    assert bot.storage.load_admins() == []
+    assert bot.storage.load_group_admins() == {}
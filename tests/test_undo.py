@@ -0,0 +1,75 @@
+import asyncio
+from types import SimpleNamespace
+
+CHAT = -1002
+
+
+def deposit(bot, raw: float, usdt: float, msg: int) -> int:
+    op = bot.commit_op(CHAT, {"op": "in", "item": bot.new_ledger_item("10:00", raw, usdt, None, {"fx": 7.0, "rate": 0.1})})
+    bot.link_reply(CHAT, op, SimpleNamespace(message_id=msg))
+    return op["item"]["id"]
+
+
+def test_undo_removes_exact_record(bot, backend, reopen):
+    bot.load_group_state(CHAT)
+    first = deposit(bot, 100, 12.85, msg=501)
+    deposit(bot, 100, 12.85, msg=502)  # 金额相同的另一笔
+
+    state = reopen(CHAT)
+    index = bot.ensure_record_index(state)
+    assert index["by_msg"][501] == first
+    direction, item = index["by_id"][first]
+    bot.commit_op(CHAT, {"op": "undo", "id": first, "kind": bot.record_kind(direction, item), "usdt": item.usdt})
+
+    state = reopen(CHAT)
+    assert [(r.id, r.msg) for r in state["recent"]["in"]] == [(first + 1, 502)]
+    assert state["summary"]["should_send_usdt"] == 12.85
+    assert bot.ensure_aggregates(state)["count"]["in"] == 1
+
+
+def test_undo_handler_uses_reply_message(bot, monkeypatch):
+    events, replies = [], []
+    monkeypatch.setattr(bot, "is_admin", lambda user_id, chat_id=None: True)
+    monkeypatch.setattr(bot, "log_event", events.append)
+    bot.load_group_state(CHAT)
+    bot.commit_op(CHAT, {"op": "day", "date": bot.today_str()})
+    deposit(bot, 100, 12.85, msg=601)
+    target = deposit(bot, 100, 12.85, msg=602)
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    message = SimpleNamespace(text="撤销", reply_text=reply_text,
+                              reply_to_message=SimpleNamespace(message_id=602, text="", from_user=SimpleNamespace(is_bot=True)))
+    update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=1), effective_chat=SimpleNamespace(id=CHAT))
+    asyncio.run(bot.handle_undo(update, None, "撤销", "撤销"))
+
+    state = bot.load_group_state(CHAT)
+    assert target not in bot.ensure_record_index(state)["by_id"]
+    assert [r.msg for r in state["recent"]["in"]] == [601]
+    assert replies[0].startswith("✅ 已撤销入金记录")
+    assert events[0]["kind"] == "undo_in" and events[0]["id"] == target
+
+
+def test_link_does_not_invalidate_rendered_summary(bot):
+    bot.load_group_state(CHAT)
+    op = bot.commit_op(CHAT, {"op": "in", "item": bot.new_ledger_item("10:00", 100, 12.85, None, {"fx": 7.0, "rate": 0.1})})
+    state = bot.load_group_state(CHAT)
+    version = state["_version"]
+    bot.link_reply(CHAT, op, SimpleNamespace(message_id=701))
+    assert state["_version"] == version
+    assert bot.ensure_record_index(state)["by_msg"][701] == op["item"]["id"]
+
+
+def test_link_folds_into_pending_op(bot, backend, reopen, monkeypatch):
+    bot.load_group_state(CHAT)
+    bot.flush_all_groups()
+    monkeypatch.setattr(bot, "flusher_task", object())  # 后台刷新任务"在运行"：操作留在待写缓冲里
+    record_id = deposit(bot, 100, 12.85, msg=801)
+
+    [(chat_id, snapshot, ops)] = bot.collect_flush_batch()
+    assert [op["op"] for op in ops] == ["in"] and ops[0]["item"]["msg"] == 801
+    bot.submit_flush_batch([(chat_id, snapshot, ops)])
+
+    state = reopen(CHAT)
+    assert bot.ensure_record_index(state)["by_msg"][801] == record_id
@@ -0,0 +1,95 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+UPDATE = {"update_id": 1, "message": {"message_id": 5, "date": 0, "chat": {"id": -100, "type": "group"}, "text": "+0"}}
+
+
+@pytest.fixture
+def app(bot, monkeypatch):
+    """只有更新队列的 Application 替身"""
+    application = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+    monkeypatch.setattr(bot, "webhook_app", application)
+    return application
+
+
+def headers(bot, secret=None) -> dict:
+    return {"x-telegram-bot-api-secret-token": bot.WEBHOOK_SECRET if secret is None else secret}
+
+
+def test_webhook_queues_update(bot, app):
+    status, _, _ = asyncio.run(bot.http_dispatch("POST", bot.WEBHOOK_PATH, headers(bot), json.dumps(UPDATE).encode()))
+    assert status == 200
+    update = app.update_queue.get_nowait()
+    assert update.update_id == 1 and update.message.text == "+0"
+
+
+@pytest.mark.parametrize("body", [b"not json", b"[1, 2]", b"null", b"42", b'{"message": {"text": "x"}}'])
+def test_webhook_rejects_bad_bodies(bot, app, body):
+    status, _, _ = asyncio.run(bot.http_dispatch("POST", bot.WEBHOOK_PATH, headers(bot), body))
+    assert status == 400
+    assert app.update_queue.empty()
+
+
+def test_webhook_checks_secret_and_method(bot, app):
+    body = json.dumps(UPDATE).encode()
+    assert asyncio.run(bot.http_dispatch("POST", bot.WEBHOOK_PATH, headers(bot, "wrong"), body))[0] == 403
+    assert asyncio.run(bot.http_dispatch("GET", bot.WEBHOOK_PATH, headers(bot), b""))[0] == 405
+    assert app.update_queue.empty()
+
+
+def test_webhook_path_disabled_in_polling_mode(bot):
+    assert bot.webhook_app is None
+    assert asyncio.run(bot.http_dispatch("POST", bot.WEBHOOK_PATH, headers(bot), b"{}"))[0] == 404
+
+
+@pytest.mark.parametrize("method, path, status", [
+    ("GET", "/health", 200),
+    ("HEAD", "/", 200),
+    ("POST", "/health", 405),
+    ("GET", "/metrics", 200),
+    ("GET", "/nope", 404),
+])
+def test_dispatch_routes(bot, method, path, status):
+    assert asyncio.run(bot.http_dispatch(method, path, {}, b""))[0] == status
+
+
+def test_server_handles_keep_alive_connection(bot, app):
+    async def exchange():
+        server = await asyncio.start_server(bot.handle_http, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        body = json.dumps(UPDATE).encode()
+        writer.write(f"POST {bot.WEBHOOK_PATH} HTTP/1.1\r\nContent-Length: {len(body)}\r\n"
+                     f"X-Telegram-Bot-Api-Secret-Token: {bot.WEBHOOK_SECRET}\r\n\r\n".encode() + body)
+        writer.write(b"GET /health?x=1 HTTP/1.1\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response.decode()
+
+    response = asyncio.run(exchange())
+    assert response.count("HTTP/1.1 200 OK") == 2
+    assert "Connection: keep-alive" in response and response.endswith("Connection: close\r\n\r\nOK")
+    assert app.update_queue.qsize() == 1
+
+
+def test_server_rejects_oversized_body(bot, monkeypatch):
+    monkeypatch.setattr(bot, "HTTP_MAX_BODY", 10)
+
+    async def exchange():
+        server = await asyncio.start_server(bot.handle_http, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+        writer.write(b"POST /webhook HTTP/1.1\r\nContent-Length: 11\r\n\r\n")
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response.decode()
+
+    assert asyncio.run(exchange()).startswith("HTTP/1.1 413")